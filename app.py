@@ -1,40 +1,157 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g , url_for
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, Response, jsonify, render_template, request, flash, redirect, session, g , url_for
+from flask import abort, current_app, get_flashed_messages, stream_with_context
 from sqlalchemy.exc import IntegrityError,InvalidRequestError
 
+from assets import init_assets, assets_cli
+from cache import init_cache, invalidate_author, invalidate_message, message_card, message_cards
 from forms import UserAddForm, LoginForm, MessageForm , UserEditForm
-from models import db, connect_db, User, Message , Likes , Follows
+from models import db, connect_db, read_rows, User, UserCard, Follows , Recommendation
+from feed import init_feed, feed_cli, home_feed, fan_out_message, follow_added, follow_removed, message_posted, message_deleted
+from feed import mark_posted, new_marks, new_since
+from graph import init_graph_index, graph_cli, log_follow
+from imageproxy import init_image_proxy
+from jobs import enqueue, jobs_cli
+from partitions import init_partitions, messages_before, partitions_cli
+from pubsub import events, init_pubsub, publish_message, subscribe
+from purge import purge_user
+from ratelimit import init_ratelimit, ratelimit_cli
+from recommend import refresh_recommendations, recommendations_cli
+from shards import init_shards, router, shards_cli
+from snowflake import WORKERS, init_snowflake
+from statements import init_statements
+from tags import index_message, init_tags, mentioning, tagged, tags_cli, unindex_message
+from trending import active_authors, count_like, count_post, init_trending, trending_messages
+from warmup import init_warmup
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# endpoints that set their own long-lived cache headers
+CACHED_ENDPOINTS = {'build_static', 'image_proxy'}
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+# rows fetched per round trip by streamed pages
+STREAM_ROWS = 100
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+# template output chunks collected before each write of a streamed page
+STREAM_BUFFER = 20
 
-connect_db(app)
+# messages per profile page
+PROFILE_PAGE = 100
+
+# most cards fetched at once by the live timeline
+MAX_CARDS = 100
+
+# messages per hashtag or mentions page
+INDEX_PAGE = 100
+
+bp = Blueprint('warbler', __name__)
+
+
+def create_app(config=None):
+    """Create and configure the Warbler app.
+
+    `config` overrides the defaults below. Nothing here connects to the
+    database: Flask-SQLAlchemy creates the engine when it's first used. The
+    debug toolbar is only imported and installed in debug mode.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Optional in-memory follows graph: 'db' or the path of a snapshot
+    app.config['GRAPH_INDEX'] = os.environ.get('GRAPH_INDEX')
+
+    # Shared rate limit buckets ('tcp://host:port'); per process if unset
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND')
+
+    # Reverse proxies in front of the app, whose X-Forwarded-For headers
+    # give the client address rate limits are kept by
+    app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', 0))
+
+    # Databases for messages and likes, comma-separated; the main one if unset
+    app.config['SHARD_URLS'] = os.environ.get('SHARD_URLS')
+
+    # Broker for live updates ('module:Class'); pubsub.LocalBroker if unset
+    app.config['PUBSUB_BROKER'] = os.environ.get('PUBSUB_BROKER')
+
+    # Prepare the hot queries on the Postgres server (not behind PgBouncer
+    # in transaction mode)
+    app.config['PREPARED_STATEMENTS'] = bool(os.environ.get('PREPARED_STATEMENTS'))
+
+    # This host's range of message id workers, one per process running at
+    # once; required outside debug and testing (see snowflake.py)
+    worker_id = os.environ.get('SNOWFLAKE_WORKER_ID')
+    app.config['SNOWFLAKE_WORKER_ID'] = int(worker_id) if worker_id else None
+    app.config['SNOWFLAKE_WORKERS'] = int(os.environ.get('SNOWFLAKE_WORKERS', WORKERS))
+
+    app.config.update(config or {})
+
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(graph_cli)
+    app.cli.add_command(feed_cli)
+    app.cli.add_command(ratelimit_cli)
+    app.cli.add_command(partitions_cli)
+    app.cli.add_command(shards_cli)
+    app.cli.add_command(tags_cli)
+
+    init_snowflake(app)
+    init_assets(app)
+    init_statements(app)
+    init_cache(app)
+    init_feed(app)
+    init_image_proxy(app)
+    init_graph_index(app)
+    init_partitions(app)
+    init_shards(app)
+    init_pubsub(app)
+    init_trending(app)
+    init_tags(app)
+
+    # after everything that adds template filters, which templates need to
+    # compile, and before the views, so request timing covers their hooks
+    init_warmup(app)
+
+    app.register_blueprint(bp)
+
+    # after the views' hooks, which set g.user
+    init_ratelimit(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.find(session[CURR_USER_KEY])
+
+        if g.user and g.user.deleted_at:
+            # account deleted in another session
+            do_logout()
+            g.user = None
 
     else:
         g.user = None
@@ -53,7 +170,29 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def stream_page(template_name, **context):
+    """Render a template as a streamed response.
+
+    The page is sent as it renders, so the head and profile card go out
+    before a long list is done; pass the list as a `read_rows` generator and
+    its rows are rendered as they arrive from the database. The request context
+    (and the DB session) stays open until the last chunk is sent.
+    """
+
+    # the session cookie is saved before the body renders, so take flashed
+    # messages out of it now; base.html gets the same ones
+    get_flashed_messages(with_categories=True)
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+
+    return Response(stream_with_context(stream))
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -90,7 +229,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -110,19 +249,19 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
     do_logout()
 
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -131,56 +270,80 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.cards(viewer_id=g.user.id if g.user else None)
 
-    return render_template('users/index.html', users=users)
+    if search:
+        users = users.where(User.__table__.c.username.like(f"%{search}%"))
 
+    return stream_page('users/index.html',
+                       users=read_rows(users, UserCard, yield_per=STREAM_ROWS))
 
-@app.route('/users/<int:user_id>')
+
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    Paginated: takes a 'before' param in querystring (the last message id
+    of the previous page).
+    """
+
+    user = User.find(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    if not user or user.deleted_at:
+        abort(404)
 
+    # one index range scan on the author's shard, so their own new post or
+    # delete shows whichever worker serves the page; older pages may come
+    # from archived months
+    messages = messages_before(user_id, request.args.get('before', type=int), PROFILE_PAGE)
+    next_before = messages[-1].id if len(messages) == PROFILE_PAGE else None
 
-@app.route('/users/<int:user_id>/following')
+    return render_template('users/show.html', user=user, messages=messages,
+                           like_counts=router.like_counts([m.id for m in messages]),
+                           next_before=next_before)
+
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
+
+    Paginated: takes an 'after' param in querystring (the last user id of
+    the previous page).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_after = user.following_page(
+        viewer_id=g.user.id, after=request.args.get('after', type=int))
 
+    return stream_page('users/following.html',
+                       user=user, users=users, next_after=next_after)
 
-@app.route('/users/<int:user_id>/followers')
+
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
+
+    Paginated: takes an 'after' param in querystring (the last user id of
+    the previous page).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_after = user.followers_page(
+        viewer_id=g.user.id, after=request.args.get('after', type=int))
+
+    return stream_page('users/followers.html',
+                       user=user, users=users, next_after=next_after)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -190,12 +353,18 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    follow_added(g.user, followed_user.id)
+    log_follow(g.user.id, followed_user.id)
+    enqueue(refresh_recommendations, user_id=g.user.id)
     db.session.commit()
 
+    if User.graph_index:
+        User.graph_index.follow(g.user.id, followed_user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -205,18 +374,24 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    follow_removed(g.user, followed_user.id)
+    log_follow(g.user.id, followed_user.id, following=False)
+    enqueue(refresh_recommendations, user_id=g.user.id)
     db.session.commit()
 
+    if User.graph_index:
+        User.graph_index.unfollow(g.user.id, followed_user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     form = UserEditForm(obj=g.user)
 
@@ -235,8 +410,9 @@ def profile():
 
             try:
                 db.session.commit()
+                invalidate_author(user.id)
 
-                return redirect(url_for('users_show' , user_id=user.id))
+                return redirect(url_for('.users_show' , user_id=user.id))
             except IntegrityError:
                 db.session.rollback()
 
@@ -253,9 +429,13 @@ def profile():
 
     
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is marked deleted and logged out right away; a background
+    job purges its messages, likes and follows.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -263,16 +443,19 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    g.user.mark_deleted()
+    enqueue(purge_user, user_id=g.user.id)
     db.session.commit()
 
+    invalidate_author(g.user.id)
+
     return redirect("/signup")
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -286,24 +469,103 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = router.add_message(g.user.id, form.text.data)
+
+        enqueue(fan_out_message, message_id=msg.id)
+        mark_posted(msg)
+        index_message(msg)
         db.session.commit()
 
+        message_posted(msg)
+        publish_message(msg)
+        count_post(msg)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/cards')
+def messages_cards():
+    """Home page cards of the messages in the 'ids' querystring param
+    (comma-separated), for the live timeline."""
+
+    if not g.user:
+        abort(401)
+
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id][:MAX_CARDS]
+    except ValueError:
+        abort(400)
+
+    messages = message_cards(ids)
+
+    return render_template('messages/cards.html', messages=messages, likes=(),
+                           like_counts=router.like_counts([m.id for m in messages]))
+
+
+@bp.route('/messages/since')
+def messages_since():
+    """Count and ids (the newest 100 at most) of messages from followed
+    accounts newer than the 'after' querystring param, a message id, as JSON.
+
+    The ETag is made of 'after' and the newest of those ids, so a poll with
+    nothing new is answered 304 from the high-water marks alone.
+    """
+
+    if not g.user:
+        abort(401)
+
+    try:
+        after = int(request.args['after'])
+    except (KeyError, ValueError):
+        abort(400)
+
+    marks = new_marks(g.user.id, after)
+    etag = f"{after}-{max((message_id for _, message_id in marks), default=after)}"
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        ids = new_since(marks, after)
+        resp = jsonify(count=len(ids), ids=[str(id) for id in ids])
+
+    resp.set_etag(etag)
+    return resp
+
+
+@bp.route('/stream')
+def stream():
+    """Server-sent events with the ids of new messages for the home page.
+
+    Streamed without the request context, so no database connection is
+    held while it waits (see pubsub).
+    """
+
+    if not g.user:
+        abort(401)
+
+    return Response(events(subscribe(g.user)), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    message = message_card(message_id)
 
+    if not message:
+        abort(404)
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+    viewer_follows = (g.user is not None and g.user.id != message.user_id
+                      and g.user.is_following_id(message.user_id))
+
+    return render_template('messages/show.html',
+                           message=message, viewer_follows=viewer_follows)
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -311,19 +573,26 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = router.find_message(message_id)
+
+    if not msg:
+        abort(404)
 
     if g.user.id != msg.user_id:
         #can only delete your own message
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
+    router.delete_message(msg)
+    unindex_message(message_id)
     db.session.commit()
 
+    invalidate_message(message_id)
+    message_deleted(msg)
+
     return redirect(f"/users/{g.user.id}")
 
-@app.route('/users/add_like/<int:message_id>' , methods=["POST"])
+@bp.route('/users/add_like/<int:message_id>' , methods=["POST"])
 def messages_add_like(message_id):
     """Add like to a message"""
 
@@ -331,28 +600,24 @@ def messages_add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = router.find_message(message_id)
+
+    if not msg:
+        abort(404)
 
     if g.user.id == msg.user_id:
         flash("Can not like your own message!" , "danger")
         return redirect('/')
 
-    if g.user.is_like(msg):
-        # alrealy like this message, unlike it
-        Likes.query.filter(Likes.user_id==g.user.id , Likes.message_id==msg.id).delete()
-        db.session.commit()
-
-        return redirect('/')
-
-    # like this message
-    like = Likes(user_id = g.user.id , message_id=message_id)
-
-    db.session.add(like)
+    # like this message, or unlike it if already liked
+    liked = router.toggle_like(g.user.id, message_id)
     db.session.commit()
 
+    count_like(g.user.id, message_id, liked)
+
     return redirect('/')
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     """Show list of messages this user likes."""
 
@@ -361,33 +626,98 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    messages = router.liked_messages(user, yield_per=STREAM_ROWS)
+
+    return stream_page('users/likes.html', user=user, messages=messages)
+
+def indexed_page(title, entries):
+    """A page of the messages of (message id, author id) index `entries`,
+    with a link to the next one."""
+
+    messages = message_cards([message_id for message_id, _ in entries], dict(entries))
+    next_before = entries[-1][0] if len(entries) == INDEX_PAGE else None
+
+    return render_template('messages/index.html', title=title, messages=messages,
+                           likes=router.liked_ids(g.user.id),
+                           like_counts=router.like_counts([m.id for m in messages]),
+                           next_before=next_before)
+
+
+@bp.route('/tags/<tag>')
+def tags_show(tag):
+    """Show the messages with a hashtag.
+
+    Paginated: takes a 'before' param in querystring (the last message id
+    of the previous page).
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', type=int)
+
+    return indexed_page(f"#{tag.lower()}", tagged(tag, before, INDEX_PAGE))
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show the messages mentioning this user.
+
+    Paginated like tags_show.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+    before = request.args.get('before', type=int)
+
+    return indexed_page(f"Mentioning @{user.username}", mentioning(user_id, before, INDEX_PAGE))
+
+
+@bp.route('/trending')
+def trending():
+    """Show the messages liked most and the accounts posting most lately,
+    from this worker's counters (see trending)."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    pairs = trending_messages()
+    messages = [card for card, _ in pairs]
+    likes = router.liked_ids(g.user.id)
+
+    # the counts shown are the window's, from the counters too
+    return render_template('trending.html', messages=messages, likes=likes,
+                           like_counts={card.id: count for card, count in pairs},
+                           authors=active_authors(limit=10))
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users and
+      who to follow suggestions
     """
 
     if g.user:
 
-        user_ids = [g.user.id , *[user.id for user in g.user.following]]
+        messages = home_feed(g.user)
+        likes = router.liked_ids(g.user.id)
+        suggestions = Recommendation.for_user(g.user.id)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = [like.message_id for like in db.session.query(Likes).filter(Likes.user_id == g.user.id).all()]
+        like_counts = router.like_counts([m.id for m in messages])
 
-        return render_template('home.html', messages=messages , likes=likes)
+        return render_template('home.html', messages=messages , likes=likes ,
+                               like_counts=like_counts, suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
@@ -400,12 +730,18 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    if request.endpoint in CACHED_ENDPOINTS:
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+app = create_app()
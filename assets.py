@@ -0,0 +1,384 @@
+"""Static asset pipeline.
+
+    (venv) $ flask assets build
+
+downloads the vendored CSS/JS, minifies the CSS and our own JS (the vendored
+scripts come minified), and writes every asset to
+static/build/ under a content-hashed file name, with .gz (and, if brotli is
+installed, .br) copies of text files and resized WebP/AVIF variants of the
+large images. static/build/manifest.json maps asset names to built files.
+
+Templates link assets with `asset_url(name)` and pick image sizes with the
+`image_variant` filter, which only picks WebP/AVIF for clients whose
+Accept header lists the format. Until a build has been run both fall back
+to the CDN or the original files, so development works without one.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
+
+import click
+from flask import g, has_request_context, request, send_from_directory
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_PATH = os.path.join(BUILD_DIR, 'manifest.json')
+
+# asset name -> CDN URL, or path under static/
+ASSETS = {
+    'vendor/bootstrap.css': 'https://unpkg.com/bootstrap@4.1.3/dist/css/bootstrap.min.css',
+    'vendor/fontawesome.css': 'https://use.fontawesome.com/releases/v5.3.1/css/all.css',
+    'vendor/jquery.js': 'https://unpkg.com/jquery@3.3.1/dist/jquery.min.js',
+    'vendor/popper.js': 'https://unpkg.com/popper.js@1.14.4/dist/umd/popper.min.js',
+    'vendor/bootstrap.js': 'https://unpkg.com/bootstrap@4.1.3/dist/js/bootstrap.min.js',
+    'favicon.ico': 'favicon.ico',
+    'images/warbler-logo.png': 'images/warbler-logo.png',
+    'images/nav-bg.png': 'images/nav-bg.png',
+    'images/default-pic.png': 'images/default-pic.png',
+    'images/warbler-hero.jpg': 'images/warbler-hero.jpg',
+    'images/signed-out-home.jpg': 'images/signed-out-home.jpg',
+    'stylesheets/style.css': 'stylesheets/style.css',
+    'scripts/stream.js': 'scripts/stream.js',
+}
+
+# image name -> widths of the resized variants to generate
+IMAGE_VARIANTS = {
+    'images/warbler-hero.jpg': [640, 1280],
+    'images/default-pic.png': [96, 200],
+}
+
+VARIANT_FORMATS = {
+    'webp': dict(quality=80),
+    'avif': dict(quality=50),
+}
+
+COMPRESSED_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.eot', '.ttf', '.json'}
+
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+# loaded by init_assets()
+manifest = {'assets': {}, 'variants': {}}
+
+
+def minify_css(css):
+    """Strip comments and insignificant whitespace from `css`."""
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """Strip whole-line comments, indentation and blank lines from `js`.
+
+    Comments after code and spaces within lines are kept, so nothing inside
+    a string or regular expression is touched, and line breaks are kept for
+    automatic semicolon insertion. Not for multi-line template literals,
+    whose indentation is part of the string.
+    """
+
+    lines = []
+    in_comment = False
+
+    for line in js.splitlines():
+        line = line.strip()
+
+        if in_comment:
+            if '*/' not in line:
+                continue
+
+            in_comment = False
+            line = line.split('*/', 1)[1].strip()
+
+        if line.startswith('/*'):
+            if '*/' not in line[2:]:
+                in_comment = True
+                continue
+
+            line = line[2:].split('*/', 1)[1].strip()
+
+        if line and not line.startswith('//'):
+            lines.append(line)
+
+    return '\n'.join(lines) + '\n'
+
+
+class Builder:
+    """Builds the assets in `ASSETS` into `build_dir`."""
+
+    def __init__(self, build_dir=BUILD_DIR):
+        self.build_dir = build_dir
+        self.assets = {}
+        self.variants = {}
+
+    def build(self):
+        """Build every asset and write the manifest. Returns the manifest."""
+
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+        os.makedirs(self.build_dir)
+
+        # stylesheets last, so the files they reference are already built
+        for name, source in sorted(ASSETS.items(),
+                                   key=lambda item: item[0].endswith('.css')):
+            self.add(name, source)
+
+        for name, widths in IMAGE_VARIANTS.items():
+            self.add_variants(name, ASSETS[name], widths)
+
+        result = {'assets': self.assets, 'variants': self.variants}
+
+        with open(os.path.join(self.build_dir, 'manifest.json'), 'w') as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+
+        return result
+
+    def read(self, source):
+        """Contents of a CDN URL or a file under static/."""
+
+        if is_remote(source):
+            with urlopen(source) as response:
+                return response.read()
+
+        with open(os.path.join(STATIC_DIR, source), 'rb') as file:
+            return file.read()
+
+    def add(self, name, source):
+        """Build one asset; returns its path under static/."""
+
+        if name in self.assets:
+            return self.assets[name]
+
+        data = self.read(source)
+
+        if name.endswith('.css'):
+            css = self.rewrite_urls(data.decode('utf-8'), source)
+            data = minify_css(css).encode('utf-8')
+        elif name.endswith('.js') and not is_remote(source):
+            data = minify_js(data.decode('utf-8')).encode('utf-8')
+
+        self.assets[name] = self.write(name, data)
+        return self.assets[name]
+
+    def rewrite_urls(self, css, source):
+        """Build the files `css` references and point it at the built copies."""
+
+        def replace(match):
+            url = match.group(2)
+
+            if url.startswith(('data:', '#')):
+                return match.group(0)
+
+            # keep '?#iefix' and '#id' suffixes used by font files
+            path, _, suffix = url.partition('#')
+            path, _, query = path.partition('?')
+            suffix = ('?' + query if query else '') + ('#' + suffix if suffix else '')
+
+            if path.startswith('/static/'):
+                ref_name = ref_source = path[len('/static/'):]
+            elif is_remote(source) or is_remote(path):
+                ref_source = urljoin(source, path)
+                ref_name = 'vendor/' + os.path.basename(urlsplit(ref_source).path)
+            else:
+                ref_name = ref_source = os.path.normpath(
+                    os.path.join(os.path.dirname(source), path))
+
+            return f'url("/static/{self.add(ref_name, ref_source)}{suffix}")'
+
+        return CSS_URL.sub(replace, css)
+
+    def add_variants(self, name, source, widths):
+        """Write resized copies of an image in each of `VARIANT_FORMATS`."""
+
+        from PIL import Image
+
+        image = Image.open(os.path.join(STATIC_DIR, source))
+        base, _ = os.path.splitext(name)
+        variants = []
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        for width in widths:
+            if width >= image.width:
+                continue
+
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+
+            for fmt, options in VARIANT_FORMATS.items():
+                data = io.BytesIO()
+
+                try:
+                    resized.save(data, fmt, **options)
+                except (KeyError, OSError):
+                    # this Pillow build can't write the format
+                    continue
+
+                path = self.write(f"{base}-{width}.{fmt}", data.getvalue())
+                variants.append([width, fmt, path])
+
+        self.variants[name] = variants
+
+    def write(self, name, data):
+        """Write `data` under a content-hashed name; returns the path under static/."""
+
+        base, ext = os.path.splitext(name)
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        filename = f"{base}.{digest}{ext}"
+        path = os.path.join(self.build_dir, filename)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as file:
+            file.write(data)
+
+        if ext in COMPRESSED_EXTENSIONS:
+            with open(path + '.gz', 'wb') as file:
+                file.write(gzip.compress(data, 9))
+
+            if brotli:
+                with open(path + '.br', 'wb') as file:
+                    file.write(brotli.compress(data))
+
+        return os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+
+
+def is_remote(source):
+    """Is `source` a URL rather than a path under static/?"""
+
+    return source.startswith(('http://', 'https://', '//'))
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """Read the manifest written by the last build, if there is one."""
+
+    if not os.path.exists(path):
+        return {'assets': {}, 'variants': {}}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def asset_url(name):
+    """URL of the asset `name`: the built file if there is one."""
+
+    if name in manifest['assets']:
+        return f"/static/{manifest['assets'][name]}"
+
+    source = ASSETS.get(name, name)
+
+    return source if is_remote(source) else f"/static/{source}"
+
+
+def accepts_image(fmt):
+    """Does the client list `fmt` ('webp', 'avif') in its Accept header?
+
+    Browsers that can show the format name it in the Accept header of page
+    requests too; a bare */* doesn't count. The page then depends on the
+    header, so it's marked to vary on it.
+    """
+
+    g.vary_accept = True
+
+    return f"image/{fmt}" in request.accept_mimetypes.values()
+
+
+def image_variant(url, width, fmt='webp'):
+    """URL of the smallest built variant of `url` at least `width` wide.
+
+    Falls back to the built original, then to `url` itself, which is
+    returned as is for images that aren't ours. In a request, variants are
+    only picked for clients that accept `fmt`.
+    """
+
+    if not url or not url.startswith('/static/'):
+        return url
+
+    name = url[len('/static/'):]
+    accepted = not has_request_context() or accepts_image(fmt)
+    variants = [(variant_width, path)
+                for variant_width, variant_fmt, path
+                in manifest['variants'].get(name, [])
+                if accepted and variant_fmt == fmt and variant_width >= width]
+
+    if variants:
+        return f"/static/{min(variants)[1]}"
+
+    return asset_url(name) if name in ASSETS else url
+
+
+def build_static(filename):
+    """Serve a built file, precompressed if the client accepts it.
+
+    Built file names change with their content, so they can be cached
+    for good.
+    """
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+
+    for encoding, ext in [('br', '.br'), ('gzip', '.gz')]:
+        if (encoding in request.accept_encodings
+                and os.path.isfile(os.path.join(BUILD_DIR, filename + ext))):
+            response = send_from_directory(BUILD_DIR, filename + ext,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+
+    if response is None:
+        response = send_from_directory(BUILD_DIR, filename, mimetype=mimetype)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    return response
+
+
+def vary_on_accept(response):
+    """Mark pages whose images were picked by Accept header as varying on it."""
+
+    if g.get('vary_accept'):
+        response.vary.add('Accept')
+
+    return response
+
+
+def init_assets(app):
+    """Load the manifest and register the template helpers and build route."""
+
+    manifest.update(load_manifest())
+
+    app.add_template_global(asset_url)
+    app.add_template_filter(image_variant)
+    app.add_url_rule('/static/build/<path:filename>', 'build_static', build_static)
+    app.after_request(vary_on_accept)
+
+
+assets_cli = AppGroup('assets', help="Build static assets.")
+
+
+@assets_cli.command('build')
+def build_command():
+    """Vendor, minify, fingerprint and compress static assets."""
+
+    result = Builder().build()
+
+    click.echo(f"{len(result['assets'])} assets and "
+               f"{sum(map(len, result['variants'].values()))} image variants "
+               f"written to {BUILD_DIR}")
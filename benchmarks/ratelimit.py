@@ -0,0 +1,64 @@
+"""How long a rate limit decision takes.
+
+    (venv) $ python benchmarks/ratelimit.py
+
+Times `LocalBuckets.take` on its own, the limiter's before-request hook for
+a limited and an unlimited route, and `RemoteBuckets.take` against a bucket
+server on localhost.
+"""
+
+import os
+import sys
+import timeit
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from ratelimit import LIMITS, BucketServer, LocalBuckets, RateLimiter, RemoteBuckets
+
+NUMBER = 100000
+
+# enough tokens that every request in the benchmark is admitted
+BIG_BURST = 10 ** 9
+
+
+def report(name, seconds, number):
+    print(f"{name:40} {seconds / number * 1e6:6.2f} us")
+
+
+def main():
+    buckets = LocalBuckets()
+    request = [('warbler.messages_add:user:1', 1.0, BIG_BURST),
+               ('warbler.messages_add:ip:127.0.0.1', 1.0, BIG_BURST)]
+
+    report("LocalBuckets.take (2 buckets)",
+           timeit.timeit(lambda: buckets.take(request), number=NUMBER), NUMBER)
+
+    app = Flask(__name__)
+    limits = {endpoint: {kind: limit._replace(burst=BIG_BURST)
+                         for kind, limit in budgets.items()}
+              for endpoint, budgets in LIMITS.items()}
+    limiter = RateLimiter(limits, LocalBuckets())
+
+    for endpoint in ['warbler.login', 'warbler.homepage']:
+        app.add_url_rule(f"/{endpoint}", endpoint, methods=['POST'])
+
+        with app.test_request_context(f"/{endpoint}", method='POST'):
+            report(f"RateLimiter.check ({endpoint})",
+                   timeit.timeit(limiter.check, number=NUMBER), NUMBER)
+
+    server = BucketServer(('127.0.0.1', 0))
+    Thread(target=server.serve_forever, daemon=True).start()
+    remote = RemoteBuckets(*server.server_address)
+
+    number = NUMBER // 10
+    report("RemoteBuckets.take (localhost)",
+           timeit.timeit(lambda: remote.take(request), number=number), number)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
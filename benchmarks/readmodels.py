@@ -0,0 +1,93 @@
+"""What a list page costs read as ORM entities and as read-model rows.
+
+    (venv) $ python benchmarks/readmodels.py
+
+Fills a scratch database (`BENCH_DATABASE_URL`, a temporary SQLite file by
+default) with `USERS` users, then renders the /users page from full `User`
+entities, as it used to be read, and from `UserCard` rows read with Core
+(`read_rows`). Reports the peak memory allocated while reading and
+rendering, and the best time of `RUNS`.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', f"sqlite:///{tempfile.gettempdir()}/warbler-bench.db")
+os.environ.setdefault('SNOWFLAKE_WORKER_ID', '0')
+
+from flask import g, render_template
+
+from app import app
+from models import db, read_rows, User, UserCard
+
+USERS = 5000
+RUNS = 5
+
+
+def orm_page():
+    users = User.query.filter(User.deleted_at.is_(None)).order_by(User.id).all()
+    return render_template('users/index.html', users=users)
+
+
+def read_model_page():
+    return render_template('users/index.html', users=read_rows(User.cards(), UserCard))
+
+
+def measure(page):
+    """(peak bytes, best seconds) of rendering `page` in fresh sessions.
+
+    Memory is traced in a run of its own, since tracing slows everything.
+    """
+
+    peak = None
+    times = []
+
+    for run in range(RUNS + 1):
+        with app.test_request_context('/users'):
+            g.user = None
+
+            if run == 0:
+                tracemalloc.start()
+                page()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                page()
+                times.append(time.perf_counter() - start)
+
+            db.session.remove()
+
+    return peak, min(times)
+
+
+def main():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [
+            dict(username=f"user{i}", email=f"user{i}@example.com",
+                 password="$2b$12$" + "x" * 53, bio="x" * 200, location="Somewhere")
+            for i in range(USERS)])
+        db.session.commit()
+
+    # compile the template and warm the engine first
+    measure(read_model_page)
+
+    for name, page in [("ORM entities", orm_page), ("read-model rows", read_model_page)]:
+        peak, seconds = measure(page)
+        print(f"{name:16} {peak / 2 ** 20:6.1f} MB peak, {seconds * 1000:6.1f} ms "
+              f"for {USERS} users")
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
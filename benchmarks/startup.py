@@ -0,0 +1,98 @@
+"""How long the app takes to start.
+
+    (venv) $ python benchmarks/startup.py
+
+Imports the app in fresh interpreters with `python -X importtime` and
+reports the total import time, the slowest modules `app` imports directly,
+and the time `create_app()` takes on its own.
+"""
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one process at a time
+os.environ.setdefault('SNOWFLAKE_WORKER_ID', '0')
+
+RUNS = 5
+TOP = 15
+
+# import time: self [us] | cumulative | imported package
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+CREATE_APP = """
+import time
+import app
+start = time.perf_counter()
+app.create_app()
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def run(args):
+    """Run Python with `args` from the repo root; returns the completed process."""
+
+    return subprocess.run([sys.executable, *args], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def import_times():
+    """Time of `import app` and (time, module) of each module it imports directly.
+
+    Times are cumulative, in microseconds.
+    """
+
+    stderr = run(['-X', 'importtime', '-c', 'import app']).stderr
+    total = None
+    times = []
+
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+
+        if not match:
+            continue
+
+        # a module's line follows its imports', which are indented two
+        # more spaces per level
+        depth = len(match.group(3)) // 2
+        cumulative, module = int(match.group(2)), match.group(4)
+
+        if depth == 1:
+            times.append((cumulative, module))
+        elif depth == 0 and module == 'app':
+            total = cumulative
+            break
+        elif depth == 0:
+            times = []
+
+    return total, times
+
+
+def main():
+    totals = []
+
+    for _ in range(RUNS):
+        total, times = import_times()
+        totals.append(total)
+
+    print(f"import app: {statistics.median(totals) / 1000:.0f} ms "
+          f"(median of {RUNS} runs)")
+    print()
+
+    for cumulative, module in sorted(times, reverse=True)[:TOP]:
+        print(f"{cumulative / 1000:8.1f} ms  {module}")
+
+    create = [float(run(['-c', CREATE_APP]).stdout) for _ in range(RUNS)]
+
+    print()
+    print(f"create_app(): {statistics.median(create):.0f} ms "
+          f"(median of {RUNS} runs)")
+
+
+if __name__ == '__main__':
+    main()
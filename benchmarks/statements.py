@@ -0,0 +1,102 @@
+"""What building and compiling the hot queries costs per call.
+
+    (venv) $ python benchmarks/statements.py
+
+Runs each hot query `NUMBER` times against a small scratch database
+(`BENCH_DATABASE_URL`, a temporary SQLite file by default), built as it used
+to be on every call and as a `Statement`/baked query built once, and
+reports the time per call. The queries are trivial for the database, so the
+difference is the Python overhead saved on each request.
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', f"sqlite:///{tempfile.gettempdir()}/warbler-bench.db")
+os.environ.setdefault('SNOWFLAKE_WORKER_ID', '0')
+
+from app import app
+from feed import TIMELINE
+from models import db, Follows, Likes, TimelineEntry, User, USER_FOLLOWING_COUNT
+from shards import router
+
+NUMBER = 2000
+
+
+def report(name, built, cached):
+    print(f"{name:24} {built / NUMBER * 1e6:7.1f} us built per call, "
+          f"{cached / NUMBER * 1e6:7.1f} us cached, "
+          f"{(built - cached) / NUMBER * 1e6:6.1f} us saved")
+
+
+def get_user():
+    db.session.expunge_all()
+    return User.query.get(1)
+
+
+def find_user():
+    db.session.expunge_all()
+    return User.find(1)
+
+
+def following_count():
+    return Follows.query.filter(Follows.user_following_id == 1).count()
+
+
+def liked_ids():
+    likes = Likes.__table__
+
+    return [message_id for (message_id,) in db.session.execute(
+        db.select([likes.c.message_id])
+        .where(likes.c.user_id == 1)
+        .order_by(likes.c.message_id.desc()))]
+
+
+def timeline():
+    return (db.session
+            .query(TimelineEntry.message_id, TimelineEntry.author_id)
+            .filter(TimelineEntry.user_id == 1)
+            .order_by(TimelineEntry.message_id.desc())
+            .limit(100)
+            .all())
+
+
+def main():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [
+            dict(username=f"user{i}", email=f"user{i}@example.com", password="x")
+            for i in range(1, 11)])
+        db.session.bulk_insert_mappings(Follows, [
+            dict(user_following_id=1, user_being_followed_id=i) for i in range(2, 11)])
+        db.session.commit()
+
+        cases = [
+            ("add_user_to_g", get_user, find_user),
+            ("following count", following_count,
+                lambda: USER_FOLLOWING_COUNT.execute(db.session, user_id=1).scalar()),
+            ("liked ids", liked_ids, lambda: router.liked_ids(1)),
+            ("home timeline", timeline,
+                lambda: TIMELINE.execute(db.session, user_id=1, limit=100).fetchall()),
+        ]
+
+        for name, built, cached in cases:
+            # warm both up, so the cached version is compiled already
+            built()
+            cached()
+
+            report(name, timeit.timeit(built, number=NUMBER),
+                   timeit.timeit(cached, number=NUMBER))
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
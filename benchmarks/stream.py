@@ -0,0 +1,51 @@
+"""What idle live-timeline streams cost.
+
+    (venv) $ python benchmarks/stream.py
+
+Opens `STREAMS` subscriptions to `FOLLOWS` authors each on a
+`LocalBroker`, as many /stream connections would, and reports the memory
+they hold and how long publishing a message to an author's followers takes.
+The connections themselves are greenlets under serve_async.py: a few KB of
+stack each.
+"""
+
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pubsub import LocalBroker
+
+STREAMS = 10000
+FOLLOWS = 100
+AUTHORS = 20000
+NUMBER = 1000
+
+
+def main():
+    random.seed(0)
+    broker = LocalBroker()
+
+    tracemalloc.start()
+    subscriptions = [broker.subscribe(random.sample(range(AUTHORS), FOLLOWS))
+                     for _ in range(STREAMS)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{STREAMS} subscriptions of {FOLLOWS} authors: {size / 2 ** 20:.1f} MB, "
+          f"{size / STREAMS / 1024:.1f} KB each")
+
+    followers = sum(len(broker.channels.get(author, ())) for author in range(AUTHORS)) / AUTHORS
+    seconds = timeit.timeit(lambda: broker.publish(random.randrange(AUTHORS), 1), number=NUMBER)
+
+    print(f"publish to {followers:.0f} followers: {seconds / NUMBER * 1e6:.1f} us")
+
+    for subscription in subscriptions:
+        subscription.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""In-process caches of rarely changing rows.
+
+A message's text never changes after it's posted, and its author's name and
+picture change rarely, yet a linked message page used to read both on every
+view. `message_card` keeps them here instead, in two caches so one profile
+edit doesn't have to find every message of its author:
+
+- `messages`: message id -> (id, text, timestamp, user id)
+- `authors`: user id -> (username, image url)
+
+Views that change these rows call `invalidate_message`/`invalidate_author`
+after committing. That only clears this process's copy: entries also expire
+after `CACHE_TTL` seconds, which bounds how long other workers serve stale
+ones.
+
+`recent` keeps the newest messages of each author, for the hot authors
+merged into home feeds: it's filled from the database on first use, added
+to when the author posts and pruned when they delete a message, and expires
+the same way. Profile pages, and home pages for their owner's messages,
+read the database instead, so authors see their own posts and deletes
+whichever worker serves them.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from models import db, User
+from shards import RecentMessage, router
+
+CACHE_SIZE = 10000
+CACHE_TTL = 60
+
+# messages kept per author by `recent`
+RECENT_SIZE = 100
+
+MessageCard = namedtuple('MessageCard', ['id', 'text', 'timestamp', 'user_id',
+                                         'username', 'image_url'])
+
+
+class TTLCache:
+    """A dict with a size limit, evicting least recently used, and expiry."""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """The value for `key`, calling `load(key)` for it if not cached.
+
+        None (nothing found) isn't cached, so a row that shows up later, or
+        comes back, isn't missed for the TTL.
+        """
+
+        now = self.clock()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+
+        value = load(key)
+
+        if value is not None:
+            self.put(key, value)
+
+        return value
+
+    def put(self, key, value):
+        """Cache `value` for `key`."""
+
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Forget the value for `key`."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Forget every value."""
+
+        with self.lock:
+            self.entries.clear()
+
+
+class RecentMessages:
+    """The newest messages of each author, newest first.
+
+    Each author's messages are a ring buffer of at most `size` entries: a
+    new message pushes out the oldest. A buffer is loaded from the database
+    the first time it's read (or after it expires), so it holds either all
+    of an author's messages or their newest `size`.
+    """
+
+    def __init__(self, size=RECENT_SIZE, authors=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.buffers = TTLCache(size=authors, ttl=ttl)
+
+    def load(self, author_id):
+        """A buffer of the author's newest messages, from the database."""
+
+        return deque(router.author_messages(author_id, limit=self.size), maxlen=self.size)
+
+    def get(self, author_id, limit=None):
+        """List of the author's newest messages (at most `limit`)."""
+
+        buffer = self.buffers.get(author_id, self.load)
+
+        with self.buffers.lock:
+            return list(buffer)[:limit]
+
+    def add(self, message):
+        """Add a new message to its author's buffer, if that is loaded."""
+
+        with self.buffers.lock:
+            entry = self.buffers.entries.get(message.user_id)
+
+            if entry:
+                entry[0].appendleft(RecentMessage(message.id, message.text,
+                                                  message.timestamp, message.user_id))
+
+    def remove(self, author_id, message_id):
+        """Drop a deleted message from its author's buffer."""
+
+        with self.buffers.lock:
+            entry = self.buffers.entries.get(author_id)
+
+            if not entry:
+                return
+
+            buffer = entry[0]
+
+            if len(buffer) == self.size:
+                # the author may have older messages than the buffer holds,
+                # and the next one should take this one's place
+                del self.buffers.entries[author_id]
+                return
+
+            for message in buffer:
+                if message.id == message_id:
+                    buffer.remove(message)
+                    break
+
+    def clear(self):
+        """Forget every buffer."""
+
+        self.buffers.clear()
+
+
+messages = TTLCache()
+authors = TTLCache()
+recent = RecentMessages()
+
+
+def load_message(message_id):
+    """(id, text, timestamp, user id) of a message, or None."""
+
+    row = router.find_message(message_id)
+
+    return row and tuple(row)
+
+
+def load_author(user_id):
+    """(username, image url) of a user, or None if deleted."""
+
+    row = (db.session
+           .query(User.username, User.image_url)
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+
+    return row and tuple(row)
+
+
+def message_card(message_id):
+    """`MessageCard` of a message and its author, or None."""
+
+    message = messages.get(message_id, load_message)
+
+    if not message:
+        return None
+
+    author = authors.get(message[3], load_author)
+
+    if not author:
+        return None
+
+    return MessageCard(*message, *author)
+
+
+def message_cards(message_ids, author_ids=None):
+    """`MessageCard`s of messages, in the order of `message_ids`.
+
+    Messages not cached are read in one go; missing ones are left out. With
+    `author_ids` ({message id: author id}), each is read from its author's
+    shard only, instead of every shard.
+    """
+
+    with messages.lock:
+        now = messages.clock()
+        cached = {message_id: entry[0] for message_id, entry in
+                  ((message_id, messages.entries.get(message_id)) for message_id in message_ids)
+                  if entry and entry[1] > now}
+
+    missing = [message_id for message_id in message_ids if message_id not in cached]
+
+    if author_ids is None:
+        rows = router.find_messages(missing)
+    else:
+        rows = router.fetch_messages([(message_id, author_ids[message_id])
+                                      for message_id in missing])
+
+    for message_id, row in rows.items():
+        cached[message_id] = tuple(row)
+        messages.put(message_id, cached[message_id])
+
+    cards = []
+
+    for message_id in message_ids:
+        message = cached.get(message_id)
+        author = message and authors.get(message[3], load_author)
+
+        if author:
+            cards.append(MessageCard(*message, *author))
+
+    return cards
+
+
+def invalidate_message(message_id):
+    """Forget a deleted message."""
+
+    messages.invalidate(message_id)
+
+
+def invalidate_author(user_id):
+    """Forget an edited or deleted user."""
+
+    authors.invalidate(user_id)
+
+
+def init_cache(app):
+    """Size the caches from the app config."""
+
+    for cache in (messages, authors, recent.buffers):
+        cache.size = app.config.get('CACHE_SIZE', cache.size)
+        cache.ttl = app.config.get('CACHE_TTL', cache.ttl)
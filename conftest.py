@@ -0,0 +1,8 @@
+"""Shared setup for the test modules."""
+
+import os
+
+# The app won't start without a snowflake worker id (see readme). Set it
+# here, before any test module imports app, instead of in every test file.
+
+os.environ.setdefault('SNOWFLAKE_WORKER_ID', "0")
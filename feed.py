@@ -0,0 +1,571 @@
+"""Home timelines.
+
+A home page shows the newest messages of the accounts a user follows. Two
+ways of assembling it are combined:
+
+- fan-out on write: when an account posts, a job copies the message into
+  the precomputed timeline (the `timelines` table) of each follower, so
+  reading a timeline is one range scan of its primary key;
+- fan-out on read: messages of hot authors, those with at least
+  `HOT_FOLLOWERS` followers, are not copied, which would be one write per
+  follower. They are merged into each page at read time from each
+  author's buffer of recent messages (`cache.recent`), as are the user's
+  own messages.
+
+`refresh_hot_authors` decides which authors are hot every few minutes. An
+author stays hot until their followers drop below half the threshold, so
+accounts near it don't flip between the two paths. When one does cool down,
+their newest messages, which were never fanned out, are copied into their
+followers' timelines before they stop being merged.
+
+Timelines are filled the first time they're read (`ensure_timeline`) and
+kept to `TIMELINE_SIZE` entries by a daily job. `metrics` counts the work
+done on each path, and `flask feed stats` shows what a given threshold
+would cost, for tuning it.
+
+Each author's newest message id is also kept in a table of high-water
+marks, so "is there anything new since this message?" (`new_marks`) is one
+indexed query for clients polling a home page.
+"""
+
+import heapq
+import logging
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+
+from cache import TTLCache, MessageCard, RecentMessage, authors, load_author, recent
+from jobs import task
+from models import db, Follows, HighWaterMark, HotAuthor, TimelineEntry, User
+from shards import insert_ignoring_duplicates, router
+from statements import Statement
+
+logger = logging.getLogger(__name__)
+
+FEED_SIZE = 100
+TIMELINE_SIZE = 800
+HOT_FOLLOWERS = 10000
+
+# messages read per query when a stream runs past an author's buffer
+STREAM_CHUNK = 100
+
+# how long a worker keeps the set of hot authors
+HOT_AUTHORS_TTL = 60
+
+# log the read metrics every this many home pages
+METRICS_LOG_EVERY = 1000
+
+# authors whose high-water marks are filled per query by `fill_high_water_marks`
+MARKS_BATCH = 1000
+
+metrics = {
+    'fanout_messages': 0,
+    'fanout_rows': 0,
+    'fanout_skipped_hot': 0,
+    'fanout_seconds': 0.0,
+    'reads': 0,
+    'read_timeline_rows': 0,
+    'read_hot_authors': 0,
+    'read_seconds': 0.0,
+}
+
+hot = TTLCache(size=1, ttl=HOT_AUTHORS_TTL)
+
+TIMELINE = Statement(
+    db.select([TimelineEntry.message_id, TimelineEntry.author_id])
+    .where(TimelineEntry.user_id == db.bindparam('user_id'))
+    .order_by(TimelineEntry.message_id.desc())
+    .limit(db.bindparam('limit')),
+    'timeline')
+
+
+def load_hot_authors(_=None):
+    """Ids of the hot authors."""
+
+    return frozenset(user_id for (user_id,) in db.session.query(HotAuthor.user_id))
+
+
+def hot_authors():
+    """Ids of the hot authors, as this worker last loaded them."""
+
+    return hot.get('hot', load_hot_authors)
+
+
+def recent_messages(author_id):
+    """An author's newest messages, newest first, from this worker's cache."""
+
+    return recent.get(author_id)
+
+
+def bound(message_id, author_id):
+    """A stream bound (see `merge_streams`) at an author's newest message."""
+
+    return RecentMessage(message_id, None, None, author_id)
+
+
+def merge_streams(streams, limit, watermark=None):
+    """The newest `limit` messages of several newest-first streams.
+
+    A k-way merge on message ids, which are time-ordered: only the head of
+    each stream is in the heap, so the work done is about `limit` rows plus
+    one per stream, however long the streams are. Streams are read lazily
+    and stop being read at `watermark`, an id older than any message wanted.
+
+    A stream may start with a `bound` instead of a message: a row with no
+    text whose id is at least that of the stream's first message. The
+    stream is only read past it if its messages could make the cut.
+    Messages are de-duplicated by id.
+    """
+
+    heap = []
+
+    def push(index, stream):
+        row = next(stream, None)
+
+        if row is not None and (watermark is None or row.id >= watermark):
+            heapq.heappush(heap, (-row.id, index, row, stream))
+
+    for index, stream in enumerate(streams):
+        push(index, iter(stream))
+
+    rows = []
+    seen = set()
+
+    while heap:
+        _, index, row, stream = heapq.heappop(heap)
+
+        if row.text is not None and row.id not in seen:
+            seen.add(row.id)
+            rows.append(row)
+
+            if len(rows) == limit:
+                break
+
+        push(index, stream)
+
+    return rows
+
+
+def author_stream(author_id, latest=None, chunk=STREAM_CHUNK, fresh=False):
+    """An author's messages, newest first, read as far as they're wanted.
+
+    Starts with the author's buffer of recent messages, then pages through
+    the messages index of their shard; with `fresh`, every page is read
+    from the shard. With `latest`, the id of their newest message, it starts
+    with a `bound` and reads nothing until then.
+    """
+
+    if latest is not None:
+        yield bound(latest, author_id)
+
+    if fresh:
+        rows = router.author_messages(author_id, limit=chunk)
+        full = chunk
+    else:
+        rows = recent.get(author_id)
+        # a full buffer may not hold all of the author's messages
+        full = recent.size
+
+    yield from rows
+
+    while rows and len(rows) == full:
+        last = rows[-1]
+        rows = router.author_messages(author_id, before_id=last.id, limit=chunk)
+        full = chunk
+
+        yield from rows
+
+
+def latest_messages(author_ids):
+    """(author id, id of newest message) of authors who have posted.
+
+    One index lookup per author, with the shards queried at once.
+    """
+
+    return router.latest_message_ids(list(author_ids))
+
+
+def timeline_rows(user_id, limit):
+    """The newest entries of a timeline, as `RecentMessage`s.
+
+    The messages are read from their authors' shards; entries of deleted
+    messages are skipped.
+    """
+
+    entries = TIMELINE.execute(db.session, user_id=user_id, limit=limit).fetchall()
+
+    messages = router.fetch_messages(entries)
+
+    return [messages[message_id] for message_id, _ in entries if message_id in messages]
+
+
+def copy_to_timeline(user_id, rows):
+    """Add (id, text, timestamp, user id) rows to a user's timeline."""
+
+    if rows:
+        db.session.execute(insert_ignoring_duplicates(TimelineEntry.__table__), [
+            dict(user_id=user_id, message_id=message_id, author_id=author_id)
+            for message_id, _, _, author_id in rows
+        ])
+
+
+def ensure_timeline(user):
+    """Fill `user`'s timeline, the first time it's needed.
+
+    Copies the newest messages of the (not hot) accounts they follow,
+    merged from each author's stream; authors who haven't posted since the
+    timeline filled up aren't read.
+    """
+
+    if user.timeline_built_at:
+        return
+
+    following = set(user.following_ids()) - hot_authors()
+
+    streams = [author_stream(author_id, latest)
+               for author_id, latest in latest_messages(following)] if following else []
+
+    # a request filling it at the same time copies the same rows, which
+    # are skipped
+    copy_to_timeline(user.id, merge_streams(streams, TIMELINE_SIZE))
+    user.timeline_built_at = datetime.utcnow()
+    db.session.commit()
+
+
+def home_feed(user, limit=FEED_SIZE):
+    """`MessageCard`s of the newest messages on `user`'s home page."""
+
+    start = time.perf_counter()
+    ensure_timeline(user)
+
+    merged_authors = hot_authors() & set(user.following_ids())
+    timeline = timeline_rows(user.id, limit)
+
+    # a full page of the timeline sets how old a merged message can be
+    watermark = timeline[-1].id if len(timeline) == limit else None
+
+    # the user's own messages are read from their shard, not this worker's
+    # buffer, so they see their posts and deletes whichever worker serves them
+    streams = [timeline, author_stream(user.id, fresh=True),
+               *(author_stream(author_id) for author_id in merged_authors)]
+    cards = []
+
+    for message_id, text, timestamp, author_id in merge_streams(streams, limit, watermark):
+        author = authors.get(author_id, load_author)
+
+        if author:
+            cards.append(MessageCard(message_id, text, timestamp, author_id, *author))
+
+    metrics['reads'] += 1
+    metrics['read_timeline_rows'] += len(timeline)
+    metrics['read_hot_authors'] += len(merged_authors)
+    metrics['read_seconds'] += time.perf_counter() - start
+
+    if metrics['reads'] % METRICS_LOG_EVERY == 0:
+        log_metrics()
+
+    return cards
+
+
+def log_metrics():
+    """Log the work done on both paths by this worker so far."""
+
+    reads = max(metrics['reads'], 1)
+    messages = max(metrics['fanout_messages'], 1)
+
+    logger.info(
+        f"feed reads: {metrics['reads']}, "
+        f"{metrics['read_seconds'] / reads * 1000:.1f} ms, "
+        f"{metrics['read_timeline_rows'] / reads:.0f} timeline rows and "
+        f"{metrics['read_hot_authors'] / reads:.1f} hot authors per read; "
+        f"fan-outs: {metrics['fanout_messages']} "
+        f"({metrics['fanout_skipped_hot']} hot), "
+        f"{metrics['fanout_seconds'] / messages * 1000:.1f} ms, "
+        f"{metrics['fanout_rows'] / messages:.0f} rows per message")
+
+
+def follow_added(user, author_id):
+    """Bring a newly followed author's recent messages into `user`'s timeline."""
+
+    if user.timeline_built_at and author_id not in hot_authors():
+        copy_to_timeline(user.id, recent_messages(author_id))
+
+
+def follow_removed(user, author_id):
+    """Take an unfollowed author's messages out of `user`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user.id, TimelineEntry.author_id == author_id)
+     .delete(synchronize_session=False))
+
+
+def message_posted(message):
+    """Show a new message in its author's feeds right away in this worker."""
+
+    recent.add(message)
+
+
+def message_deleted(message):
+    """Take a deleted message out of feeds merged in this worker."""
+
+    recent.remove(message.user_id, message.id)
+
+
+def raise_high_water_mark(author_id, message_id):
+    """Move an author's high-water mark up to `message_id`; a newer mark is
+    kept."""
+
+    marks = HighWaterMark.__table__
+
+    raised = db.session.execute(
+        marks.update()
+        .where(db.and_(marks.c.user_id == author_id, marks.c.message_id < message_id))
+        .values(message_id=message_id))
+
+    if not raised.rowcount:
+        db.session.execute(insert_ignoring_duplicates(marks),
+                           [dict(user_id=author_id, message_id=message_id)])
+
+
+def mark_posted(message):
+    """Record a new message as its author's newest, in the posting
+    transaction."""
+
+    raise_high_water_mark(message.user_id, message.id)
+
+
+def new_marks(user_id, after):
+    """(author id, id of newest message) of the accounts `user_id` follows
+    that have posted since message id `after`.
+
+    One query on the follows index and the high-water marks' primary key;
+    nothing is read for authors with nothing new.
+    """
+
+    marks = HighWaterMark.__table__
+
+    return db.session.execute(
+        db.select([marks.c.user_id, marks.c.message_id])
+        .select_from(marks.join(Follows.__table__,
+                                Follows.user_being_followed_id == marks.c.user_id))
+        .where(db.and_(Follows.user_following_id == user_id,
+                       marks.c.message_id > after))).fetchall()
+
+
+def new_since(marks, after, limit=FEED_SIZE):
+    """Ids of the newest `limit` messages after `after` of the authors of
+    `marks` (see `new_marks`), newest first.
+
+    Read from the authors' shards, not this worker's buffers of recent
+    messages, which may not have a message the marks already count yet.
+    """
+
+    if not marks:
+        return []
+
+    return router.message_ids_after([author_id for author_id, _ in marks], after, limit)
+
+
+def fan_out_insert(author_id, message_id):
+    """INSERT of a message of an author (`message_id` an SQL expression)
+    into the built timelines of the author's followers."""
+
+    followers = (db.select([message_id,
+                            db.literal(author_id),
+                            Follows.user_following_id])
+                 .select_from(Follows.__table__.join(
+                     User.__table__, User.id == Follows.user_following_id))
+                 .where(db.and_(Follows.user_being_followed_id == author_id,
+                                User.timeline_built_at.isnot(None))))
+
+    return insert_ignoring_duplicates(TimelineEntry.__table__).from_select(
+        ['message_id', 'author_id', 'user_id'], followers)
+
+
+def fan_out_cooled(author_id, limit=None):
+    """Copy the newest `limit` messages of an author who is no longer hot
+    into their followers' built timelines, as if they'd been fanned out.
+
+    Returns the number of messages copied.
+    """
+
+    rows = router.author_messages(author_id, limit=limit or TIMELINE_SIZE)
+
+    if rows:
+        db.session.execute(
+            fan_out_insert(author_id, db.bindparam('message_id', type_=db.BigInteger)),
+            [dict(message_id=row.id) for row in rows])
+
+    return len(rows)
+
+
+@task
+def fan_out_message(message_id):
+    """Copy a new message into the built timelines of its author's followers.
+
+    Returns the number of timelines it was copied to.
+    """
+
+    start = time.perf_counter()
+    message = router.find_message(message_id)
+
+    if message is None:
+        return 0
+
+    metrics['fanout_messages'] += 1
+
+    if message.user_id in load_hot_authors():
+        metrics['fanout_skipped_hot'] += 1
+        return 0
+
+    result = db.session.execute(fan_out_insert(message.user_id, db.literal(message.id)))
+    db.session.commit()
+
+    metrics['fanout_rows'] += result.rowcount
+    metrics['fanout_seconds'] += time.perf_counter() - start
+
+    logger.info(f"message {message_id} fanned out to {result.rowcount} timelines "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    return result.rowcount
+
+
+@task(every=5 * 60)
+def refresh_hot_authors(threshold=None):
+    """Recompute the set of hot authors. Returns how many there are."""
+
+    threshold = threshold or HOT_FOLLOWERS
+    followers = db.func.count().label('followers')
+
+    counts = (db.session
+              .query(Follows.user_being_followed_id, followers)
+              .group_by(Follows.user_being_followed_id)
+              .having(followers * 2 >= threshold)
+              .all())
+
+    current = load_hot_authors()
+    rows = [dict(user_id=user_id, followers=count)
+            for user_id, count in counts
+            if count >= threshold or user_id in current]
+
+    # their messages are in no timeline: copy them before they stop being
+    # merged, in the same transaction
+    for user_id in current - {row['user_id'] for row in rows}:
+        copied = fan_out_cooled(user_id)
+        logger.info(f"author {user_id} no longer hot: {copied} messages fanned out")
+
+    HotAuthor.query.delete()
+
+    if rows:
+        db.session.execute(HotAuthor.__table__.insert(), rows)
+
+    db.session.commit()
+    hot.clear()
+
+    logger.info(f"{len(rows)} hot authors")
+    return len(rows)
+
+
+@task(every=24 * 60 * 60)
+def trim_timelines(size=None):
+    """Drop timeline entries older than each user's newest `size`."""
+
+    size = size or TIMELINE_SIZE
+    newer = db.aliased(TimelineEntry)
+
+    cutoff = (db.session
+              .query(newer.message_id)
+              .filter(newer.user_id == TimelineEntry.user_id)
+              .order_by(newer.message_id.desc())
+              .limit(1)
+              .offset(size - 1)
+              .correlate(TimelineEntry)
+              .as_scalar())
+
+    count = (TimelineEntry
+             .query
+             .filter(TimelineEntry.message_id < cutoff)
+             .delete(synchronize_session=False))
+    db.session.commit()
+
+    logger.info(f"{count} timeline entries trimmed")
+    return count
+
+
+@task
+def fill_high_water_marks(batch_size=MARKS_BATCH):
+    """Set every author's high-water mark from their messages, for messages
+    posted before marks were kept. Returns the number of authors marked."""
+
+    count = 0
+    last = 0
+
+    while True:
+        user_ids = [user_id for (user_id,) in (db.session
+                    .query(User.id)
+                    .filter(User.id > last)
+                    .order_by(User.id)
+                    .limit(batch_size))]
+
+        if not user_ids:
+            break
+
+        for author_id, message_id in latest_messages(user_ids):
+            raise_high_water_mark(author_id, message_id)
+            count += 1
+
+        db.session.commit()
+        last = user_ids[-1]
+
+    logger.info(f"{count} high-water marks filled")
+    return count
+
+
+def init_feed(app):
+    """Read the feed settings from the app config."""
+
+    global HOT_FOLLOWERS
+
+    HOT_FOLLOWERS = app.config.get('FEED_HOT_FOLLOWERS', HOT_FOLLOWERS)
+
+
+feed_cli = AppGroup('feed', help="Home timelines.")
+
+
+@feed_cli.command('marks')
+def marks_command():
+    """Fill the authors' high-water marks from their messages."""
+
+    click.echo(f"{fill_high_water_marks()} authors marked")
+
+
+@feed_cli.command('stats')
+@click.option('--threshold', type=int, multiple=True,
+              help="Follower threshold to estimate (repeatable).")
+def stats_command(threshold):
+    """Show timeline sizes and what follower thresholds would cost."""
+
+    followers = db.func.count().label('followers')
+    counts = sorted((count for _, count in (db.session
+                     .query(Follows.user_being_followed_id, followers)
+                     .group_by(Follows.user_being_followed_id))), reverse=True)
+
+    click.echo(f"hot authors: {len(load_hot_authors())} (threshold {HOT_FOLLOWERS})")
+    click.echo(f"timeline entries: {TimelineEntry.query.count()}")
+    click.echo(f"built timelines: "
+               f"{User.query.filter(User.timeline_built_at.isnot(None)).count()}")
+
+    total = sum(counts)
+
+    # raising the threshold means more rows written per message by the
+    # biggest fanned-out author; lowering it means more follows merged on
+    # every read
+    for limit in threshold or (100, 1000, HOT_FOLLOWERS, 10 * HOT_FOLLOWERS):
+        hot_counts = [count for count in counts if count >= limit]
+
+        click.echo(f"threshold {limit}: {len(hot_counts)} hot authors, "
+                   f"up to {max(counts[len(hot_counts):], default=0)} rows per message, "
+                   f"{sum(hot_counts) / max(total, 1):.1%} of follows merged on read")
@@ -0,0 +1,468 @@
+"""Compact array-based views of the follows graph.
+
+The ORM relationships on `User` load one object per follow; these load the
+whole `follows` table into a pair of numpy arrays instead, for work that
+walks many users at once (see `recommend`) and for the optional
+`GraphIndex` that answers follow checks and lists in memory.
+
+numpy is imported by the functions that use it, so importing this module
+(as the app does at startup) stays cheap.
+"""
+
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from jobs import task
+from models import db, Follows, FollowChange, User
+
+FETCH_SIZE = 100000
+
+# approximate size of a Python int in an edited list
+INT_SIZE = 36
+
+# seconds between an index's checks for follow changes made elsewhere
+GRAPH_POLL = 2
+
+# changes this recent (seconds) are applied again on every check, in case
+# one committed after a change with a later id
+CHANGES_OVERLAP = 10
+
+# seconds follow changes are kept, for indexes and snapshots made before them
+CHANGES_KEEP = 7 * 24 * 60 * 60
+
+
+class CSR:
+    """Adjacency lists in compressed sparse row form.
+
+    Nodes are user ids. The neighbors of `node` are
+    `targets[offsets[node]:offsets[node + 1]]`, sorted ascending.
+    """
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_edges(cls, sources, targets, size=None):
+        """Build from parallel arrays of edge sources and targets."""
+
+        import numpy as np
+
+        order = np.lexsort((targets, sources))
+        sources = sources[order]
+        targets = targets[order]
+
+        if size is None:
+            size = int(max(sources.max(), targets.max())) + 1 if len(sources) else 0
+
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=offsets[1:])
+
+        return cls(offsets, targets.astype(np.int32))
+
+    @property
+    def size(self):
+        """Number of node slots (the largest user id + 1)."""
+
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays, in bytes."""
+
+        return self.offsets.nbytes + self.targets.nbytes
+
+    def neighbors(self, node):
+        """Sorted array of the neighbors of `node`."""
+
+        if node >= self.size:
+            return self.targets[:0]
+
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def degree(self, node):
+        """Number of neighbors of `node`."""
+
+        if node >= self.size:
+            return 0
+
+        return int(self.offsets[node + 1] - self.offsets[node])
+
+
+def read_follows():
+    """Stream the follows table into (follower ids, followed ids) arrays."""
+
+    import numpy as np
+
+    table = Follows.__table__
+    query = db.select([table.c.user_following_id, table.c.user_being_followed_id])
+
+    result = (db.session
+              .connection()
+              .execution_options(stream_results=True)
+              .execute(query))
+
+    chunks = []
+
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+
+        if not rows:
+            break
+
+        chunks.append(np.array([tuple(row) for row in rows], dtype=np.int32))
+
+    if not chunks:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    edges = np.concatenate(chunks)
+    return edges[:, 0], edges[:, 1]
+
+
+def load_following():
+    """CSR of the users each user is following."""
+
+    followers, followed = read_follows()
+    return CSR.from_edges(followers, followed)
+
+
+class GraphIndex:
+    """Process-local index of the follows graph, in both directions.
+
+    Answers membership, counts and pages of neighbors from sorted arrays
+    without touching the database. The base arrays are read-only (they may
+    be memory-mapped from a snapshot); follows and unfollows made in this
+    process are applied to per-user copies of the affected lists.
+
+    Writes made by other processes are logged in `follow_changes` (see
+    `log_follow`); an index built from the database or a snapshot applies
+    them every `poll` seconds (see `catch_up`), so its lists are at most
+    that stale.
+    """
+
+    def __init__(self, following, followers, change_id=None, poll=GRAPH_POLL,
+                 clock=time.monotonic):
+        self.following_csr = following
+        self.followers_csr = followers
+        self.following_edits = {}
+        self.followers_edits = {}
+
+        # id of the last follow change applied; None: don't look for any
+        self.change_id = change_id
+        self.poll = poll
+        self.clock = clock
+        self.next_check = clock() + poll
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, **kwargs):
+        """Build the index from the follows table."""
+
+        # changes logged while the table is read are applied again later
+        change_id = latest_change_id()
+
+        followers, followed = read_follows()
+        size = int(max(followers.max(), followed.max())) + 1 if len(followers) else 0
+
+        return cls(CSR.from_edges(followers, followed, size),
+                   CSR.from_edges(followed, followers, size),
+                   change_id=change_id, **kwargs)
+
+    @classmethod
+    def load(cls, path, mmap=True, **kwargs):
+        """Load a snapshot written by `save`, memory-mapped by default."""
+
+        import numpy as np
+
+        mode = 'r' if mmap else None
+
+        def csr(name):
+            return CSR(np.load(os.path.join(path, f"{name}_offsets.npy"), mmap_mode=mode),
+                       np.load(os.path.join(path, f"{name}_targets.npy"), mmap_mode=mode))
+
+        try:
+            with open(os.path.join(path, 'change_id')) as f:
+                change_id = int(f.read())
+        except FileNotFoundError:
+            # from before changes were logged: caught up (or rebuilt) from the start
+            change_id = 0
+
+        return cls(csr('following'), csr('followers'), change_id=change_id, **kwargs)
+
+    def save(self, path):
+        """Write the base arrays to `path` as a snapshot.
+
+        Edits made since the index was built are not included; the id of
+        the last change it was built with is, for `catch_up`.
+        """
+
+        import numpy as np
+
+        os.makedirs(path, exist_ok=True)
+
+        for name, csr in [('following', self.following_csr),
+                          ('followers', self.followers_csr)]:
+            np.save(os.path.join(path, f"{name}_offsets.npy"), csr.offsets)
+            np.save(os.path.join(path, f"{name}_targets.npy"), csr.targets)
+
+        with open(os.path.join(path, 'change_id'), 'w') as f:
+            f.write(str(self.change_id or 0))
+
+    def refresh(self):
+        """`catch_up` if it's been `poll` seconds since the last check."""
+
+        if self.change_id is None or self.clock() < self.next_check:
+            return
+
+        # another thread is at it
+        if not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            self.next_check = self.clock() + self.poll
+            self.catch_up()
+        finally:
+            self.lock.release()
+
+    def catch_up(self):
+        """Apply the follow changes logged since the last one applied.
+
+        Changes of the last `CHANGES_OVERLAP` seconds are applied again, in
+        id order; applying one twice changes nothing. If changes this index
+        hasn't seen were pruned already, it's rebuilt from the follows
+        table instead.
+        """
+
+        first = db.session.query(db.func.min(FollowChange.id)).scalar()
+
+        if first is not None and first > self.change_id + 1:
+            self.rebuild()
+            return
+
+        recent = datetime.utcnow() - timedelta(seconds=CHANGES_OVERLAP)
+
+        changes = (FollowChange
+                   .query
+                   .filter(db.or_(FollowChange.id > self.change_id,
+                                  FollowChange.created_at > recent))
+                   .order_by(FollowChange.id)
+                   .all())
+
+        for change in changes:
+            if change.other_id is None:
+                self.remove_user(change.user_id)
+            elif change.following:
+                self.follow(change.user_id, change.other_id)
+            else:
+                self.unfollow(change.user_id, change.other_id)
+
+            self.change_id = max(self.change_id, change.id)
+
+    def rebuild(self):
+        """Replace the arrays (and edits) with ones read from the database."""
+
+        fresh = GraphIndex.from_db()
+
+        self.following_csr = fresh.following_csr
+        self.followers_csr = fresh.followers_csr
+        self.following_edits = {}
+        self.followers_edits = {}
+        self.change_id = fresh.change_id
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` is following."""
+
+        self.refresh()
+
+        if user_id in self.following_edits:
+            return self.following_edits[user_id]
+
+        return self.following_csr.neighbors(user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        self.refresh()
+
+        if user_id in self.followers_edits:
+            return self.followers_edits[user_id]
+
+        return self.followers_csr.neighbors(user_id)
+
+    def is_following(self, user_id, other_id):
+        """Is `user_id` following `other_id`?"""
+
+        following = self.following(user_id)
+        i = bisect_left(following, other_id)
+
+        return i < len(following) and following[i] == other_id
+
+    def following_count(self, user_id):
+        """Number of users `user_id` is following."""
+
+        return len(self.following(user_id))
+
+    def followers_count(self, user_id):
+        """Number of users following `user_id`."""
+
+        return len(self.followers(user_id))
+
+    @staticmethod
+    def page(ids, after=None, limit=30):
+        """One page of the sorted `ids`, starting after the id `after`.
+
+        Returns (ids, next_after); next_after is None on the last page.
+        """
+
+        start = bisect_right(ids, after) if after else 0
+        page = [int(user_id) for user_id in ids[start:start + limit]]
+
+        if start + limit < len(ids):
+            return page, page[-1]
+
+        return page, None
+
+    def follow(self, user_id, other_id):
+        """Record that `user_id` started following `other_id`."""
+
+        if self.is_following(user_id, other_id):
+            return
+
+        insort(self._edit(self.following_edits, self.following_csr, user_id), other_id)
+        insort(self._edit(self.followers_edits, self.followers_csr, other_id), user_id)
+
+    def unfollow(self, user_id, other_id):
+        """Record that `user_id` stopped following `other_id`."""
+
+        if not self.is_following(user_id, other_id):
+            return
+
+        self._edit(self.following_edits, self.following_csr, user_id).remove(other_id)
+        self._edit(self.followers_edits, self.followers_csr, other_id).remove(user_id)
+
+    def remove_user(self, user_id):
+        """Record that a purged user's follows are gone, both ways."""
+
+        for other_id in list(self.following(user_id)):
+            self.unfollow(user_id, int(other_id))
+
+        for other_id in list(self.followers(user_id)):
+            self.unfollow(int(other_id), user_id)
+
+    @staticmethod
+    def _edit(edits, csr, user_id):
+        """Writable copy of one user's list, made on first write."""
+
+        if user_id not in edits:
+            edits[user_id] = [int(other_id) for other_id in csr.neighbors(user_id)]
+
+        return edits[user_id]
+
+    def memory_report(self):
+        """Bytes used by the base arrays and by the edited lists."""
+
+        edits = sum(sys.getsizeof(ids) + INT_SIZE * len(ids)
+                    for edits in (self.following_edits, self.followers_edits)
+                    for ids in edits.values())
+
+        return {
+            'users': self.following_csr.size,
+            'follows': len(self.following_csr.targets),
+            'arrays': self.following_csr.nbytes + self.followers_csr.nbytes,
+            'edits': edits,
+        }
+
+
+def latest_change_id():
+    """Id of the last follow change logged, or 0."""
+
+    return db.session.query(db.func.coalesce(db.func.max(FollowChange.id), 0)).scalar()
+
+
+def log_follow(user_id, other_id, following=True):
+    """Log a follow (or unfollow) for the graph indexes of every process.
+
+    Added to the caller's transaction; nothing is logged unless the app is
+    configured to use an index.
+    """
+
+    if current_app.config.get('GRAPH_INDEX'):
+        db.session.add(FollowChange(user_id=user_id, other_id=other_id, following=following))
+
+
+def log_purge(user_id):
+    """Log that a purged user's follows were removed (see `log_follow`)."""
+
+    if current_app.config.get('GRAPH_INDEX'):
+        db.session.add(FollowChange(user_id=user_id, other_id=None, following=False))
+
+
+@task(every=60 * 60)
+def prune_follow_changes(keep=CHANGES_KEEP):
+    """Delete follow changes older than `keep` seconds, except the last one
+    (so `catch_up` can tell what was pruned). Returns how many were."""
+
+    cutoff = datetime.utcnow() - timedelta(seconds=keep)
+
+    count = (FollowChange
+             .query
+             .filter(FollowChange.created_at < cutoff,
+                     FollowChange.id < latest_change_id())
+             .delete(synchronize_session=False))
+    db.session.commit()
+
+    return count
+
+
+def init_graph_index(app):
+    """Load the graph index if the app is configured to use one.
+
+    `GRAPH_INDEX` is 'db' to build it from the follows table, or the path
+    of a snapshot written by `flask graph snapshot`.
+    """
+
+    source = app.config.get('GRAPH_INDEX')
+
+    if not source:
+        return None
+
+    with app.app_context():
+        index = GraphIndex.from_db() if source == 'db' else GraphIndex.load(source)
+
+    User.graph_index = index
+    app.logger.info(f"graph index loaded: {index.memory_report()}")
+
+    return index
+
+
+graph_cli = AppGroup('graph', help="Manage the in-memory follows graph index.")
+
+
+@graph_cli.command('snapshot')
+@click.argument('path')
+def snapshot_command(path):
+    """Write a snapshot of the follows table to PATH."""
+
+    index = GraphIndex.from_db()
+    index.save(path)
+
+    click.echo(f"snapshot written: {index.memory_report()}")
+
+
+@graph_cli.command('stats')
+@click.argument('path', required=False)
+def stats_command(path):
+    """Show the size of the index (from PATH, or built from the database)."""
+
+    index = GraphIndex.load(path) if path else GraphIndex.from_db()
+
+    for key, value in index.memory_report().items():
+        click.echo(f"{key}: {value}")
@@ -0,0 +1,366 @@
+"""Resizing proxy for user avatars and header images.
+
+`image_url` and `header_image_url` can point anywhere. Instead of hotlinking
+full-size originals, templates use the `thumbnail` filter, which sends
+remote images through /img/<size>/<signature>?url=...; the proxy fetches
+the original once, checks it really is an image, resizes it to `size` and
+keeps the WebP result in an on-disk cache with LRU eviction.
+
+Proxy URLs are signed with the app's SECRET_KEY, so the route can't be used
+to fetch arbitrary URLs. Hosts are resolved once, when connecting, and the
+address checked is the one connected to, so a host can't pass the check
+with a public address and then be fetched from a private one. Originals that
+fail are remembered for `FAILURE_TTL` seconds and not fetched again
+meanwhile. Pillow is imported on first use, keeping it out of app startup.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlencode, urlsplit
+from urllib.request import (HTTPHandler, HTTPSHandler, HTTPRedirectHandler,
+                            ProxyHandler, build_opener)
+
+from flask import current_app, request, redirect, abort, send_file
+
+from assets import image_variant
+from cache import TTLCache
+
+# size name -> (width, height, crop to fill)
+SIZES = {
+    'avatar': (96, 96, True),
+    'profile': (200, 200, True),
+    'header': (640, 320, False),
+    'hero': (1280, 640, False),
+}
+
+# shown when the original can't be fetched
+FALLBACKS = {
+    'avatar': '/static/images/default-pic.png',
+    'profile': '/static/images/default-pic.png',
+    'header': '/static/images/warbler-hero.jpg',
+    'hero': '/static/images/warbler-hero.jpg',
+}
+
+# local widths that match each size, for images under /static/
+LOCAL_WIDTHS = {
+    'avatar': 96,
+    'profile': 200,
+    'header': 640,
+    'hero': 1280,
+}
+
+FETCH_TIMEOUT = 5
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40 * 1000 * 1000
+
+# seconds a failed original is answered with the fallback without fetching
+FAILURE_TTL = 60
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var', 'images')
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class ImageFetchError(Exception):
+    """The original image couldn't be fetched or isn't a usable image."""
+
+
+def sign(size, url):
+    """Signature of a proxy URL."""
+
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    message = f"{size}:{url}".encode('utf-8')
+
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:24]
+
+
+def thumbnail(url, size):
+    """URL of the image `url` resized to `size` (a key of `SIZES`).
+
+    Our own images come from the static build; others go through the proxy.
+    """
+
+    if not url:
+        return FALLBACKS[size]
+
+    if url.startswith('//'):
+        url = 'https:' + url
+    elif url.startswith('/'):
+        return image_variant(url, LOCAL_WIDTHS[size])
+
+    return f"/img/{size}/{sign(size, url)}?{urlencode({'url': url})}"
+
+
+def check_url(url):
+    """Refuse URLs that aren't http(s)."""
+
+    parts = urlsplit(url)
+
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageFetchError(f"unsupported URL: {url}")
+
+
+def public_address(host, port):
+    """The address to connect to for `host`, refusing private addresses.
+
+    Called when connecting (see `PinnedConnection`), so the address checked
+    is the one used.
+    """
+
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as error:
+        raise ImageFetchError(str(error))
+
+    if not current_app.config.get('IMAGE_PROXY_ALLOW_PRIVATE'):
+        for address in addresses:
+            ip = ipaddress.ip_address(address[4][0])
+
+            if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved:
+                raise ImageFetchError(f"refusing private address: {host}")
+
+    return addresses[0][4][0]
+
+
+def pinned_connection(address, *args):
+    """`socket.create_connection` to the checked address of the host."""
+
+    host, port = address
+
+    return socket.create_connection((public_address(host, port), port), *args)
+
+
+class PinnedConnection(HTTPConnection):
+    """HTTP connection to the address `public_address` checked."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = pinned_connection
+
+
+class PinnedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection to the address `public_address` checked.
+
+    Certificates are still verified against the host name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = pinned_connection
+
+
+class PinnedHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PinnedConnection, req)
+
+
+class PinnedHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PinnedHTTPSConnection, req, context=self._context)
+
+
+class CheckedRedirectHandler(HTTPRedirectHandler):
+    """Follow redirects only to http(s) URLs."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url):
+    """Download `url` (at most MAX_SOURCE_BYTES) and open it as an image."""
+
+    from PIL import Image
+
+    check_url(url)
+
+    # no proxies from the environment: they'd connect to hosts unchecked
+    opener = build_opener(ProxyHandler({}), PinnedHTTPHandler, PinnedHTTPSHandler,
+                          CheckedRedirectHandler)
+
+    try:
+        with opener.open(url, timeout=FETCH_TIMEOUT) as response:
+            content_type = response.headers.get('Content-Type', '')
+
+            if not content_type.startswith('image/'):
+                raise ImageFetchError(f"not an image: {content_type}")
+
+            data = response.read(MAX_SOURCE_BYTES + 1)
+
+    except OSError as error:
+        raise ImageFetchError(str(error))
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ImageFetchError("image too large")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+
+        if image.width * image.height > MAX_SOURCE_PIXELS:
+            raise ImageFetchError("image too large")
+
+        image.load()
+
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ImageFetchError(str(error))
+
+    return image
+
+
+def resize(image, size):
+    """Resize `image` to `size`; returns WebP bytes."""
+
+    from PIL import Image, ImageOps
+
+    width, height, crop = SIZES[size]
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image.thumbnail((width, height), Image.LANCZOS)
+
+    data = io.BytesIO()
+    image.save(data, 'webp', quality=80)
+
+    return data.getvalue()
+
+
+class ImageCache:
+    """On-disk cache of resized images, evicting least recently used.
+
+    Files are named by the hash of their key. A hit touches the file, so
+    modification times order the files by last use.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+
+    def file_path(self, key):
+        """Where the file for `key` is stored."""
+
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.webp')
+
+    def get(self, key):
+        """Path of the cached file for `key`, or None."""
+
+        path = self.file_path(key)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, data):
+        """Store `data` for `key`; returns its path."""
+
+        path = self.file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename, so readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+
+        os.replace(temp_path, path)
+
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self.files())
+        else:
+            self.total_bytes += len(data)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+        return path
+
+    def files(self):
+        """(path, size, mtime) of every cached file."""
+
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Remove least recently used files until under 90% of max_bytes."""
+
+        files = sorted(self.files(), key=lambda file: file[2])
+        self.total_bytes = sum(size for _, size, _ in files)
+
+        for path, size, _ in files:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.total_bytes -= size
+
+
+cache = ImageCache()
+
+# url -> why it couldn't be fetched, for `FAILURE_TTL` seconds
+failures = TTLCache(ttl=FAILURE_TTL)
+
+
+def image_proxy(size, signature):
+    """Serve the image at ?url= resized to `size`."""
+
+    url = request.args.get('url', '')
+
+    if size not in SIZES or not hmac.compare_digest(signature, sign(size, url)):
+        abort(404)
+
+    key = f"{size}:{url}"
+    path = cache.get(key)
+
+    if not path:
+        if failures.get(url, lambda url: None):
+            return redirect(thumbnail(FALLBACKS[size], size))
+
+        try:
+            path = cache.put(key, resize(fetch(url), size))
+        except ImageFetchError as error:
+            current_app.logger.info(f"image proxy: {error}")
+            failures.put(url, str(error) or "fetch failed")
+            return redirect(thumbnail(FALLBACKS[size], size))
+
+    response = send_file(path, mimetype='image/webp', add_etags=False)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    # file times change with every hit (see ImageCache), so tag by name
+    response.set_etag(os.path.splitext(os.path.basename(path))[0])
+    response.make_conditional(request)
+
+    return response
+
+
+def init_image_proxy(app):
+    """Register the proxy route and the `thumbnail` template filter."""
+
+    cache.path = app.config.get('IMAGE_CACHE_DIR', cache.path)
+    cache.max_bytes = app.config.get('IMAGE_CACHE_MAX_BYTES', cache.max_bytes)
+
+    app.add_template_filter(thumbnail)
+    app.add_url_rule('/img/<size>/<signature>', 'image_proxy', image_proxy)
@@ -0,0 +1,322 @@
+"""Background jobs for Warbler.
+
+Slow work is queued in the `jobs` table and run by worker processes, so
+there is no external broker to run. Views queue work with `enqueue()` in
+the same transaction as the write that needs it:
+
+    enqueue(purge_user, user_id=user.id)
+    db.session.commit()
+
+and workers are started with:
+
+    (venv) $ flask jobs work --processes 2
+"""
+
+import json
+import logging
+import os
+import time
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing import Process
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+# name -> task function
+TASKS = {}
+
+# name -> seconds between runs, for tasks that repeat
+PERIODIC = {}
+
+POLL_INTERVAL = 1.0
+RETRY_DELAY = 10
+JOB_TIMEOUT = 15 * 60
+
+# seconds between a worker's checks for stale jobs and unscheduled tasks
+MAINTENANCE_INTERVAL = 60
+
+
+class RetryLater(Exception):
+    """Raised by a task that can't run yet: its job is queued again in
+    `delay` seconds, and the attempt isn't counted."""
+
+    def __init__(self, delay, reason=None):
+        super().__init__(reason or f"retry in {delay} seconds")
+        self.delay = delay
+
+
+def task(func=None, *, max_attempts=3, every=None):
+    """Register `func` as a job that can be queued by name.
+
+    `every` (seconds) makes the worker queue the task again after every
+    run, whether it succeeded or ran out of attempts, so it repeats for as
+    long as a worker is up.
+    """
+
+    def register(func):
+        func.max_attempts = max_attempts
+        TASKS[func.__name__] = func
+
+        if every:
+            PERIODIC[func.__name__] = every
+
+        return func
+
+    if func:
+        return register(func)
+
+    return register
+
+
+def enqueue(func, delay=0, run_at=None, **kwargs):
+    """Queue the task `func` (a task or its name) to run with `kwargs`.
+
+    The job is added to the current session; it is queued when the caller
+    commits. `delay` (seconds) or `run_at` schedule it for later.
+    """
+
+    name = func if isinstance(func, str) else func.__name__
+
+    job = Job(
+        name=name,
+        args=json.dumps(kwargs),
+        max_attempts=TASKS[name].max_attempts,
+        run_at=run_at or datetime.utcnow() + timedelta(seconds=delay),
+    )
+
+    db.session.add(job)
+    return job
+
+
+def claim():
+    """Take the next due job and mark it running, or return None.
+
+    Rows are locked with SKIP LOCKED so several workers can poll the
+    table without handing out the same job twice.
+    """
+
+    job = (Job
+           .query
+           .filter(Job.status == 'queued', Job.run_at <= datetime.utcnow())
+           .order_by(Job.run_at)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job:
+        job.status = 'running'
+        job.locked_at = datetime.utcnow()
+        job.attempts += 1
+
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """Run a claimed job and record the outcome.
+
+    Failed jobs are retried with exponential backoff until they run out of
+    attempts; jobs raising `RetryLater` are put off without using one up.
+    Returns True if the job succeeded.
+    """
+
+    try:
+        TASKS[job.name](**json.loads(job.args))
+
+    except RetryLater as retry:
+        db.session.rollback()
+
+        job.last_error = str(retry)
+        job.locked_at = None
+        job.status = 'queued'
+        job.attempts -= 1
+        job.run_at = datetime.utcnow() + timedelta(seconds=retry.delay)
+
+        db.session.commit()
+        logger.info(f"{job} put off: {retry}")
+        return False
+
+    except Exception:
+        db.session.rollback()
+
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'failed'
+
+            if job.name in PERIODIC:
+                enqueue(job.name, delay=PERIODIC[job.name], **json.loads(job.args))
+
+        db.session.commit()
+        logger.exception(f"{job} failed")
+        return False
+
+    job.status = 'done'
+    job.locked_at = None
+
+    if job.name in PERIODIC:
+        enqueue(job.name, delay=PERIODIC[job.name], **json.loads(job.args))
+
+    db.session.commit()
+    return True
+
+
+def requeue_stale(timeout=JOB_TIMEOUT):
+    """Put back jobs left running by a worker that died.
+
+    Jobs out of attempts are marked failed instead, so a job that kills
+    its worker isn't run forever. Returns the number of jobs queued again.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    stale = Job.query.filter(Job.status == 'running', Job.locked_at < cutoff)
+
+    (stale
+     .filter(Job.attempts >= Job.max_attempts)
+     .update({'status': 'failed', 'locked_at': None,
+              'last_error': "worker died while running the job"},
+             synchronize_session=False))
+
+    count = (stale
+             .filter(Job.attempts < Job.max_attempts)
+             .update({'status': 'queued', 'locked_at': None},
+                     synchronize_session=False))
+    db.session.commit()
+
+    return count
+
+
+def schedule_periodic():
+    """Queue every periodic task that is not already queued or running.
+
+    Workers call this at the same time, so a task may get queued twice:
+    extra queued runs are deleted, keeping a running one or the first
+    queued.
+    """
+
+    for name in PERIODIC:
+        pending = (Job
+                   .query
+                   .filter(Job.name == name,
+                           Job.status.in_(['queued', 'running']))
+                   .order_by(Job.status.desc(), Job.run_at, Job.id)
+                   .all())
+
+        if not pending:
+            enqueue(name)
+            continue
+
+        extra = [job.id for job in pending[1:] if job.status == 'queued']
+
+        if extra:
+            (Job
+             .query
+             .filter(Job.id.in_(extra), Job.status == 'queued')
+             .delete(synchronize_session=False))
+
+    db.session.commit()
+
+
+def maintain():
+    """Put back jobs of dead workers and queue periodic tasks."""
+
+    requeue_stale()
+    schedule_periodic()
+
+
+def run_pending(limit=None):
+    """Run due jobs until there are none left (or `limit` have run).
+
+    Returns the number of jobs run.
+    """
+
+    count = 0
+
+    while limit is None or count < limit:
+        job = claim()
+
+        if not job:
+            break
+
+        run_job(job)
+        count += 1
+
+    return count
+
+
+def work(poll_interval=POLL_INTERVAL, maintenance_interval=MAINTENANCE_INTERVAL):
+    """Run jobs forever, sleeping while the queue is empty, and `maintain`
+    the queue every `maintenance_interval` seconds."""
+
+    logger.info(f"worker {os.getpid()} started")
+
+    next_maintenance = 0
+
+    while True:
+        if time.monotonic() >= next_maintenance:
+            maintain()
+            next_maintenance = time.monotonic() + maintenance_interval
+
+        if not run_pending():
+            time.sleep(poll_interval)
+
+
+def _worker_process(app, poll_interval):
+    """Entry point of a forked worker process."""
+
+    with app.app_context():
+        # connections can't be shared with the parent process
+        db.engine.dispose()
+        work(poll_interval)
+
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--processes', default=1, help="Number of worker processes.")
+@click.option('--poll-interval', default=POLL_INTERVAL,
+              help="Seconds to sleep when the queue is empty.")
+def work_command(processes, poll_interval):
+    """Start worker processes."""
+
+    app = current_app._get_current_object()
+
+    workers = [Process(target=_worker_process, args=(app, poll_interval))
+               for _ in range(processes)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+
+@jobs_cli.command('run')
+def run_command():
+    """Run every due job once, then exit."""
+
+    click.echo(f"{run_pending()} jobs run")
+
+
+@jobs_cli.command('status')
+def status_command():
+    """Show job counts by status."""
+
+    counts = (db.session
+              .query(Job.status, db.func.count(Job.id))
+              .group_by(Job.status)
+              .all())
+
+    for status, count in counts:
+        click.echo(f"{status}: {count}")
@@ -1,18 +1,36 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext import baked
+
+from snowflake import next_id, timestamp_of
+from statements import Statement
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# baked ORM queries, built and compiled once (see statements)
+bakery = baked.bakery()
+
+FOLLOWS_PAGE_SIZE = 30
+
+# a row of a followers/following page
+UserCard = namedtuple('UserCard', 'id username image_url header_image_url bio viewer_follows')
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key covers followers lookups; this covers following
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -27,10 +45,51 @@ class Follows(db.Model):
     )
 
 
+class FollowChange(db.Model):
+    """A follow or unfollow, or a purged user's follows removed, logged for
+    the graph indexes of other processes (see `graph.GraphIndex.catch_up`)."""
+
+    __tablename__ = 'follow_changes'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # the follower, or the purged user
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # the followed user; None when `user_id` was purged
+    other_id = db.Column(
+        db.Integer,
+    )
+
+    following = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        # one like per user and message; also the index of a user's likes
+        db.Index('ux_likes_user_message', 'user_id', 'message_id', unique=True),
+        # for counting a message's likes
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -43,12 +102,47 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
 
+def viewer_follows(viewer_id):
+    """Column: does `viewer_id` follow the user in the row?
+
+    A correlated EXISTS, answered by one follows index lookup per row.
+    """
+
+    follows = Follows.__table__.alias()
+
+    return (db.exists()
+            .where(db.and_(follows.c.user_following_id == viewer_id,
+                           follows.c.user_being_followed_id == User.__table__.c.id))
+            .label('viewer_follows'))
+
+
+def read_rows(query, row_type, yield_per=None):
+    """Run a Core `query` and return its rows as `row_type` tuples.
+
+    List pages only render a few columns, so they're read with Core into
+    plain tuples rather than loaded as ORM entities, which carry every
+    column plus the session's bookkeeping. With `yield_per`, a generator
+    fetching that many rows at a time (with a server-side cursor where the
+    driver has one), for streamed pages.
+    """
+
+    if not yield_per:
+        return [row_type(*row) for row in db.session.execute(query)]
+
+    def rows():
+        result = db.session.execute(query.execution_options(stream_results=True))
+
+        for chunk in iter(lambda: result.fetchmany(yield_per), []):
+            yield from (row_type(*row) for row in chunk)
+
+    return rows()
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -94,7 +188,16 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # when this user's timeline was first filled (see feed.ensure_timeline)
+    timeline_built_at = db.Column(
+        db.DateTime,
+    )
+
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -116,20 +219,215 @@ class User(db.Model):
         backref="likes_users"
     )
 
+    # process-local graph.GraphIndex, set by graph.init_graph_index() when
+    # the app is configured to use one
+    graph_index = None
+
+    # shards.ShardRouter, set by shards.init_shards() when messages and
+    # likes are spread over several databases
+    shard_router = None
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
+        if self.graph_index:
+            return self.graph_index.is_following(other_user.id, self.id)
+
         found_user_list = [user for user in self.followers if user == other_user]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if self.graph_index:
+            return self.graph_index.is_following(self.id, other_user.id)
+
+        return self.is_following_id(other_user.id)
+
+    def is_following_id(self, user_id):
+        """Is this user following the user with id `user_id`?
+
+        One lookup in the follows primary key, without loading either user.
+        """
+
+        if self.graph_index:
+            return self.graph_index.is_following(self.id, user_id)
+
+        return USER_IS_FOLLOWING.execute(db.session, user_id=self.id, other_id=user_id).scalar()
+
+    def following_ids(self):
+        """Ids of the users this user is following."""
+
+        if self.graph_index:
+            return [int(user_id) for user_id in self.graph_index.following(self.id)]
+
+        return [user_id for (user_id,) in USER_FOLLOWING_IDS.execute(db.session, user_id=self.id)]
+
+    def following_count(self):
+        """Number of users this user is following."""
+
+        if self.graph_index:
+            return self.graph_index.following_count(self.id)
+
+        return USER_FOLLOWING_COUNT.execute(db.session, user_id=self.id).scalar()
+
+    def followers_count(self):
+        """Number of users following this user."""
+
+        if self.graph_index:
+            return self.graph_index.followers_count(self.id)
+
+        return USER_FOLLOWERS_COUNT.execute(db.session, user_id=self.id).scalar()
+
+    def messages_count(self):
+        """Number of messages this user has posted."""
+
+        if self.shard_router:
+            return self.shard_router.count_messages(self.id)
+
+        return USER_MESSAGES_COUNT.execute(db.session, user_id=self.id).scalar()
+
+    def likes_count(self):
+        """Number of messages this user likes."""
+
+        if self.shard_router:
+            return self.shard_router.count_likes(self.id)
+
+        return USER_LIKES_COUNT.execute(db.session, user_id=self.id).scalar()
+
+    def liked_messages(self):
+        """Core query of the messages this user likes, newest first.
+
+        Rows carry the columns a message card shows, with the author's as
+        `user_id`, `username` and `image_url`; their likes are counted a
+        page at a time (see `ShardRouter.liked_messages`).
+        """
+
+        messages = Message.__table__
+        users = User.__table__
+        likes = Likes.__table__
+
+        return (db.select([messages.c.id,
+                           messages.c.text,
+                           messages.c.timestamp,
+                           users.c.id.label('user_id'),
+                           users.c.username,
+                           users.c.image_url])
+                .select_from(messages
+                             .join(likes, likes.c.message_id == messages.c.id)
+                             .join(users, users.c.id == messages.c.user_id))
+                .where(likes.c.user_id == self.id)
+                .order_by(messages.c.id.desc()))
+
+    @classmethod
+    def cards(cls, viewer_id=None):
+        """Core query of `UserCard` rows for users who haven't deleted their
+        account (see `read_rows`).
+
+        Rows carry the columns a user card shows, plus `viewer_follows` (see
+        `viewer_follows`). Ordered by user id.
+        """
+
+        users = cls.__table__
+
+        return (db.select([users.c.id,
+                           users.c.username,
+                           users.c.image_url,
+                           users.c.header_image_url,
+                           users.c.bio,
+                           viewer_follows(viewer_id)])
+                .where(users.c.deleted_at.is_(None))
+                .order_by(users.c.id))
+
+    def following_page(self, viewer_id=None, after=None, limit=FOLLOWS_PAGE_SIZE):
+        """One page of the users this user is following.
+
+        See `follows_page`.
+        """
+
+        if self.graph_index:
+            return self.graph_index_page(
+                self.graph_index.following(self.id), viewer_id, after, limit)
+
+        follows = Follows.__table__
+
+        return self.follows_page(
+            follows.c.user_following_id, follows.c.user_being_followed_id,
+            viewer_id, after, limit)
+
+    def followers_page(self, viewer_id=None, after=None, limit=FOLLOWS_PAGE_SIZE):
+        """One page of the users following this user.
+
+        See `follows_page`.
+        """
+
+        if self.graph_index:
+            return self.graph_index_page(
+                self.graph_index.followers(self.id), viewer_id, after, limit)
+
+        follows = Follows.__table__
+
+        return self.follows_page(
+            follows.c.user_being_followed_id, follows.c.user_following_id,
+            viewer_id, after, limit)
+
+    def follows_page(self, this_side, other_side, viewer_id, after, limit):
+        """One page of users on `other_side` of this user's follows rows.
+
+        Rows are `UserCard`s: the columns a user card shows, plus
+        `viewer_follows`, whether `viewer_id` follows that user, computed in
+        the same query. Pages are ordered by user id; pass the last id of a
+        page as `after` to get the next one.
+
+        Returns (rows, next_after); next_after is None on the last page.
+        """
+
+        users = User.__table__
+        query = (self.cards(viewer_id)
+                 .select_from(users.join(Follows.__table__, other_side == users.c.id))
+                 .where(this_side == self.id))
+
+        if after:
+            query = query.where(users.c.id > after)
+
+        rows = read_rows(query.limit(limit + 1), UserCard)
+
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1].id
+
+        return rows, None
+
+    def graph_index_page(self, ids, viewer_id, after, limit):
+        """`follows_page` for a list of user ids from the graph index.
+
+        Only the user cards themselves are read from the database.
+        """
+
+        page_ids, next_after = self.graph_index.page(ids, after, limit)
+        users = User.__table__
+
+        rows = db.session.execute(
+            db.select([users.c.id,
+                       users.c.username,
+                       users.c.image_url,
+                       users.c.header_image_url,
+                       users.c.bio])
+            .where(db.and_(users.c.id.in_(page_ids), users.c.deleted_at.is_(None)))
+            .order_by(users.c.id))
+
+        return [UserCard(*row, self.graph_index.is_following(viewer_id, row.id))
+                for row in rows], next_after
+
+    def mark_deleted(self):
+        """Mark this user as deleted.
+
+        The user's rows are removed later by `purge.purge_user`.
+        """
+
+        self.deleted_at = datetime.utcnow()
 
     def is_like(self , check_message):
         """Is this user like check_message"""
@@ -138,6 +436,18 @@ class User(db.Model):
 
         return len(found_message_list) == 1
 
+    @classmethod
+    def find(cls, user_id):
+        """The user with id `user_id`, deleted or not, or None.
+
+        A baked query, for the lookup behind every logged-in request.
+        """
+
+        query = bakery(lambda session: session.query(User))
+        query += lambda query: query.filter(User.id == db.bindparam('user_id'))
+
+        return query(db.session()).params(user_id=user_id).first()
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -168,7 +478,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -182,10 +492,19 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # an author's newest messages
+        db.Index('ix_messages_user_id', 'user_id', 'id'),
+        # a partition per month on Postgres (see partitions)
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
 
+    # time-ordered (see snowflake), so newest first is ORDER BY id DESC
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -193,10 +512,13 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # when the id was made, or the database's clock for rows inserted
+    # without one
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=lambda context: timestamp_of(context.get_current_parameters()['id']),
+        server_default=db.text('CURRENT_TIMESTAMP'),
     )
 
     user_id = db.Column(
@@ -214,6 +536,286 @@ class Message(db.Model):
         return len(found_user_list) == 1
 
 
+class Recommendation(db.Model):
+    """An account suggested to a user, scored by mutual follows."""
+
+    __tablename__ = 'recommendations'
+    __table_args__ = (
+        db.Index('ix_recommendations_user_score', 'user_id', 'score'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # how many of the accounts the user follows also follow the candidate
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit=5):
+        """Best suggestions for `user_id`, as user card rows with a score."""
+
+        return RECOMMENDATIONS.execute(db.session, user_id=user_id, limit=limit).fetchall()
+
+
+class TimelineEntry(db.Model):
+    """A message in a user's precomputed home timeline (see `feed`)."""
+
+    __tablename__ = 'timelines'
+
+    # message ids are time-ordered, so the primary key is also the index
+    # of each timeline, newest last
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # not a foreign key: the message may be on another database (see
+    # shards); entries of deleted messages are skipped when read
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # copied from the message, so unfollows can remove an author's entries
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class MessageTag(db.Model):
+    """A #hashtag in a message (see `tags`)."""
+
+    __tablename__ = 'message_tags'
+    __table_args__ = (
+        # for removing a deleted message's tags
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+    # lowercased, without the '#'; with the message id, the index of each
+    # tag's messages, newest last
+    tag = db.Column(
+        db.String(140),
+        primary_key=True,
+    )
+
+    # not a foreign key: the message may be on another database (see shards)
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message (see `tags`)."""
+
+    __tablename__ = 'mentions'
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+    # the user mentioned
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class HotAuthor(db.Model):
+    """An account with so many followers its messages aren't fanned out."""
+
+    __tablename__ = 'hot_authors'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    followers = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class HighWaterMark(db.Model):
+    """The id of an author's newest message, for cheap "anything new?" polls
+    (see `feed.new_since`)."""
+
+    __tablename__ = 'high_water_marks'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard holds the messages and likes of a bucket of users."""
+
+    __tablename__ = 'shard_buckets'
+
+    # user id % shards.BUCKETS
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # being copied to another shard: its users can't write
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, run by the background worker."""
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # queued -> running -> done / failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=3,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
+
+# hot queries, built once (see statements)
+
+USER_IS_FOLLOWING = Statement(
+    db.select([db.exists().where(db.and_(
+        Follows.user_following_id == db.bindparam('user_id'),
+        Follows.user_being_followed_id == db.bindparam('other_id')))]),
+    'user_is_following')
+
+USER_FOLLOWING_IDS = Statement(
+    db.select([Follows.user_being_followed_id])
+    .where(Follows.user_following_id == db.bindparam('user_id')),
+    'user_following_ids')
+
+USER_FOLLOWING_COUNT = Statement(
+    db.select([db.func.count()])
+    .where(Follows.user_following_id == db.bindparam('user_id')),
+    'user_following_count')
+
+USER_FOLLOWERS_COUNT = Statement(
+    db.select([db.func.count()])
+    .where(Follows.user_being_followed_id == db.bindparam('user_id')),
+    'user_followers_count')
+
+USER_MESSAGES_COUNT = Statement(
+    db.select([db.func.count()])
+    .where(Message.user_id == db.bindparam('user_id')),
+    'user_messages_count')
+
+USER_LIKES_COUNT = Statement(
+    db.select([db.func.count()])
+    .where(Likes.user_id == db.bindparam('user_id')),
+    'user_likes_count')
+
+RECOMMENDATIONS = Statement(
+    db.select([User.id, User.username, User.image_url, Recommendation.score])
+    .select_from(Recommendation.__table__.join(
+        User.__table__, User.id == Recommendation.candidate_id))
+    .where(db.and_(Recommendation.user_id == db.bindparam('user_id'),
+                   User.deleted_at.is_(None)))
+    .order_by(Recommendation.score.desc(), Recommendation.candidate_id)
+    .limit(db.bindparam('limit')),
+    'recommendations')
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,645 @@
+"""Monthly partitions of the messages table, and their archive.
+
+Message ids are time-ordered (see snowflake), so a month of messages is a
+range of ids. On Postgres (12 or later) `messages` is partitioned by range
+of id, one table per month (`messages_2021_06`): ORDER BY id DESC ... LIMIT
+reads the newest partitions first and stops, lookups by id touch only the
+partition holding the id, and old months are dropped without a DELETE. The
+partitions for this month and the next `PARTITIONS_AHEAD` are made when the
+table is created and then by a daily job.
+
+A DEFAULT partition catches messages past the last month made, so posting
+never fails for want of one; a month whose messages are there already is
+left there (see `ensure_partitions`).
+
+Months older than `ARCHIVE_AFTER_MONTHS` are archived by the same job:
+their messages, with the likes on them, are streamed in id order to a
+gzipped JSON lines file in `ARCHIVE_DIR`, then taken out of the database.
+Profile pages paged past the database's messages read the rest from those
+files (`messages_before`), only the blocks of a file holding the author's
+messages (see `write_archive`), and `flask partitions restore 2021-06` puts
+a month back, without the messages and likes of accounts purged since.
+Purging an account takes its messages and likes out of the archive files
+too (`purge_archived_user`).
+
+Other databases have no partitions, so there a month is only a range of
+ids: archiving deletes it and restoring inserts it again. With shards (see
+shards), only the main database's months are archived.
+"""
+
+import gzip
+import heapq
+import json
+import logging
+import os
+from datetime import date, datetime
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+from cache import RecentMessage, TTLCache
+from jobs import task
+from models import db, Likes, Message, TimelineEntry, User
+from shards import insert_ignoring_duplicates, router
+from snowflake import min_id_at, timestamp_of
+
+logger = logging.getLogger(__name__)
+
+PARTITIONS_AHEAD = 2
+ARCHIVE_AFTER_MONTHS = 12
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var', 'archive')
+
+# messages read from the database at a time when archiving, and records
+# compressed together in an archive file
+ARCHIVE_BATCH = 1000
+
+# indexes of archive files kept in memory, for deep profile pages
+ARCHIVE_CACHE_MONTHS = 24
+
+DEFAULT_PARTITION = 'messages_default'
+
+archives = TTLCache(size=ARCHIVE_CACHE_MONTHS)
+
+
+def month_of(when):
+    """The first day of the month of `when`."""
+
+    return date(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    """The month `count` months after (or before) `month`."""
+
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def months(start, end):
+    """Months from `start` up to and including `end`."""
+
+    while start <= end:
+        yield start
+        start = add_months(start, 1)
+
+
+def parse_month(text):
+    """The month of a 'YYYY-MM' string."""
+
+    return datetime.strptime(text, '%Y-%m').date()
+
+
+def id_range(month):
+    """(lowest id, lowest id of the next month) of a month."""
+
+    start = datetime(month.year, month.month, 1)
+    end = add_months(month, 1)
+
+    return min_id_at(start), min_id_at(datetime(end.year, end.month, 1))
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"{partition_name(month)}.jsonl.gz")
+
+
+def index_path(month):
+    return os.path.join(ARCHIVE_DIR, f"{partition_name(month)}.index.json")
+
+
+def batches(iterable, size):
+    """Lists of up to `size` items of `iterable`, in order."""
+
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(islice(iterator, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def is_partitioned(bind):
+    """Whether the messages table on `bind` has real partitions."""
+
+    return bind.dialect.name == 'postgresql'
+
+
+def existing_partitions(bind):
+    """Months that have a partition on Postgres."""
+
+    names = bind.execute(db.text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'messages'::regclass"))
+
+    return sorted(datetime.strptime(name, 'messages_%Y_%m').date() for (name,) in names
+                  if name != DEFAULT_PARTITION)
+
+
+def create_partition(bind, month):
+    low, high = id_range(month)
+
+    bind.execute(db.text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+        f"PARTITION OF messages FOR VALUES FROM ({low}) TO ({high})"))
+
+
+def in_default_partition(bind, month):
+    """Whether messages of `month` went to the default partition."""
+
+    low, high = id_range(month)
+
+    return bind.execute(db.text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+        f"WHERE id >= {low} AND id < {high})")).scalar()
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def create_first_partitions(table, connection, **kw):
+    """The default partition, and partitions for this month and the next
+    ones, for a new table."""
+
+    if is_partitioned(connection):
+        connection.execute(db.text(
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+
+        this_month = month_of(datetime.utcnow())
+
+        for month in months(this_month, add_months(this_month, PARTITIONS_AHEAD)):
+            create_partition(connection, month)
+
+
+def ensure_partitions(start=None, ahead=None):
+    """Create missing partitions from `start` (this month) on.
+
+    A month with messages in the default partition already (posted while
+    the job wasn't running) is skipped: its partition can't be made without
+    taking them out, and with them the likes on them. They stay where they
+    are, and an error is logged.
+
+    Returns the months created; none on databases without partitions.
+    """
+
+    bind = db.session.get_bind()
+
+    if not is_partitioned(bind):
+        return []
+
+    this_month = month_of(datetime.utcnow())
+    ahead = PARTITIONS_AHEAD if ahead is None else ahead
+    existing = set(existing_partitions(bind))
+
+    created = []
+
+    for month in months(start or this_month, add_months(this_month, ahead)):
+        if month in existing:
+            continue
+
+        if in_default_partition(db.session, month):
+            logger.error(f"{partition_name(month)}: messages in {DEFAULT_PARTITION}, "
+                         f"partition not created")
+            continue
+
+        create_partition(db.session, month)
+        created.append(month)
+
+    db.session.commit()
+
+    return created
+
+
+def months_in_database():
+    """Months that have a partition or, without partitions, messages."""
+
+    bind = db.session.get_bind()
+
+    if is_partitioned(bind):
+        return existing_partitions(bind)
+
+    oldest, newest = db.session.query(db.func.min(Message.id),
+                                      db.func.max(Message.id)).one()
+
+    if oldest is None:
+        return []
+
+    return list(months(month_of(timestamp_of(oldest)), month_of(timestamp_of(newest))))
+
+
+def read_archive(month):
+    """The records of an archived month, in id order, read as they're
+    wanted; none if there is no archive."""
+
+    try:
+        archive = gzip.open(archive_path(month), 'rt')
+    except FileNotFoundError:
+        return
+
+    with archive:
+        for line in archive:
+            yield json.loads(line)
+
+
+def archive_stamp(month):
+    """(modification time, size) of an archive file, or None."""
+
+    try:
+        stat = os.stat(archive_path(month))
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_archive(month, records):
+    """Replace the archive file of a month with `records`, in id order;
+    without records, remove it. Returns the number written.
+
+    Records are compressed `ARCHIVE_BATCH` at a time, each batch a gzip
+    member of its own (gzip reads them as one stream), and the offset, ids
+    and authors of each are indexed next to the file, so a profile page
+    decompresses only the batches with its author's messages.
+    """
+
+    path = archive_path(month)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+    blocks = []
+    count = 0
+
+    with open(path + '.tmp', 'wb') as archive:
+        for batch in batches(records, ARCHIVE_BATCH):
+            data = gzip.compress(''.join(json.dumps(record) + '\n' for record in batch).encode())
+            blocks.append([archive.tell(), len(data), batch[0]['id'], batch[-1]['id'],
+                           sorted({record['user_id'] for record in batch})])
+            archive.write(data)
+            count += len(batch)
+
+    if count:
+        os.replace(path + '.tmp', path)
+
+        # the file's stamp tells a reader whether the index is of it
+        with open(index_path(month) + '.tmp', 'w') as index:
+            json.dump(dict(stamp=archive_stamp(month), blocks=blocks), index)
+
+        os.replace(index_path(month) + '.tmp', index_path(month))
+    else:
+        for name in (path + '.tmp', path, index_path(month)):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    archives.invalidate(month)
+
+    return count
+
+
+def merge_records(*streams):
+    """Merge streams of records in id order; for an id in several, the
+    record of the last stream wins."""
+
+    def keyed(order, stream):
+        return ((record['id'], order, record) for record in stream)
+
+    previous = None
+
+    for id, _, record in heapq.merge(*(keyed(order, stream)
+                                       for order, stream in enumerate(streams))):
+        if previous is not None and previous['id'] != id:
+            yield previous
+
+        previous = record
+
+    if previous is not None:
+        yield previous
+
+
+def database_records(low, high, counts):
+    """Records of the messages with ids from `low` up to `high`, with their
+    likes, in id order, read `ARCHIVE_BATCH` messages at a time. Counts them
+    in `counts['messages']`."""
+
+    messages = Message.__table__
+    likes = Likes.__table__
+    after = low - 1
+
+    while True:
+        rows = db.session.execute(
+            messages.select()
+            .where(db.and_(messages.c.id > after, messages.c.id < high))
+            .order_by(messages.c.id)
+            .limit(ARCHIVE_BATCH)).fetchall()
+
+        if not rows:
+            return
+
+        likers = {}
+
+        for user_id, message_id in db.session.execute(
+                db.select([likes.c.user_id, likes.c.message_id])
+                .where(likes.c.message_id.in_([row.id for row in rows]))):
+            likers.setdefault(message_id, []).append(user_id)
+
+        for row in rows:
+            yield dict(id=row.id, text=row.text, user_id=row.user_id,
+                       timestamp=row.timestamp.isoformat(), likes=likers.get(row.id, []))
+
+        counts['messages'] += len(rows)
+        after = rows[-1].id
+
+
+def archive_month(month):
+    """Move a month of messages out of the database into its archive file.
+
+    The file is written before the rows are deleted, and merged with what
+    an earlier archive of the month left there; both are streamed, a batch
+    at a time. Returns the number of messages archived.
+    """
+
+    low, high = id_range(month)
+    messages = Message.__table__
+    likes = Likes.__table__
+    in_month = messages.c.id.between(low, high - 1)
+
+    counts = dict(messages=0)
+
+    if db.session.execute(db.select([messages.c.id]).where(in_month).limit(1)).first():
+        write_archive(month, merge_records(read_archive(month),
+                                           database_records(low, high, counts)))
+
+    for table, column in [(TimelineEntry.__table__, TimelineEntry.message_id),
+                          (likes, likes.c.message_id)]:
+        db.session.execute(table.delete().where(column.between(low, high - 1)))
+
+    if is_partitioned(db.session.get_bind()):
+        db.session.execute(db.text(
+            f"ALTER TABLE messages DETACH PARTITION {partition_name(month)}"))
+        db.session.execute(db.text(f"DROP TABLE {partition_name(month)}"))
+    else:
+        db.session.execute(messages.delete().where(in_month))
+
+    db.session.commit()
+
+    logger.info(f"{partition_name(month)}: {counts['messages']} messages archived")
+    return counts['messages']
+
+
+def restore_month(month):
+    """Put an archived month back in the database. Returns its message count.
+
+    Messages and likes of accounts that no longer exist are left out, and
+    rows already there are skipped, so a month can be restored again. The
+    file is read `ARCHIVE_BATCH` records at a time.
+    """
+
+    if is_partitioned(db.session.get_bind()):
+        create_partition(db.session, month)
+
+    count = 0
+
+    for records in batches(read_archive(month), ARCHIVE_BATCH):
+        user_ids = {record['user_id'] for record in records}
+        user_ids.update(user_id for record in records for user_id in record['likes'])
+
+        existing = {user_id for (user_id,) in
+                    db.session.query(User.id).filter(User.id.in_(user_ids))}
+
+        records = [record for record in records if record['user_id'] in existing]
+
+        if not records:
+            continue
+
+        db.session.execute(insert_ignoring_duplicates(Message.__table__), [
+            dict(id=record['id'], text=record['text'], user_id=record['user_id'],
+                 timestamp=datetime.fromisoformat(record['timestamp']))
+            for record in records
+        ])
+
+        likes = [dict(user_id=user_id, message_id=record['id'])
+                 for record in records for user_id in record['likes']
+                 if user_id in existing]
+
+        if likes:
+            db.session.execute(insert_ignoring_duplicates(Likes.__table__), likes)
+
+        count += len(records)
+
+    db.session.commit()
+
+    logger.info(f"{partition_name(month)}: {count} messages restored")
+    return count
+
+
+def purge_archived_user(user_id):
+    """Take a purged account's messages, and its likes of other messages,
+    out of the archive files. Returns the number of messages removed.
+
+    Each file is read through once to see whether the account is in it, and
+    rewritten only if so; both stream.
+    """
+
+    def mentions(record):
+        return record['user_id'] == user_id or user_id in record['likes']
+
+    def kept(records):
+        for record in records:
+            if record['user_id'] == user_id:
+                counts['messages'] += 1
+                continue
+
+            record['likes'] = [liker for liker in record['likes'] if liker != user_id]
+            yield record
+
+    counts = dict(messages=0)
+
+    for month in archived_months():
+        if any(mentions(record) for record in read_archive(month)):
+            write_archive(month, kept(read_archive(month)))
+
+    return counts['messages']
+
+
+@task(every=24 * 60 * 60)
+def maintain_partitions(after_months=None, today=None):
+    """Create the coming months' partitions and archive old months.
+
+    Returns the number of months archived.
+    """
+
+    ensure_partitions()
+
+    after_months = ARCHIVE_AFTER_MONTHS if after_months is None else after_months
+    cutoff = add_months(month_of(today or datetime.utcnow()), -after_months)
+
+    old = [month for month in months_in_database() if month < cutoff]
+
+    for month in old:
+        archive_month(month)
+
+    return len(old)
+
+
+def archived_months():
+    """Months with an archive file, newest first."""
+
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+
+    return sorted((datetime.strptime(name, 'messages_%Y_%m.jsonl.gz').date()
+                   for name in names if name.endswith('.jsonl.gz')), reverse=True)
+
+
+def load_index(month):
+    """{'stamp': the file's `archive_stamp`, 'blocks': [(offset, length,
+    first id, last id, set of author ids)]} of an archive file (see
+    `write_archive`), or None if it has no index."""
+
+    try:
+        with open(index_path(month)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    index['blocks'] = [(offset, length, first, last, frozenset(authors))
+                       for offset, length, first, last, authors in index['blocks']]
+
+    return index
+
+
+def archive_index(month):
+    """The index of an archive file as it is now, or None if it has none
+    (it's being rewritten, or was written before they were kept)."""
+
+    stamp = archive_stamp(month)
+    index = archives.get(month, load_index)
+
+    if index and index['stamp'] != stamp:
+        archives.invalidate(month)
+        index = archives.get(month, load_index)
+
+    return index if index and index['stamp'] == stamp else None
+
+
+def as_row(record):
+    return RecentMessage(record['id'], record['text'],
+                         datetime.fromisoformat(record['timestamp']), record['user_id'])
+
+
+def archived_rows(month, author_id, before_id):
+    """An author's messages of an archived month (older than `before_id`),
+    newest first, read as they're wanted.
+
+    Only the blocks holding the author's messages are decompressed; a file
+    without an index is read through.
+    """
+
+    def wanted(record):
+        return (record['user_id'] == author_id
+                and (before_id is None or record['id'] < before_id))
+
+    index = archive_index(month)
+
+    if index is None:
+        yield from reversed([as_row(record) for record in read_archive(month) if wanted(record)])
+        return
+
+    with open(archive_path(month), 'rb') as archive:
+        for offset, length, first, last, authors in reversed(index['blocks']):
+            if author_id not in authors or (before_id is not None and first >= before_id):
+                continue
+
+            archive.seek(offset)
+            lines = gzip.decompress(archive.read(length)).decode().splitlines()
+            records = (json.loads(line) for line in lines)
+
+            yield from reversed([as_row(record) for record in records if wanted(record)])
+
+
+def archived_messages(author_id, before_id, limit):
+    """An author's archived messages (older than `before_id`), newest first."""
+
+    rows = []
+
+    for month in archived_months():
+        if before_id is not None and id_range(month)[0] >= before_id:
+            continue
+
+        for row in archived_rows(month, author_id, before_id):
+            rows.append(row)
+
+            if len(rows) == limit:
+                return rows
+
+    return rows
+
+
+def messages_before(author_id, before_id, limit):
+    """An author's messages (older than `before_id`), newest first, as
+    `RecentMessage`s: from the database, then from the archive."""
+
+    rows = router.author_messages(author_id, before_id=before_id, limit=limit)
+
+    if len(rows) < limit:
+        # everything in the database older than the last row has been read
+        rows += archived_messages(author_id, rows[-1].id if rows else before_id,
+                                  limit - len(rows))
+
+    return rows
+
+
+def init_partitions(app):
+    """Read the partition settings from the app config."""
+
+    global PARTITIONS_AHEAD, ARCHIVE_AFTER_MONTHS, ARCHIVE_DIR
+
+    PARTITIONS_AHEAD = app.config.get('PARTITIONS_AHEAD', PARTITIONS_AHEAD)
+    ARCHIVE_AFTER_MONTHS = app.config.get('ARCHIVE_AFTER_MONTHS', ARCHIVE_AFTER_MONTHS)
+    ARCHIVE_DIR = app.config.get('ARCHIVE_DIR', ARCHIVE_DIR)
+
+
+partitions_cli = AppGroup('partitions', help="Monthly message partitions.")
+
+
+@partitions_cli.command('list')
+def list_command():
+    """Show the months in the database and in the archive."""
+
+    for month in months_in_database():
+        click.echo(f"{month:%Y-%m} database")
+
+    for month in reversed(archived_months()):
+        click.echo(f"{month:%Y-%m} archived ({archive_path(month)})")
+
+
+@partitions_cli.command('create')
+@click.option('--since', help="First month to create (YYYY-MM).")
+def create_command(since):
+    """Create missing partitions up to the coming months."""
+
+    created = ensure_partitions(parse_month(since) if since else None)
+    click.echo(f"{len(created)} partitions created")
+
+
+@partitions_cli.command('archive')
+@click.option('--after-months', type=int, help="Archive months older than this.")
+def archive_command(after_months):
+    """Archive old months now."""
+
+    click.echo(f"{maintain_partitions(after_months)} months archived")
+
+
+@partitions_cli.command('restore')
+@click.argument('month')
+def restore_command(month):
+    """Put an archived month (YYYY-MM) back in the database."""
+
+    click.echo(f"{restore_month(parse_month(month))} messages restored")
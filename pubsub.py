@@ -0,0 +1,147 @@
+"""Live home timeline updates.
+
+When a message is posted its id is published on its author's channel.
+`/stream` subscribes a logged-in user to the channels of the accounts they
+follow (and their own) and sends the ids of new messages to the browser as
+server-sent events; static/scripts/stream.js then fetches just those cards
+from `/messages/cards` and adds them to the top of the home page.
+
+The broker is set by `PUBSUB_BROKER` ('module:Class', `LocalBroker` by
+default). `LocalBroker` only reaches streams held by the process the message
+was posted in, so it suits one async worker serving everything; a broker
+shared by several processes needs the same `subscribe`/`publish` methods.
+
+A stream holds no database connection while it waits, just a
+`Subscription`, so one gevent worker (see serve_async.py) can keep many
+thousands of them open.
+"""
+
+import json
+import threading
+from collections import deque
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+# seconds between comments sent to keep idle connections open
+HEARTBEAT = 15
+
+# milliseconds browsers wait before reconnecting a dropped stream
+RETRY = 5000
+
+# ids kept for a subscriber that isn't reading; older ones are dropped
+PENDING = 100
+
+
+class Subscription:
+    """Messages published on some channels, waiting to be read."""
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = frozenset(channels)
+        self.pending = deque(maxlen=PENDING)
+        self.ready = threading.Event()
+
+    def put(self, item):
+        self.pending.append(item)
+        self.ready.set()
+
+    def get(self, timeout=None):
+        """Items published since the last call, waiting up to `timeout`
+        seconds for one; [] if none came."""
+
+        if not self.ready.wait(timeout):
+            return []
+
+        self.ready.clear()
+        items = []
+
+        while self.pending:
+            items.append(self.pending.popleft())
+
+        return items
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Channels of subscriptions in this process."""
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels)
+
+        with self.lock:
+            for channel in subscription.channels:
+                self.channels.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.channels.get(channel)
+
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+
+                    if not subscribers:
+                        del self.channels[channel]
+
+    def publish(self, channel, item):
+        """Give `item` to every subscriber of `channel`."""
+
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+
+        for subscription in subscribers:
+            subscription.put(item)
+
+
+def publish_message(message):
+    """Tell the streams of the author's followers about a new message."""
+
+    current_app.extensions['pubsub'].publish(message.user_id, message.id)
+
+
+def subscribe(user):
+    """A `Subscription` to the messages of the accounts `user` follows."""
+
+    return current_app.extensions['pubsub'].subscribe({user.id, *user.following_ids()})
+
+
+def events(subscription, heartbeat=HEARTBEAT):
+    """The server-sent events of a subscription, until the client goes away.
+
+    Message ids are sent as strings: they don't fit in a JavaScript number.
+    """
+
+    try:
+        yield f"retry: {RETRY}\n\n"
+
+        while True:
+            message_ids = subscription.get(timeout=heartbeat)
+
+            if message_ids:
+                data = json.dumps([str(message_id) for message_id in message_ids])
+                yield f"event: messages\ndata: {data}\n\n"
+            else:
+                yield ": heartbeat\n\n"
+
+    finally:
+        subscription.close()
+
+
+def init_pubsub(app):
+    """Set up the broker named by the app config."""
+
+    broker = app.config.get('PUBSUB_BROKER') or LocalBroker
+
+    if isinstance(broker, str):
+        broker = import_string(broker)
+
+    app.extensions['pubsub'] = broker()
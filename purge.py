@@ -0,0 +1,149 @@
+"""Purge deleted user accounts in bounded batches."""
+
+import logging
+
+from graph import log_purge
+from jobs import RetryLater, task
+from models import db, User, Message, Likes, Follows
+from partitions import purge_archived_user
+from shards import BucketMovingError, router
+
+logger = logging.getLogger(__name__)
+
+PURGE_BATCH_SIZE = 1000
+
+# seconds to put off a purge whose user is being moved to another shard;
+# longer than a move takes
+MOVE_RETRY_DELAY = 5 * 60
+
+
+def log_progress(user_id, table, deleted):
+    """Default progress reporter: write to the log."""
+
+    logger.info(
+        f"purge user #{user_id}: {deleted} rows deleted from {table}")
+
+
+def delete_in_batches(table, key, where, batch_size, connect=None):
+    """Delete rows matching `where` from `table`, `batch_size` rows at a time.
+
+    `key` is the column used to pick each batch. Every batch is its own
+    transaction, so no single statement holds locks for long: in the app's
+    session, or in `connect()` (a shard's, see `ShardRouter.connect`).
+
+    Yields the running total of deleted rows after every batch.
+    """
+
+    total = 0
+
+    while True:
+        batch = (db.select([key])
+                 .where(where)
+                 .limit(batch_size))
+
+        delete = table.delete().where(db.and_(where, key.in_(batch)))
+
+        if connect:
+            with connect() as connection:
+                result = connection.execute(delete)
+        else:
+            result = db.session.execute(delete)
+            db.session.commit()
+
+        if not result.rowcount:
+            return
+
+        total += result.rowcount
+        yield total
+
+
+def purge_shard(user_id, batch_size, progress):
+    """Delete a user's likes, then their messages, from their shard.
+
+    Returns a dict of deleted row counts per table.
+    """
+
+    likes = router.likes
+
+    def connect():
+        return router.connect(router.writable_shard_of(user_id))
+
+    deleted = 0
+
+    for deleted in delete_in_batches(likes, likes.c.id, likes.c.user_id == user_id,
+                                     batch_size, connect):
+        progress(user_id, 'likes', deleted)
+
+    counts = {'likes': deleted}
+    deleted = 0
+
+    for deleted in router.delete_messages_of(user_id, batch_size):
+        progress(user_id, 'messages', deleted)
+
+    counts['messages'] = deleted
+
+    return counts
+
+
+@task
+def purge_user(user_id, batch_size=PURGE_BATCH_SIZE, progress=log_progress):
+    """Remove a deleted user's messages, likes and follows, then the user.
+
+    Rows are deleted with plain DELETE statements so nothing is loaded into
+    the ORM; likes on the user's messages go with them through the
+    database's ON DELETE CASCADE.
+
+    With shards (see shards), the user's likes and messages are deleted
+    from their shard first, in batches too, with others' likes on those
+    messages; while the user's bucket is being moved the job is put off
+    until the move is over. Their archived messages and likes (see
+    partitions) are taken out of the archive files.
+
+    `progress(user_id, table, deleted)` is called after every batch.
+
+    Returns a dict of deleted row counts per table.
+    """
+
+    messages = Message.__table__
+    likes = Likes.__table__
+    follows = Follows.__table__
+
+    steps = [] if router.sharded else [
+        (likes, likes.c.id, likes.c.user_id == user_id),
+        (messages, messages.c.id, messages.c.user_id == user_id),
+    ]
+
+    steps += [
+        (follows, follows.c.user_being_followed_id,
+            follows.c.user_following_id == user_id),
+        (follows, follows.c.user_following_id,
+            follows.c.user_being_followed_id == user_id),
+    ]
+
+    counts = {}
+
+    if router.sharded:
+        try:
+            counts.update(purge_shard(user_id, batch_size, progress))
+        except BucketMovingError as e:
+            raise RetryLater(MOVE_RETRY_DELAY, str(e))
+
+    for table, key, where in steps:
+        done = counts.get(table.name, 0)
+        deleted = 0
+
+        for deleted in delete_in_batches(table, key, where, batch_size):
+            progress(user_id, table.name, done + deleted)
+
+        counts[table.name] = done + deleted
+
+    counts['archived messages'] = purge_archived_user(user_id)
+    progress(user_id, 'archived messages', counts['archived messages'])
+
+    log_purge(user_id)
+    db.session.execute(
+        User.__table__.delete().where(User.__table__.c.id == user_id))
+    db.session.commit()
+
+    return counts
+
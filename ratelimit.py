@@ -0,0 +1,332 @@
+"""Token-bucket rate limiting for the expensive POST routes.
+
+Logging in and signing up hash a password with bcrypt; posting and liking
+messages are write transactions. Each of these routes has a budget per
+client IP and, once logged in, per user id (`LIMITS`, overridable with the
+`RATE_LIMITS` config). A budget is a token bucket: `burst` requests at
+once, refilled at `rate` requests per `per` seconds. A request is admitted
+only if every bucket it draws from has a token; otherwise it gets a 429
+with a `Retry-After` header.
+
+Buckets live in this process by default (`LocalBuckets`), so each worker
+enforces the budgets on its own. Set `RATE_LIMIT_BACKEND` to
+'tcp://host:port' to share them between workers and hosts through a bucket
+server, started with
+
+    (venv) $ flask ratelimit serve --port 7379
+
+If the bucket server can't be reached, requests are let through.
+
+Behind reverse proxies every request comes from a proxy's address, so all
+clients would share one IP budget. Set `PROXY_COUNT` to the number of
+proxies in front of the app and the client address is taken from their
+X-Forwarded-For headers instead (`trust_proxies`). Only set it when the
+proxies are really there: the header is whatever the client sent otherwise.
+"""
+
+import logging
+import math
+import socket
+import socketserver
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import click
+from flask import Response, current_app, g, request
+from flask.cli import AppGroup
+
+logger = logging.getLogger(__name__)
+
+Limit = namedtuple('Limit', ['rate', 'per', 'burst'])
+
+# endpoint -> {'ip': Limit, 'user': Limit}
+LIMITS = {
+    'warbler.login': {
+        'ip': Limit(rate=10, per=60, burst=10),
+    },
+    'warbler.signup': {
+        'ip': Limit(rate=5, per=60 * 60, burst=5),
+    },
+    'warbler.messages_add': {
+        'user': Limit(rate=30, per=60, burst=10),
+        'ip': Limit(rate=120, per=60, burst=30),
+    },
+    'warbler.messages_add_like': {
+        'user': Limit(rate=120, per=60, burst=30),
+        'ip': Limit(rate=480, per=60, burst=60),
+    },
+}
+
+# only these methods are limited: the forms themselves are cheap to show
+LIMITED_METHODS = {'POST'}
+
+# forget refilled buckets every this many tokens taken
+PRUNE_EVERY = 10000
+
+SERVER_TIMEOUT = 0.05
+
+
+class LocalBuckets:
+    """Token buckets in this process's memory.
+
+    A bucket is (tokens, time of last update, time it will be full again);
+    buckets that have refilled are forgotten, as a fresh one is the same.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.added = 0
+
+    def take(self, requests):
+        """Take a token from each of `requests`, a list of (key, rate, burst).
+
+        `rate` is in tokens per second. Tokens are taken only if every
+        bucket has one. Returns 0 if they were, or else the seconds until
+        they all will.
+        """
+
+        now = self.clock()
+        wait = 0.0
+
+        with self.lock:
+            levels = []
+
+            for key, rate, burst in requests:
+                bucket = self.buckets.get(key)
+
+                if bucket is None:
+                    tokens = burst
+                else:
+                    tokens, updated, _ = bucket
+                    tokens = min(burst, tokens + (now - updated) * rate)
+
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+
+                levels.append(tokens)
+
+            if wait:
+                return wait
+
+            for (key, rate, burst), tokens in zip(requests, levels):
+                tokens -= 1
+                self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+
+            self.added += len(requests)
+
+            if self.added >= PRUNE_EVERY:
+                self.prune(now)
+
+        return 0.0
+
+    def prune(self, now):
+        """Forget buckets that have refilled. Call with the lock held."""
+
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket[2] > now}
+        self.added = 0
+
+    def reset(self):
+        """Forget every bucket."""
+
+        with self.lock:
+            self.buckets.clear()
+
+
+class RemoteBuckets:
+    """Token buckets kept by a bucket server (see `BucketServer`).
+
+    Each thread keeps one connection to the server. A request is one line
+    of space-separated key, rate and burst triples; the reply is the line
+    `LocalBuckets.take` returned.
+    """
+
+    def __init__(self, host, port, timeout=SERVER_TIMEOUT):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        """This thread's (socket, reader), connecting if needed."""
+
+        if getattr(self.local, 'connection', None) is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.connection = (sock, sock.makefile('rb'))
+
+        return self.local.connection
+
+    def take(self, requests):
+        """See `LocalBuckets.take`. Lets the request through on errors."""
+
+        line = ' '.join(f"{key} {rate!r} {burst!r}" for key, rate, burst in requests)
+
+        try:
+            sock, reader = self.connection()
+            sock.sendall(line.encode('utf-8') + b'\n')
+            reply = reader.readline()
+
+            if not reply:
+                raise ConnectionError("bucket server closed the connection")
+
+            return float(reply)
+
+        except (OSError, ValueError) as error:
+            logger.warning(f"rate limit server {self.address}: {error}")
+            self.close()
+            return 0.0
+
+    def close(self):
+        """Close this thread's connection."""
+
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+
+        if connection:
+            connection[1].close()
+            connection[0].close()
+
+    def reset(self):
+        """Buckets on the server are left alone."""
+
+
+class BucketRequestHandler(socketserver.StreamRequestHandler):
+    """Answers `RemoteBuckets` requests from the server's `LocalBuckets`."""
+
+    def handle(self):
+        for line in self.rfile:
+            fields = line.split()
+            requests = [(fields[i].decode('utf-8'), float(fields[i + 1]), float(fields[i + 2]))
+                        for i in range(0, len(fields) - 2, 3)]
+
+            self.wfile.write(f"{self.server.buckets.take(requests)!r}\n".encode('utf-8'))
+
+
+class BucketServer(socketserver.ThreadingTCPServer):
+    """TCP server sharing one set of token buckets between its clients."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, buckets=None):
+        super().__init__(address, BucketRequestHandler)
+        self.buckets = buckets or LocalBuckets()
+
+
+def backend_for(url):
+    """Buckets for a `RATE_LIMIT_BACKEND` setting."""
+
+    if not url:
+        return LocalBuckets()
+
+    parts = urlsplit(url)
+
+    if parts.scheme != 'tcp':
+        raise ValueError(f"unsupported rate limit backend: {url}")
+
+    return RemoteBuckets(parts.hostname, parts.port)
+
+
+class RateLimiter:
+    """Applies per-endpoint budgets to requests, before the view runs."""
+
+    def __init__(self, limits, backend):
+        # endpoint -> [(kind, rate per second, burst)]
+        self.limits = {
+            endpoint: [(kind, limit.rate / limit.per, limit.burst)
+                       for kind, limit in sorted(budgets.items())]
+            for endpoint, budgets in limits.items()
+        }
+        self.backend = backend
+
+    def check(self):
+        """Before-request hook: a 429 response if the client is over budget."""
+
+        # one context lookup instead of one per attribute
+        req = request._get_current_object()
+        budgets = self.limits.get(req.endpoint)
+
+        if not budgets or req.method not in LIMITED_METHODS:
+            return None
+
+        user = g.get('user')
+        requests = []
+
+        for kind, rate, burst in budgets:
+            if kind == 'ip':
+                requests.append((f"{req.endpoint}:ip:{req.remote_addr}", rate, burst))
+            elif user:
+                requests.append((f"{req.endpoint}:user:{user.id}", rate, burst))
+
+        if not requests:
+            return None
+
+        wait = self.backend.take(requests)
+
+        if not wait:
+            return None
+
+        retry_after = math.ceil(wait)
+        current_app.logger.info(
+            f"rate limited {req.endpoint} for {req.remote_addr}"
+            f"{f' (user {user.id})' if user else ''}: retry after {retry_after}s")
+
+        return Response(f"Too many requests. Try again in {retry_after} seconds.\n",
+                        429, {'Retry-After': str(retry_after)}, mimetype='text/plain')
+
+
+def trust_proxies(app, count):
+    """Take the client address (and scheme) from the headers set by `count`
+    reverse proxies in front of the app."""
+
+    try:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+    except ImportError:
+        # Werkzeug < 0.15
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=count)
+    else:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count)
+
+
+def init_ratelimit(app):
+    """Install the rate limiter.
+
+    Call after the hook that sets `g.user`, so user budgets can apply.
+    """
+
+    if app.config.get('PROXY_COUNT'):
+        trust_proxies(app, app.config['PROXY_COUNT'])
+
+    limits = dict(LIMITS)
+    limits.update(app.config.get('RATE_LIMITS', {}))
+
+    limiter = RateLimiter(limits, backend_for(app.config.get('RATE_LIMIT_BACKEND')))
+    app.extensions['ratelimit'] = limiter
+
+    if app.config.get('RATE_LIMIT_ENABLED', True):
+        app.before_request(limiter.check)
+
+    return limiter
+
+
+ratelimit_cli = AppGroup('ratelimit', help="Shared rate limit buckets.")
+
+
+@ratelimit_cli.command('serve')
+@click.option('--host', default='127.0.0.1', help="Address to listen on.")
+@click.option('--port', default=7379, help="Port to listen on.")
+def serve_command(host, port):
+    """Serve token buckets to the app's workers (RATE_LIMIT_BACKEND)."""
+
+    server = BucketServer((host, port))
+    click.echo(f"serving rate limit buckets on tcp://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,246 @@
+"""'Who to follow' recommendations.
+
+A user's candidates are the accounts followed by the accounts they follow,
+scored by how many of those follows lead to the candidate. The top few per
+user are stored in the `recommendations` table, so serving them is one
+indexed read (`Recommendation.for_user`).
+
+Stored recommendations are refreshed one user at a time by a job whenever
+that user follows or unfollows someone, and rebuilt for everyone once a day
+(or with `flask recommendations rebuild`) from an in-memory CSR copy of the
+follows graph.
+"""
+
+import io
+import logging
+from multiprocessing import get_context
+
+import click
+from flask.cli import AppGroup
+
+from graph import load_following
+from jobs import task
+from models import db, Follows, Recommendation
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATIONS_PER_USER = 20
+
+# bound the 2-hop walk for users (and followees) with huge follow lists
+MAX_FOLLOWING_SCANNED = 200
+MAX_NEIGHBORS_SCANNED = 500
+
+# users per unit of work in a full rebuild
+CHUNK_SIZE = 10000
+
+# set before forking rebuild workers, which inherit it
+_following = None
+
+
+def top_candidates(following, user_id, k=RECOMMENDATIONS_PER_USER):
+    """Best friend-of-friend candidates for `user_id` in the CSR `following`.
+
+    Returns a list of (candidate id, score), best first.
+    """
+
+    import numpy as np
+
+    followed = following.neighbors(user_id)
+
+    if not len(followed):
+        return []
+
+    candidates = np.concatenate([
+        following.neighbors(other)[:MAX_NEIGHBORS_SCANNED]
+        for other in followed[:MAX_FOLLOWING_SCANNED]
+    ])
+
+    # drop the user and the accounts they already follow (`followed` is sorted)
+    positions = np.minimum(np.searchsorted(followed, candidates), len(followed) - 1)
+    keep = (followed[positions] != candidates) & (candidates != user_id)
+    candidates = candidates[keep]
+
+    if not len(candidates):
+        return []
+
+    ids, scores = np.unique(candidates, return_counts=True)
+
+    if len(ids) > k:
+        best = np.argpartition(-scores, k)[:k]
+        ids = ids[best]
+        scores = scores[best]
+
+    order = np.lexsort((ids, -scores))
+
+    return [(int(ids[i]), int(scores[i])) for i in order]
+
+
+def recommend_range(bounds):
+    """Recommendations for users with ids in [start, stop) of `_following`.
+
+    Runs in a rebuild worker. Returns (start, stop, rows).
+    """
+
+    import numpy as np
+
+    start, stop = bounds
+    offsets = _following.offsets[start:stop + 1]
+
+    rows = [
+        (int(user_id), candidate, score)
+        for user_id in np.flatnonzero(np.diff(offsets)) + start
+        for candidate, score in top_candidates(_following, user_id)
+    ]
+
+    return start, stop, rows
+
+
+def write_recommendations(start, stop, rows):
+    """Replace stored recommendations of users with ids in [start, stop)."""
+
+    table = Recommendation.__table__
+    connection = db.session.connection()
+
+    connection.execute(
+        table.delete().where(db.and_(table.c.user_id >= start,
+                                     table.c.user_id < stop)))
+
+    if rows and connection.dialect.name == 'postgresql':
+        # COPY is much faster than INSERT for millions of rows
+        data = io.StringIO(''.join(f"{user_id}\t{candidate}\t{score}\n"
+                                   for user_id, candidate, score in rows))
+        cursor = connection.connection.cursor()
+        cursor.copy_from(data, table.name,
+                         columns=('user_id', 'candidate_id', 'score'))
+
+    elif rows:
+        connection.execute(table.insert(), [
+            dict(user_id=user_id, candidate_id=candidate, score=score)
+            for user_id, candidate, score in rows
+        ])
+
+    db.session.commit()
+
+
+@task(every=24 * 60 * 60)
+def rebuild_recommendations(processes=1):
+    """Recompute and store recommendations for every user.
+
+    Returns the number of recommendations stored.
+    """
+
+    global _following
+
+    _following = load_following()
+    logger.info(f"follows graph loaded: {_following.size} users, "
+                f"{len(_following.targets)} follows, {_following.nbytes} bytes")
+
+    ranges = [(start, min(start + CHUNK_SIZE, _following.size))
+              for start in range(0, _following.size, CHUNK_SIZE)]
+    total = 0
+
+    if processes > 1:
+        # forked workers share the graph arrays with this process
+        pool = get_context('fork').Pool(processes)
+        results = pool.imap_unordered(recommend_range, ranges)
+    else:
+        pool = None
+        results = map(recommend_range, ranges)
+
+    try:
+        for start, stop, rows in results:
+            write_recommendations(start, stop, rows)
+            total += len(rows)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    logger.info(f"{total} recommendations stored")
+    return total
+
+
+def neighbors_scanned(user_id, dialect):
+    """Subquery of the `candidate`s reached from `user_id` in two hops, with
+    the walk bounded as `top_candidates` bounds it: their first
+    `MAX_FOLLOWING_SCANNED` followees, and the first `MAX_NEIGHBORS_SCANNED`
+    accounts each of those follows.
+
+    On Postgres a LATERAL subquery reads each followee's follows only as far
+    as the limit; elsewhere they're numbered with a window function.
+    """
+
+    follows = Follows.__table__
+    theirs = follows.alias('theirs')
+
+    followed = (db.select([follows.c.user_being_followed_id.label('id')])
+                .where(follows.c.user_following_id == user_id)
+                .order_by(follows.c.user_being_followed_id)
+                .limit(MAX_FOLLOWING_SCANNED)
+                .alias('followed'))
+
+    if dialect == 'postgresql':
+        neighbors = (db.select([theirs.c.user_being_followed_id.label('candidate')])
+                     .where(theirs.c.user_following_id == followed.c.id)
+                     .order_by(theirs.c.user_being_followed_id)
+                     .limit(MAX_NEIGHBORS_SCANNED)
+                     .lateral('neighbors'))
+
+        return (db.select([neighbors.c.candidate])
+                .select_from(followed.join(neighbors, db.true()))
+                .alias('scanned'))
+
+    rank = (db.func.row_number()
+            .over(partition_by=theirs.c.user_following_id,
+                  order_by=theirs.c.user_being_followed_id)
+            .label('rank'))
+
+    ranked = (db.select([theirs.c.user_being_followed_id.label('candidate'), rank])
+              .where(theirs.c.user_following_id.in_(db.select([followed.c.id])))
+              .alias('ranked'))
+
+    return (db.select([ranked.c.candidate])
+            .where(ranked.c.rank <= MAX_NEIGHBORS_SCANNED)
+            .alias('scanned'))
+
+
+@task
+def refresh_recommendations(user_id, k=RECOMMENDATIONS_PER_USER):
+    """Recompute and store recommendations for one user, in SQL.
+
+    The walk is bounded like the full rebuild's (see `neighbors_scanned`),
+    so users following, or followed by, huge lists stay cheap.
+    """
+
+    follows = Follows.__table__
+    already = follows.alias('already')
+    scanned = neighbors_scanned(user_id, db.session.get_bind().dialect.name)
+
+    already_following = (db.exists()
+                         .where(db.and_(
+                             already.c.user_following_id == user_id,
+                             already.c.user_being_followed_id == scanned.c.candidate)))
+
+    score = db.func.count().label('score')
+    candidates = db.session.execute(
+        db.select([scanned.c.candidate, score])
+        .where(db.and_(scanned.c.candidate != user_id, ~already_following))
+        .group_by(scanned.c.candidate)
+        .order_by(score.desc(), scanned.c.candidate)
+        .limit(k)).fetchall()
+
+    write_recommendations(user_id, user_id + 1, [
+        (user_id, candidate, score) for candidate, score in candidates
+    ])
+
+
+recommendations_cli = AppGroup('recommendations',
+                               help="Manage 'who to follow' recommendations.")
+
+
+@recommendations_cli.command('rebuild')
+@click.option('--processes', default=1, help="Number of worker processes.")
+def rebuild_command(processes):
+    """Recompute recommendations for every user."""
+
+    click.echo(f"{rebuild_recommendations(processes)} recommendations stored")
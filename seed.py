@@ -1,8 +1,18 @@
 """Seed database with sample data from CSV Files."""
 
+import os
 from csv import DictReader
+from datetime import datetime
+
+# seeding is the only process running
+os.environ.setdefault('SNOWFLAKE_WORKER_ID', '0')
+
 from app import db
+from feed import fill_high_water_marks
+from tags import backfill_tags
 from models import User, Message, Follows
+from partitions import ensure_partitions, month_of
+from snowflake import make_id, ms_at, timestamp_of
 
 
 db.drop_all()
@@ -11,10 +21,25 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+
+def with_id(index, message):
+    """A CSV message with an id made from its timestamp."""
+
+    timestamp = datetime.fromisoformat(message['timestamp'])
+    return dict(message, id=make_id(ms_at(timestamp), 0, index & 4095))
+
+
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    messages = [with_id(i, message) for i, message in enumerate(DictReader(messages))]
+
+# the sample messages go back years
+ensure_partitions(month_of(min(timestamp_of(message['id']) for message in messages)))
+db.session.bulk_insert_mappings(Message, messages)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
 db.session.commit()
+
+fill_high_water_marks()
+backfill_tags()
@@ -0,0 +1,43 @@
+"""Serve Warbler from one gevent process, for live timelines.
+
+    (venv) $ pip install gevent
+    (venv) $ python serve_async.py --port 5000
+
+Every open /stream is a greenlet waiting on its subscription rather than a
+thread, so one process holds thousands of them. Posts must reach the same
+process to be streamed with the default `pubsub.LocalBroker`. The same
+works under gunicorn with `-k gevent --worker-connections 10000 -w 1`.
+
+If psycogreen is installed, psycopg2 is made to wait on the database
+cooperatively too; without it a slow query blocks every connection.
+"""
+
+from gevent import monkey
+
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    pass
+
+import argparse
+
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"serving on http://{args.host}:{args.port}")
+    WSGIServer((args.host, args.port), app).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,778 @@
+"""Messages and likes spread over several databases by user id.
+
+With `SHARD_URLS` set (database URLs, comma-separated in the environment),
+each user's messages, and the likes they give, live on one of those
+databases: the user's shard. Users, follows, timelines and everything else
+stay in the main database. Without it there is one shard, the main
+database, read and written through the app's session.
+
+A user id falls in one of `BUCKETS` buckets (user id % BUCKETS), and the
+`shard_buckets` table in the main database says which shard holds each
+bucket (`flask shards init` fills it in, bucket % number of shards).
+`flask shards rebalance` evens out the shards by moving whole buckets. A
+bucket being moved is marked `moving` first, and once every worker has seen
+that (the bucket map's TTL), its users' writes are refused with a 503 until
+the move is done: its rows are copied to the new shard, rows deleted from
+the old one meanwhile (likes going with a deleted message) are deleted from
+the copy, the bucket is pointed at the new shard and, once every worker
+reads from there, the old rows are deleted.
+
+Everything the app reads or writes about messages and likes goes through
+`router`. Reads for one author go to one shard; reads across authors or by
+message id alone (a home page's followed accounts, a linked message) query
+every shard involved at the same time, from a thread pool, and are merged.
+Writes to a shard are committed right away, apart from the main database's
+transaction; with one shard they're part of it.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import click
+from flask import Response
+from flask.cli import AppGroup
+from sqlalchemy import create_engine
+
+from models import db, read_rows, Likes, Message, ShardBucket, User
+from snowflake import next_id, timestamp_of
+from statements import Statement
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = 1024
+
+# how long a worker keeps the bucket -> shard map
+BUCKET_MAP_TTL = 60
+
+# seconds clients are told to wait when their bucket is moving
+MOVING_RETRY_AFTER = 30
+
+# rows copied per statement when a bucket moves
+MOVE_BATCH = 1000
+
+# authors per query when looking up their newest messages
+AUTHORS_PER_QUERY = 100
+
+class BucketMovingError(Exception):
+    """A write for a user whose bucket is being moved to another shard."""
+
+
+RecentMessage = namedtuple('RecentMessage', ['id', 'text', 'timestamp', 'user_id'])
+
+LikedMessage = namedtuple('LikedMessage', ['id', 'text', 'timestamp', 'user_id',
+                                           'username', 'image_url', 'likes'])
+
+
+def insert_ignoring_duplicates(table, bind=None):
+    """INSERT into `table` that skips rows whose key is already there."""
+
+    bind = bind or db.session.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def shard_metadata():
+    """The messages and likes tables for shard databases.
+
+    Copies of the models' tables without foreign keys, since the users
+    they point at are in the main database.
+    """
+
+    metadata = db.MetaData()
+
+    for table in (Message.__table__, Likes.__table__):
+        copy = db.Table(table.name, metadata, *(
+            db.Column(column.name, column.type, primary_key=column.primary_key,
+                      nullable=column.nullable, unique=column.unique,
+                      autoincrement=column.autoincrement)
+            for column in table.columns))
+
+        for index in table.indexes:
+            db.Index(index.name, *(copy.c[column.name] for column in index.columns),
+                     unique=index.unique)
+
+    return metadata
+
+
+class ShardRouter:
+    """Finds the database of a user's messages and likes, and queries it."""
+
+    def __init__(self, urls=(), bucket_map_ttl=BUCKET_MAP_TTL):
+        self.bucket_map_ttl = bucket_map_ttl
+        self.lock = threading.Lock()
+        self.configure(urls)
+
+    def configure(self, urls):
+        """Use the databases at `urls` as the shards; none for the main one."""
+
+        self.engines = [create_engine(url) for url in urls]
+        self.sharded = bool(self.engines)
+
+        metadata = shard_metadata() if self.sharded else db.metadata
+        self.messages = metadata.tables['messages']
+        self.likes = metadata.tables['likes']
+        self.statements = self.hot_statements()
+
+        self.map = None
+        self.moving = frozenset()
+        self.map_expires = 0
+
+        self.pool = (ThreadPoolExecutor(max_workers=len(self.engines))
+                     if len(self.engines) > 1 else None)
+
+    @property
+    def shards(self):
+        return range(max(len(self.engines), 1))
+
+    def create_tables(self):
+        """Create the messages and likes tables on every shard."""
+
+        for engine in self.engines:
+            self.messages.metadata.create_all(engine)
+
+    def bucket_map(self):
+        """{bucket: shard}, as this worker last loaded it."""
+
+        now = time.monotonic()
+
+        with self.lock:
+            if self.map is not None and now < self.map_expires:
+                return self.map
+
+        rows = db.session.query(ShardBucket.bucket, ShardBucket.shard, ShardBucket.moving).all()
+        mapping = {bucket: shard for bucket, shard, _ in rows}
+
+        with self.lock:
+            self.map = mapping
+            self.moving = frozenset(bucket for bucket, _, moving in rows if moving)
+            self.map_expires = now + self.bucket_map_ttl
+
+        return mapping
+
+    def forget_bucket_map(self):
+        with self.lock:
+            self.map = None
+
+    def shard_of_bucket(self, bucket):
+        return self.bucket_map().get(bucket, bucket % len(self.shards))
+
+    def shard_of(self, user_id):
+        """The shard holding `user_id`'s messages and likes."""
+
+        if not self.sharded:
+            return 0
+
+        return self.shard_of_bucket(user_id % BUCKETS)
+
+    def writable_shard_of(self, user_id):
+        """The shard to write `user_id`'s messages and likes to.
+
+        Raises `BucketMovingError` while their bucket is being moved.
+        """
+
+        shard = self.shard_of(user_id)
+
+        if self.sharded and user_id % BUCKETS in self.moving:
+            raise BucketMovingError(f"bucket {user_id % BUCKETS} is moving")
+
+        return shard
+
+    def by_shard(self, user_ids):
+        """{shard: [user ids on it]}."""
+
+        groups = {}
+
+        for user_id in user_ids:
+            groups.setdefault(self.shard_of(user_id), []).append(user_id)
+
+        return groups
+
+    @contextmanager
+    def connect(self, shard):
+        """A connection to `shard`, in a transaction committed at the end.
+
+        With one shard, the app's session, left for the caller to commit.
+        """
+
+        if not self.sharded:
+            yield db.session
+            return
+
+        with self.engines[shard].begin() as connection:
+            yield connection
+
+    def each_shard(self, func, args):
+        """{shard: func(connection, arg)} for each shard: arg in `args`.
+
+        The shards are queried at the same time.
+        """
+
+        def call(shard, arg):
+            with self.connect(shard) as connection:
+                return func(connection, arg)
+
+        if self.pool is None or len(args) == 1:
+            return {shard: call(shard, arg) for shard, arg in args.items()}
+
+        futures = {shard: self.pool.submit(call, shard, arg) for shard, arg in args.items()}
+
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def hot_statements(self):
+        """The `Statement`s behind every page, on this configuration's tables."""
+
+        messages = self.messages
+        likes = self.likes
+        ids = db.bindparam('ids', expanding=True)
+        user_id = db.bindparam('user_id')
+        message_id = db.bindparam('message_id')
+
+        return dict(
+            find_messages=Statement(self.select_messages().where(messages.c.id.in_(ids))),
+            liked_ids=Statement(
+                db.select([likes.c.message_id])
+                .where(likes.c.user_id == user_id)
+                .order_by(likes.c.message_id.desc()),
+                'liked_ids'),
+            like_counts=Statement(
+                db.select([likes.c.message_id, db.func.count()])
+                .where(likes.c.message_id.in_(ids))
+                .group_by(likes.c.message_id)),
+            like=Statement(likes.insert().values(user_id=user_id, message_id=message_id)),
+            unlike=Statement(
+                likes.delete().where(db.and_(likes.c.user_id == user_id,
+                                             likes.c.message_id == message_id))),
+            count_messages=Statement(
+                db.select([db.func.count()]).where(messages.c.user_id == user_id),
+                'shard_messages_count'),
+            count_likes=Statement(
+                db.select([db.func.count()]).where(likes.c.user_id == user_id),
+                'shard_likes_count'),
+        )
+
+    def select_messages(self):
+        messages = self.messages
+
+        return db.select([messages.c.id, messages.c.text,
+                          messages.c.timestamp, messages.c.user_id])
+
+    def add_message(self, user_id, text):
+        """Post a message; returns it as a `RecentMessage`."""
+
+        id = next_id()
+        message = RecentMessage(id, text, timestamp_of(id), user_id)
+
+        with self.connect(self.writable_shard_of(user_id)) as connection:
+            connection.execute(self.messages.insert(), message._asdict())
+
+        return message
+
+    def author_messages(self, author_id, before_id=None, limit=None):
+        """An author's messages (older than `before_id`), newest first."""
+
+        messages = self.messages
+        query = (self.select_messages()
+                 .where(messages.c.user_id == author_id)
+                 .order_by(messages.c.id.desc())
+                 .limit(limit))
+
+        if before_id is not None:
+            query = query.where(messages.c.id < before_id)
+
+        with self.connect(self.shard_of(author_id)) as connection:
+            return [RecentMessage(*row) for row in connection.execute(query)]
+
+    def latest_message_ids(self, author_ids):
+        """[(author id, id of their newest message)] of authors who have posted.
+
+        One index lookup per author.
+        """
+
+        messages = self.messages
+
+        def latest(connection, author_ids):
+            rows = []
+
+            for start in range(0, len(author_ids), AUTHORS_PER_QUERY):
+                rows.extend(connection.execute(db.union_all(*(
+                    db.select([db.literal(author_id), db.func.max(messages.c.id)])
+                    .where(messages.c.user_id == author_id)
+                    for author_id in author_ids[start:start + AUTHORS_PER_QUERY]))))
+
+            return [(author_id, message_id) for author_id, message_id in rows
+                    if message_id is not None]
+
+        return [row for rows in self.each_shard(latest, self.by_shard(author_ids)).values()
+                for row in rows]
+
+    def message_ids_after(self, author_ids, after_id, limit):
+        """Ids of the newest `limit` messages of `author_ids` newer than
+        `after_id`, newest first. One query per shard involved."""
+
+        messages = self.messages
+
+        def newer(connection, author_ids):
+            return [id for (id,) in connection.execute(
+                db.select([messages.c.id])
+                .where(db.and_(messages.c.user_id.in_(author_ids), messages.c.id > after_id))
+                .order_by(messages.c.id.desc())
+                .limit(limit))]
+
+        results = self.each_shard(newer, self.by_shard(author_ids))
+
+        return sorted((id for ids in results.values() for id in ids), reverse=True)[:limit]
+
+    def fetch_messages(self, entries):
+        """{id: `RecentMessage`} of the (message id, author id) `entries`.
+
+        Deleted messages are left out.
+        """
+
+        ids_by_shard = {}
+
+        for message_id, author_id in entries:
+            ids_by_shard.setdefault(self.shard_of(author_id), []).append(message_id)
+
+        def fetch(connection, ids):
+            return self.statements['find_messages'].execute(connection, ids=ids).fetchall()
+
+        return {row.id: RecentMessage(*row)
+                for rows in self.each_shard(fetch, ids_by_shard).values() for row in rows}
+
+    def find_messages(self, message_ids):
+        """{id: `RecentMessage`} of messages known only by id, from every shard."""
+
+        if not message_ids:
+            return {}
+
+        def find(connection, ids):
+            return self.statements['find_messages'].execute(connection, ids=ids).fetchall()
+
+        results = self.each_shard(find, {shard: list(message_ids) for shard in self.shards})
+
+        return {row.id: RecentMessage(*row) for rows in results.values() for row in rows}
+
+    def find_message(self, message_id):
+        """A message known only by id, as a `RecentMessage`, or None."""
+
+        return self.find_messages([message_id]).get(message_id)
+
+    def delete_message(self, message):
+        """Delete a message, and the likes on it on every shard."""
+
+        likes = self.likes
+
+        with self.connect(self.writable_shard_of(message.user_id)) as connection:
+            connection.execute(self.messages.delete().where(self.messages.c.id == message.id))
+
+        def unlike(connection, _):
+            connection.execute(likes.delete().where(likes.c.message_id == message.id))
+
+        self.each_shard(unlike, dict.fromkeys(self.shards))
+
+    def toggle_like(self, user_id, message_id):
+        """Like a message, or unlike it if liked. Returns whether it's liked now."""
+
+        with self.connect(self.writable_shard_of(user_id)) as connection:
+            if self.statements['unlike'].execute(
+                    connection, user_id=user_id, message_id=message_id).rowcount:
+                return False
+
+            self.statements['like'].execute(connection, user_id=user_id, message_id=message_id)
+            return True
+
+    def liked_ids(self, user_id):
+        """Ids of the messages `user_id` likes, newest first."""
+
+        with self.connect(self.shard_of(user_id)) as connection:
+            return [message_id for (message_id,) in
+                    self.statements['liked_ids'].execute(connection, user_id=user_id)]
+
+    def liked_messages(self, user, yield_per=None):
+        """The messages `user` likes, newest first, with their authors.
+
+        `LikedMessage`s: see `User.liked_messages`, and `read_rows` for
+        `yield_per`. The likes of each batch of `yield_per` messages are
+        counted as it's read, so a long history isn't counted before the
+        first row goes out.
+        """
+
+        def batches():
+            if not self.sharded:
+                query = user.liked_messages()
+
+                if not yield_per:
+                    yield db.session.execute(query).fetchall()
+                    return
+
+                result = db.session.execute(query.execution_options(stream_results=True))
+                yield from iter(lambda: result.fetchmany(yield_per), [])
+                return
+
+            ids = self.liked_ids(user.id)
+            size = yield_per or len(ids)
+
+            for start in range(0, len(ids), size):
+                chunk = ids[start:start + size]
+                messages = self.find_messages(chunk)
+
+                authors = {id: (username, image_url) for id, username, image_url in (db.session
+                           .query(User.id, User.username, User.image_url)
+                           .filter(User.id.in_({message.user_id for message in messages.values()}),
+                                   User.deleted_at.is_(None)))} if messages else {}
+
+                yield [(*messages[id], *authors[messages[id].user_id]) for id in chunk
+                       if id in messages and messages[id].user_id in authors]
+
+        def rows():
+            for batch in batches():
+                counts = self.like_counts([row[0] for row in batch])
+                yield from (LikedMessage(*row, counts[row[0]]) for row in batch)
+
+        return rows() if yield_per else list(rows())
+
+    def like_counts(self, message_ids):
+        """A `Counter` of the likes of each of `message_ids`, for a page of
+        message cards.
+
+        One grouped query per shard on the likes' message index; no list of
+        likers is loaded.
+        """
+
+        if not message_ids:
+            return Counter()
+
+        def count(connection, ids):
+            return self.statements['like_counts'].execute(connection, ids=ids).fetchall()
+
+        counts = Counter()
+
+        for rows in self.each_shard(count, {shard: list(message_ids)
+                                            for shard in self.shards}).values():
+            for message_id, likes_count in rows:
+                counts[message_id] += likes_count
+
+        return counts
+
+    def count_messages(self, user_id):
+        with self.connect(self.shard_of(user_id)) as connection:
+            return self.statements['count_messages'].execute(
+                connection, user_id=user_id).scalar()
+
+    def count_likes(self, user_id):
+        with self.connect(self.shard_of(user_id)) as connection:
+            return self.statements['count_likes'].execute(
+                connection, user_id=user_id).scalar()
+
+    def delete_messages_of(self, user_id, batch_size=MOVE_BATCH):
+        """Delete a user's messages, and others' likes on them on every
+        shard, `batch_size` messages at a time.
+
+        Every batch is its own transaction on each shard. Yields the running
+        total of deleted messages after every batch; raises
+        `BucketMovingError` if the user's bucket starts moving.
+        """
+
+        messages = self.messages
+        likes = self.likes
+
+        def unlike(connection, ids):
+            connection.execute(likes.delete().where(likes.c.message_id.in_(ids)))
+
+        total = 0
+
+        while True:
+            with self.connect(self.writable_shard_of(user_id)) as connection:
+                ids = [id for (id,) in connection.execute(
+                    db.select([messages.c.id])
+                    .where(messages.c.user_id == user_id)
+                    .limit(batch_size))]
+
+            if not ids:
+                return
+
+            self.each_shard(unlike, dict.fromkeys(self.shards, ids))
+
+            with self.connect(self.writable_shard_of(user_id)) as connection:
+                connection.execute(messages.delete().where(messages.c.id.in_(ids)))
+
+            total += len(ids)
+            yield total
+
+    def init_buckets(self):
+        """Map every unmapped bucket to a shard. Returns how many were."""
+
+        mapped = set(self.bucket_map())
+        rows = [dict(bucket=bucket, shard=bucket % len(self.shards))
+                for bucket in range(BUCKETS) if bucket not in mapped]
+
+        if rows:
+            db.session.execute(ShardBucket.__table__.insert(), rows)
+
+        db.session.commit()
+        self.forget_bucket_map()
+
+        return len(rows)
+
+    def bucket_rows(self):
+        """{bucket: (shard, rows of messages and likes)} of non-empty buckets."""
+
+        def count(connection, shard):
+            counts = {}
+
+            for table in (self.messages, self.likes):
+                bucket = (table.c.user_id % BUCKETS).label('bucket')
+
+                for bucket, rows in connection.execute(
+                        db.select([bucket, db.func.count()]).group_by(bucket)):
+                    counts[bucket] = counts.get(bucket, 0) + rows
+
+            return counts
+
+        result = {}
+
+        for shard, counts in self.each_shard(count, {shard: shard for shard in self.shards}).items():
+            for bucket, rows in counts.items():
+                # rows left behind on a shard the bucket has moved from
+                # don't count
+                if self.shard_of_bucket(bucket) == shard:
+                    result[bucket] = (shard, rows)
+
+        return result
+
+    def copy_bucket(self, bucket, source, target):
+        """Copy a bucket's rows from one shard to another; rows already
+        there are skipped."""
+
+        for table in (self.messages, self.likes):
+            key = table.c.id
+            last = None
+
+            while True:
+                query = (table.select()
+                         .where(table.c.user_id % BUCKETS == bucket)
+                         .order_by(key)
+                         .limit(MOVE_BATCH))
+
+                if last is not None:
+                    query = query.where(key > last)
+
+                with self.connect(source) as connection:
+                    rows = [dict(row) for row in connection.execute(query)]
+
+                if not rows:
+                    break
+
+                last = rows[-1]['id']
+
+                if table is self.likes:
+                    # like ids are per shard
+                    for row in rows:
+                        del row['id']
+
+                with self.connect(target) as connection:
+                    connection.execute(
+                        insert_ignoring_duplicates(table, connection), rows)
+
+    def bucket_keys(self, shard, table, bucket):
+        """Keys of a bucket's rows of `table` on `shard`: message ids, or
+        (user id, message id) of likes, whose ids are per shard."""
+
+        columns = [table.c.id] if table is self.messages else [table.c.user_id,
+                                                               table.c.message_id]
+
+        with self.connect(shard) as connection:
+            return {tuple(row) for row in connection.execute(
+                db.select(columns).where(table.c.user_id % BUCKETS == bucket))}
+
+    def drop_missing(self, bucket, source, target):
+        """Delete a bucket's rows from `target` that `source` no longer has.
+
+        Returns the number of rows deleted.
+        """
+
+        deleted = 0
+
+        for table in (self.likes, self.messages):
+            gone = sorted(self.bucket_keys(target, table, bucket)
+                          - self.bucket_keys(source, table, bucket))
+
+            if not gone:
+                continue
+
+            if table is self.messages:
+                where = table.c.id == db.bindparam('key_id')
+                keys = [dict(key_id=id) for (id,) in gone]
+            else:
+                where = db.and_(table.c.user_id == db.bindparam('key_user_id'),
+                                table.c.message_id == db.bindparam('key_message_id'))
+                keys = [dict(key_user_id=user_id, key_message_id=message_id)
+                        for user_id, message_id in gone]
+
+            with self.connect(target) as connection:
+                connection.execute(table.delete().where(where), keys)
+
+            deleted += len(gone)
+
+        return deleted
+
+    def set_bucket(self, bucket, shard, moving=False):
+        db.session.merge(ShardBucket(bucket=bucket, shard=shard, moving=moving))
+        db.session.commit()
+        self.forget_bucket_map()
+
+    def move_bucket(self, bucket, target, settle=None):
+        """Move a bucket of users to the `target` shard.
+
+        Workers see changes to the bucket map once theirs expires, so this
+        waits `settle` seconds (the map's TTL) after marking the bucket
+        moving, before copying its rows (no worker writes them anymore), and
+        after pointing it at the new shard, before deleting the old rows (no
+        worker reads them anymore).
+        """
+
+        source = self.shard_of_bucket(bucket)
+
+        if source == target:
+            return
+
+        settle = self.bucket_map_ttl if settle is None else settle
+
+        self.set_bucket(bucket, source, moving=True)
+        time.sleep(settle)
+
+        try:
+            self.copy_bucket(bucket, source, target)
+
+            # likes deleted with their message on the old shard meanwhile,
+            # or rows deleted since an earlier, failed move
+            self.drop_missing(bucket, source, target)
+        except Exception:
+            self.set_bucket(bucket, source)
+            raise
+
+        self.set_bucket(bucket, target)
+        time.sleep(settle)
+
+        with self.connect(source) as connection:
+            for table in (self.likes, self.messages):
+                connection.execute(table.delete().where(table.c.user_id % BUCKETS == bucket))
+
+        logger.info(f"bucket {bucket} moved from shard {source} to {target}")
+
+
+def plan_moves(bucket_rows, shards):
+    """Bucket moves that even out the rows per shard.
+
+    `bucket_rows` is {bucket: (shard, rows)}. Greedy: moves the biggest
+    bucket of the fullest shard that fits in half the gap to the emptiest
+    one, until none does. Returns [(bucket, from shard, to shard)].
+    """
+
+    placed = dict(bucket_rows)
+    totals = dict.fromkeys(shards, 0)
+
+    for shard, rows in placed.values():
+        totals[shard] += rows
+
+    moves = []
+
+    while True:
+        fullest = max(totals, key=totals.get)
+        emptiest = min(totals, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+
+        fits = [(rows, bucket) for bucket, (shard, rows) in placed.items()
+                if shard == fullest and 0 < rows * 2 <= gap]
+
+        if not fits:
+            return moves
+
+        rows, bucket = max(fits)
+        placed[bucket] = (emptiest, rows)
+        totals[fullest] -= rows
+        totals[emptiest] += rows
+        moves.append((bucket, fullest, emptiest))
+
+
+router = ShardRouter()
+
+
+def init_shards(app):
+    """Route messages and likes to the databases of the app config's
+    `SHARD_URLS`, if set."""
+
+    urls = app.config.get('SHARD_URLS') or []
+
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+
+    router.configure(urls)
+    User.shard_router = router if router.sharded else None
+
+    app.register_error_handler(BucketMovingError, bucket_moving)
+
+
+def bucket_moving(error):
+    """Tell a client whose data is being moved to try again shortly."""
+
+    return Response(f"Your data is being moved. Try again in {MOVING_RETRY_AFTER} seconds.\n",
+                    503, {'Retry-After': str(MOVING_RETRY_AFTER)}, mimetype='text/plain')
+
+
+shards_cli = AppGroup('shards', help="Messages and likes spread over databases.")
+
+
+@shards_cli.command('init')
+def init_command():
+    """Create the shards' tables and map the buckets to them."""
+
+    router.create_tables()
+    click.echo(f"{router.init_buckets()} buckets mapped to {len(router.shards)} shards")
+
+
+@shards_cli.command('stats')
+def stats_command():
+    """Show the rows and buckets on each shard."""
+
+    totals = {shard: [0, 0] for shard in router.shards}
+
+    for shard, rows in router.bucket_rows().values():
+        totals[shard][0] += 1
+        totals[shard][1] += rows
+
+    for shard, (buckets, rows) in totals.items():
+        click.echo(f"shard {shard}: {rows} rows in {buckets} non-empty buckets")
+
+
+@shards_cli.command('move')
+@click.argument('bucket', type=int)
+@click.argument('shard', type=int)
+def move_command(bucket, shard):
+    """Move a bucket of users to a shard."""
+
+    router.move_bucket(bucket, shard)
+
+
+@shards_cli.command('rebalance')
+@click.option('--dry-run', is_flag=True, help="Only show the moves.")
+def rebalance_command(dry_run):
+    """Move buckets until the shards hold about the same rows."""
+
+    moves = plan_moves(router.bucket_rows(), router.shards)
+
+    for bucket, source, target in moves:
+        click.echo(f"bucket {bucket}: shard {source} -> {target}")
+
+        if not dry_run:
+            router.move_bucket(bucket, target)
+
+    click.echo(f"{len(moves)} buckets {'to move' if dry_run else 'moved'}")
@@ -0,0 +1,193 @@
+"""Time-ordered 64-bit ids for messages.
+
+An id is, from the high bits down:
+
+- 41 bits: milliseconds since `EPOCH` (good for about 69 years)
+- 10 bits: the id of the process that made it
+- 12 bits: a sequence number within the millisecond
+
+so ids made anywhere sort by the time they were made, without asking the
+database for the next one, and the newest messages are the ones with the
+highest ids. `timestamp_of` gives an id's time back; `min_id_at` turns a
+time into an id bound for queries and cursors.
+
+Processes running at the same time must not share a worker id. Each host
+(or container) gets a range of `SNOWFLAKE_WORKERS` ids starting at
+`SNOWFLAKE_WORKER_ID`, and each process on it leases the lowest id of the
+range no other live process holds, by locking a file named after it in
+`SNOWFLAKE_LOCK_DIR`. The lock goes away with the process, and a forked
+process leases its own id, so gunicorn workers forked from one master don't
+share one. Ranges of different hosts must not overlap. Outside debug and
+testing the app refuses to start without `SNOWFLAKE_WORKER_ID`, since two
+hosts would then use the same ids.
+"""
+
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2015, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# worker ids per host, for as many processes running at once
+WORKERS = 16
+
+LOCK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var', 'snowflake')
+
+
+class WorkerIdError(RuntimeError):
+    """No worker id can be had for this process."""
+
+
+class IdGenerator:
+    """Makes unique, increasing ids in one process.
+
+    Uses `worker_id` if given, else leases one of the range set with
+    `configure`.
+    """
+
+    def __init__(self, worker_id=None, clock=time.time):
+        self.worker_id = worker_id
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pid = None
+        self.last_ms = -1
+        self.sequence = 0
+        self.first_worker = None
+        self.workers = WORKERS
+        self.lock_dir = LOCK_DIR
+        self.lease = None
+
+    def configure(self, first_worker, workers=WORKERS, lock_dir=LOCK_DIR):
+        """Lease worker ids from `first_worker` to `first_worker + workers - 1`."""
+
+        if not 0 <= first_worker <= first_worker + workers - 1 <= MAX_WORKER:
+            raise WorkerIdError(f"worker ids {first_worker} to {first_worker + workers - 1} "
+                                f"aren't all between 0 and {MAX_WORKER}")
+
+        with self.lock:
+            self.first_worker = first_worker
+            self.workers = workers
+            self.lock_dir = lock_dir
+            self.pid = None
+
+    def worker(self):
+        """This process's worker id, chosen again after a fork."""
+
+        if self.pid != os.getpid():
+            if self.worker_id is None:
+                self.current_worker = self.lease_worker()
+            else:
+                self.current_worker = self.worker_id & MAX_WORKER
+
+            self.pid = os.getpid()
+            self.last_ms = -1
+
+        return self.current_worker
+
+    def lease_worker(self):
+        """The lowest worker id of the range not held by a live process."""
+
+        if self.first_worker is None:
+            raise WorkerIdError("no worker ids to lease: set SNOWFLAKE_WORKER_ID")
+
+        if self.lease:
+            # after a fork, the parent's: closing our copy leaves it the
+            # parent's lock
+            self.lease.close()
+            self.lease = None
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+        for worker in range(self.first_worker, self.first_worker + self.workers):
+            lease = open(os.path.join(self.lock_dir, f"{worker}.lock"), 'w')
+
+            try:
+                fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lease.close()
+                continue
+
+            self.lease = lease
+            return worker
+
+        raise WorkerIdError(f"worker ids {self.first_worker} to "
+                            f"{self.first_worker + self.workers - 1} are all taken")
+
+    def __call__(self):
+        with self.lock:
+            worker = self.worker()
+            ms = int(self.clock() * 1000) - EPOCH_MS
+
+            if ms < self.last_ms:
+                # the clock went back: keep counting from the last time
+                ms = self.last_ms
+
+            if ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+
+                if self.sequence == 0:
+                    # 4096 ids this millisecond: wait for the next one
+                    while ms <= self.last_ms:
+                        ms = int(self.clock() * 1000) - EPOCH_MS
+            else:
+                self.sequence = 0
+
+            self.last_ms = ms
+
+            return make_id(ms, worker, self.sequence)
+
+
+def make_id(ms, worker=0, sequence=0):
+    """The id of the `sequence`th id of `worker` at `ms` after EPOCH."""
+
+    return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence
+
+
+def ms_at(when):
+    """Milliseconds from EPOCH to the naive UTC datetime `when`."""
+
+    return (when - EPOCH) // timedelta(milliseconds=1)
+
+
+def min_id_at(when):
+    """The smallest id made at or after `when`."""
+
+    return make_id(ms_at(when))
+
+
+def timestamp_of(id):
+    """When `id` was made, as a naive UTC datetime."""
+
+    return EPOCH + timedelta(milliseconds=id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+next_id = IdGenerator()
+
+
+def init_snowflake(app):
+    """Set the worker ids this host leases from the app config.
+
+    Refuses to start without `SNOWFLAKE_WORKER_ID` unless debugging or
+    testing, when the whole range is this host's.
+    """
+
+    first_worker = app.config.get('SNOWFLAKE_WORKER_ID')
+    workers = app.config.get('SNOWFLAKE_WORKERS', WORKERS)
+
+    if first_worker is None:
+        if not (app.debug or app.testing):
+            raise WorkerIdError("set SNOWFLAKE_WORKER_ID, the first worker id of this "
+                                "host's range, so message ids can't collide")
+
+        first_worker, workers = 0, MAX_WORKER + 1
+
+    next_id.configure(first_worker, workers, app.config.get('SNOWFLAKE_LOCK_DIR', LOCK_DIR))
@@ -0,0 +1,86 @@
+"""Hot queries, built and compiled once.
+
+The queries behind nearly every page (loading the logged-in user, the
+profile and home page counts, follows and like checks, a home timeline)
+used to be built as Query objects and compiled to SQL on every call, which
+shows up in profiles next to the queries themselves. They're defined once
+instead, as `Statement`s: Core statements with bind parameters, run with a
+shared compiled cache so only the parameters change per call. The ORM
+lookups that need entities (see `models.User.find`) are baked queries,
+cached the same way.
+
+On Postgres, with `PREPARED_STATEMENTS` set, named statements are also
+prepared on the server, once per connection (PREPARE, then EXECUTE), so
+they're parsed and planned once too. Leave it off behind a pooler that
+hands out connections per transaction, such as PgBouncer in transaction
+mode: a statement prepared on one server connection doesn't exist on the
+next.
+"""
+
+from sqlalchemy.engine import Connection
+
+# compiled forms of every `Statement`, per dialect and parameter names
+compiled_cache = {}
+
+# prepare named statements on Postgres servers (see `init_statements`)
+PREPARED = False
+
+
+class Statement:
+    """A Core statement to run many times with different parameters.
+
+    `name` (an SQL identifier) lets it be prepared on Postgres; statements
+    with expanding (IN list) parameters can't be.
+    """
+
+    def __init__(self, query, name=None):
+        self.query = query
+        self.name = name
+        self.positional = None
+
+    def execute(self, connection, **params):
+        """Run with `params` on a `Connection`, or in a session's transaction."""
+
+        if not isinstance(connection, Connection):
+            connection = connection.connection()
+
+        if PREPARED and self.name and connection.dialect.name == 'postgresql':
+            return self.execute_prepared(connection, params)
+
+        return connection.execution_options(compiled_cache=compiled_cache).execute(
+            self.query, params)
+
+    def prepared_sql(self, dialect):
+        """(SQL with $1, $2... placeholders, parameter names in order)."""
+
+        if self.positional is None:
+            compiled = self.query.compile(dialect=type(dialect)(paramstyle='format'))
+            names = compiled.positiontup
+            sql = str(compiled) % tuple(f"${number}" for number in range(1, len(names) + 1))
+            self.positional = (sql, names)
+
+        return self.positional
+
+    def execute_prepared(self, connection, params):
+        sql, names = self.prepared_sql(connection.dialect)
+
+        # kept with the pooled DBAPI connection, which outlives checkouts
+        prepared = connection.connection.info.setdefault('prepared_statements', set())
+
+        if self.name not in prepared:
+            connection.execute(f"PREPARE {self.name} AS {sql}")
+            prepared.add(self.name)
+
+        if not names:
+            return connection.execute(f"EXECUTE {self.name}")
+
+        return connection.execute(f"EXECUTE {self.name} ({', '.join(['%s'] * len(names))})",
+                                  tuple(params[name] for name in names))
+
+
+def init_statements(app):
+    """Turn server-side prepared statements on if the app config says so."""
+
+    global PREPARED
+
+    PREPARED = bool(app.config.get('PREPARED_STATEMENTS'))
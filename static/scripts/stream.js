@@ -0,0 +1,25 @@
+// Live home timeline: the ids of new messages from followed accounts arrive
+// over /stream (server-sent events); fetch just their cards and put them at
+// the top of the list. Ids are strings, since they don't fit in a number.
+
+(function () {
+  var list = document.getElementById('messages');
+
+  if (!list || !window.EventSource) {
+    return;
+  }
+
+  var source = new EventSource('/stream');
+
+  source.addEventListener('messages', function (event) {
+    var ids = JSON.parse(event.data).filter(function (id) {
+      return !list.querySelector('[data-message-id="' + id + '"]');
+    });
+
+    if (ids.length) {
+      $.get('/messages/cards', { ids: ids.join(',') }, function (html) {
+        $(list).prepend(html);
+      });
+    }
+  });
+})();
@@ -0,0 +1,179 @@
+"""Hashtags and mentions.
+
+A message's #hashtags and @mentions are written to two side tables when
+it's posted, in the posting transaction: `message_tags` (tag, message id)
+and `mentions` (mentioned user id, message id). Their primary keys are the
+indexes of each tag's and each user's messages, so `/tags/<tag>` and
+`/users/<id>/mentions` page through them newest first (keyset pagination
+on message ids, like profiles) and read the messages by id, instead of
+scanning message texts.
+
+Messages posted before these tables existed are indexed by
+`backfill_tags` (`flask tags backfill`). Index rows of deleted messages are
+removed with them, or skipped when read.
+"""
+
+import logging
+import re
+from urllib.parse import quote
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+
+from jobs import task
+from models import db, Mention, MessageTag, User
+from shards import RecentMessage, insert_ignoring_duplicates, router
+
+logger = logging.getLogger(__name__)
+
+TAG = re.compile(r'(?<![\w#])#(\w+)')
+MENTION = re.compile(r'(?<![\w@])@(\w+)')
+
+# messages read per query by `backfill_tags`
+BACKFILL_BATCH = 1000
+
+
+def hashtags(text):
+    """The distinct hashtags of a message text, lowercased, without '#'."""
+
+    return list(dict.fromkeys(tag.lower() for tag in TAG.findall(text)))
+
+
+def mentioned_usernames(text):
+    """The distinct usernames @mentioned in a message text."""
+
+    return list(dict.fromkeys(MENTION.findall(text)))
+
+
+def link_tags(text):
+    """Template filter: message text, escaped, with its hashtags linked to
+    their pages."""
+
+    parts = []
+    last = 0
+
+    for match in TAG.finditer(text):
+        parts.append(escape(text[last:match.start()]))
+        parts.append(Markup('<a href="/tags/{}">#{}</a>').format(quote(match[1].lower()), match[1]))
+        last = match.end()
+
+    parts.append(escape(text[last:]))
+
+    return Markup('').join(parts)
+
+
+def index_messages(messages):
+    """Add the tags and mentions of `RecentMessage`s to the side tables.
+
+    Mentions of usernames nobody has are left out. Rows already there are
+    skipped, so messages can be indexed again.
+    """
+
+    tags = []
+    mentions = {}
+
+    for message in messages:
+        tags += [dict(tag=tag, message_id=message.id, author_id=message.user_id)
+                 for tag in hashtags(message.text)]
+
+        for username in mentioned_usernames(message.text):
+            mentions.setdefault(username, []).append(message)
+
+    if tags:
+        db.session.execute(insert_ignoring_duplicates(MessageTag.__table__), tags)
+
+    if mentions:
+        users = db.session.query(User.username, User.id).filter(User.username.in_(mentions))
+        rows = [dict(user_id=user_id, message_id=message.id, author_id=message.user_id)
+                for username, user_id in users for message in mentions[username]]
+
+        if rows:
+            db.session.execute(insert_ignoring_duplicates(Mention.__table__), rows)
+
+
+def index_message(message):
+    """Add a new message's tags and mentions, in its posting transaction."""
+
+    index_messages([message])
+
+
+def unindex_message(message_id):
+    """Remove a deleted message's tags and mentions."""
+
+    for model in (MessageTag, Mention):
+        model.query.filter(model.message_id == message_id).delete(synchronize_session=False)
+
+
+def page(model, where, before, limit):
+    """(message id, author id) of the newest `limit` rows of an index,
+    older than `before`."""
+
+    query = db.session.query(model.message_id, model.author_id).filter(where)
+
+    if before is not None:
+        query = query.filter(model.message_id < before)
+
+    return query.order_by(model.message_id.desc()).limit(limit).all()
+
+
+def tagged(tag, before=None, limit=None):
+    """(message id, author id) of the messages with a hashtag, newest first."""
+
+    return page(MessageTag, MessageTag.tag == tag.lower(), before, limit)
+
+
+def mentioning(user_id, before=None, limit=None):
+    """(message id, author id) of the messages mentioning a user, newest first."""
+
+    return page(Mention, Mention.user_id == user_id, before, limit)
+
+
+@task
+def backfill_tags(batch_size=BACKFILL_BATCH):
+    """Index the tags and mentions of every message, oldest first, a batch
+    per transaction. Returns the number of messages read."""
+
+    messages = router.messages
+    count = 0
+
+    for shard in router.shards:
+        last = None
+
+        while True:
+            query = router.select_messages().order_by(messages.c.id).limit(batch_size)
+
+            if last is not None:
+                query = query.where(messages.c.id > last)
+
+            with router.connect(shard) as connection:
+                rows = [RecentMessage(*row) for row in connection.execute(query)]
+
+            if not rows:
+                break
+
+            index_messages(rows)
+            db.session.commit()
+
+            count += len(rows)
+            last = rows[-1].id
+
+    logger.info(f"tags and mentions of {count} messages indexed")
+    return count
+
+
+def init_tags(app):
+    """Add the `link_tags` template filter."""
+
+    app.add_template_filter(link_tags)
+
+
+tags_cli = AppGroup('tags', help="Hashtags and mentions.")
+
+
+@tags_cli.command('backfill')
+@click.option('--batch-size', default=BACKFILL_BATCH, help="Messages per transaction.")
+def backfill_command(batch_size):
+    """Index the tags and mentions of messages posted before they were kept."""
+
+    click.echo(f"{backfill_tags(batch_size)} messages indexed")
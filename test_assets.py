@@ -0,0 +1,200 @@
+"""Static asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from PIL import Image
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import assets
+from assets import Builder, asset_url, image_variant, minify_css, minify_js
+
+app.config['TESTING'] = True
+
+
+class MinifyTestCase(TestCase):
+    """CSS and JS minification."""
+
+    def test_minify_css(self):
+        """Are comments and insignificant whitespace removed?"""
+
+        css = """
+            /* the nav */
+            .nav  >  a ,
+            .nav a:hover {
+                color: red;
+                margin : 0 ;
+            }
+        """
+
+        self.assertEqual(minify_css(css), ".nav>a,.nav a:hover{color: red;margin : 0}")
+
+    def test_minify_js(self):
+        """Are whole-line comments, indentation and blank lines removed, and
+        nothing inside lines?"""
+
+        js = """
+            // the list
+            var list = 1;  // kept
+
+            /* a block
+               comment */
+            var url = 'http://example.com/*x*/';
+        """
+
+        self.assertEqual(minify_js(js),
+                         "var list = 1;  // kept\nvar url = 'http://example.com/*x*/';\n")
+
+
+class AssetUrlTestCase(TestCase):
+    """Asset URLs with and without a manifest."""
+
+    def setUp(self):
+        self.saved = dict(assets.manifest)
+
+    def tearDown(self):
+        assets.manifest.clear()
+        assets.manifest.update(self.saved)
+
+    def test_no_manifest(self):
+        """Without a build, are the CDN or the original files linked?"""
+
+        assets.manifest.update({'assets': {}, 'variants': {}})
+
+        self.assertEqual(asset_url('vendor/jquery.js'), assets.ASSETS['vendor/jquery.js'])
+        self.assertEqual(asset_url('stylesheets/style.css'), "/static/stylesheets/style.css")
+        self.assertEqual(image_variant('/static/images/default-pic.png', 96),
+                         "/static/images/default-pic.png")
+        self.assertEqual(image_variant('http://example.com/me.png', 96),
+                         "http://example.com/me.png")
+
+    def test_manifest(self):
+        """Are hashed names and the smallest wide enough variant linked?"""
+
+        assets.manifest.update({
+            'assets': {
+                'stylesheets/style.css': 'build/stylesheets/style.0123456789ab.css',
+                'images/default-pic.png': 'build/images/default-pic.ba9876543210.png',
+            },
+            'variants': {
+                'images/default-pic.png': [
+                    [96, 'webp', 'build/images/default-pic-96.aaaaaaaaaaaa.webp'],
+                    [200, 'webp', 'build/images/default-pic-200.bbbbbbbbbbbb.webp'],
+                    [200, 'avif', 'build/images/default-pic-200.cccccccccccc.avif'],
+                ],
+            },
+        })
+
+        self.assertEqual(asset_url('stylesheets/style.css'),
+                         "/static/build/stylesheets/style.0123456789ab.css")
+
+        url = '/static/images/default-pic.png'
+
+        self.assertEqual(image_variant(url, 50),
+                         "/static/build/images/default-pic-96.aaaaaaaaaaaa.webp")
+        self.assertEqual(image_variant(url, 150),
+                         "/static/build/images/default-pic-200.bbbbbbbbbbbb.webp")
+        self.assertEqual(image_variant(url, 150, 'avif'),
+                         "/static/build/images/default-pic-200.cccccccccccc.avif")
+        # wider than any variant: the built original
+        self.assertEqual(image_variant(url, 400),
+                         "/static/build/images/default-pic.ba9876543210.png")
+
+        # in a request, only for clients that list the format
+        accept = 'text/html,image/avif,image/webp,*/*;q=0.8'
+
+        with app.test_request_context(headers={'Accept': accept}):
+            self.assertEqual(image_variant(url, 150),
+                             "/static/build/images/default-pic-200.bbbbbbbbbbbb.webp")
+
+        with app.test_request_context(headers={'Accept': 'text/html,*/*;q=0.8'}):
+            self.assertEqual(image_variant(url, 150),
+                             "/static/build/images/default-pic.ba9876543210.png")
+
+            response = assets.vary_on_accept(app.response_class())
+            self.assertIn('Accept', response.vary)
+
+
+class BuildTestCase(TestCase):
+    """A build of the local assets into a temporary directory."""
+
+    def setUp(self):
+        self.saved = (assets.ASSETS, assets.IMAGE_VARIANTS, assets.BUILD_DIR)
+
+        # only files under static/, so the build doesn't need the network
+        assets.ASSETS = {name: source for name, source in assets.ASSETS.items()
+                         if not assets.is_remote(source)}
+        assets.IMAGE_VARIANTS = {'images/default-pic.png': [96, 100000]}
+
+        self.tmp = TemporaryDirectory(dir=assets.STATIC_DIR)
+        assets.BUILD_DIR = self.tmp.name
+
+    def tearDown(self):
+        assets.ASSETS, assets.IMAGE_VARIANTS, assets.BUILD_DIR = self.saved
+        self.tmp.cleanup()
+
+    def test_build(self):
+        """Are assets written under hashed names, compressed and resized?"""
+
+        result = Builder(self.tmp.name).build()
+
+        with open(os.path.join(self.tmp.name, 'manifest.json')) as file:
+            self.assertEqual(json.load(file), result)
+
+        self.assertEqual(set(result['assets']), set(assets.ASSETS))
+
+        build = os.path.relpath(self.tmp.name, assets.STATIC_DIR)
+        css = result['assets']['stylesheets/style.css']
+
+        self.assertRegex(css, rf"^{build}/stylesheets/style\.[0-9a-f]{{12}}\.css$")
+
+        with open(os.path.join(assets.STATIC_DIR, css), 'rb') as file:
+            data = file.read()
+
+        with open(os.path.join(assets.STATIC_DIR, css + '.gz'), 'rb') as file:
+            self.assertEqual(gzip.decompress(file.read()), data)
+
+        self.assertNotIn(b'/*', data)
+
+        with open(os.path.join(assets.STATIC_DIR, result['assets']['scripts/stream.js'])) as file:
+            self.assertNotIn('// ', file.read())
+        # pointing at the built images
+        self.assertIn(f"/static/{result['assets']['images/nav-bg.png']}".encode(), data)
+
+        # only narrower than the original
+        widths = {width for width, fmt, path in result['variants']['images/default-pic.png']}
+        self.assertEqual(widths, {96})
+
+        for width, fmt, path in result['variants']['images/default-pic.png']:
+            with Image.open(os.path.join(assets.STATIC_DIR, path)) as image:
+                self.assertEqual((image.width, image.format.lower()), (96, fmt))
+
+        # built files are served precompressed and cached for good
+        filename = os.path.relpath(css, build)
+
+        with app.test_client() as client:
+            resp = client.get(f'/static/build/{filename}',
+                              headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertEqual(gzip.decompress(resp.get_data()), data)
+            resp.close()
@@ -0,0 +1,79 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+
+from cache import TTLCache
+
+
+class FakeClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTestCase(TestCase):
+    """Size-limited, expiring cache."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(size=2, ttl=10, clock=self.clock)
+        self.loads = []
+
+    def load(self, key):
+        self.loads.append(key)
+        return key * 2
+
+    def test_hit(self):
+        """values are loaded once"""
+
+        self.assertEqual(self.cache.get(1, self.load), 2)
+        self.assertEqual(self.cache.get(1, self.load), 2)
+        self.assertEqual(self.loads, [1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_expiry(self):
+        """values are reloaded after ttl seconds"""
+
+        self.cache.get(1, self.load)
+        self.clock.now += 11
+        self.cache.get(1, self.load)
+
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_lru(self):
+        """the least recently used value is evicted"""
+
+        self.cache.get(1, self.load)
+        self.cache.get(2, self.load)
+        self.cache.get(1, self.load)
+        self.cache.get(3, self.load)
+
+        self.assertEqual(list(self.cache.entries), [1, 3])
+
+    def test_invalidate(self):
+        """invalidated values are reloaded"""
+
+        self.cache.get(1, self.load)
+        self.cache.invalidate(1)
+        self.cache.get(1, self.load)
+
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_missing_not_cached(self):
+        """missing values are looked up again"""
+
+        rows = {}
+
+        self.assertIsNone(self.cache.get(1, rows.get))
+
+        rows[1] = 'found'
+        self.assertEqual(self.cache.get(1, rows.get), 'found')
@@ -0,0 +1,304 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feed.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry, HotAuthor
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import cache
+import feed
+from cache import RecentMessage
+from feed import (home_feed, ensure_timeline, fan_out_message, refresh_hot_authors,
+                  follow_removed, trim_timelines, merge_streams, author_stream, bound,
+                  fill_high_water_marks, mark_posted, new_marks, new_since)
+from snowflake import make_id, ms_at, min_id_at
+
+db.create_all()
+
+START = datetime(2020, 1, 1)
+
+
+def rows(*minutes, author_id=1):
+    """Newest-first messages posted the given minutes after START."""
+
+    return [RecentMessage(make_id(ms_at(START + timedelta(minutes=minute)), author_id),
+                          "text", START + timedelta(minutes=minute), author_id)
+            for minute in minutes]
+
+
+class MergeStreamsTestCase(TestCase):
+    """Test the k-way merge."""
+
+    def test_merge(self):
+        """Are the newest messages of all streams taken, in order?"""
+
+        merged = merge_streams([rows(9, 5, 1), rows(8, 7, 2, author_id=2), []], 4)
+
+        self.assertEqual([row.timestamp.minute for row in merged], [9, 8, 7, 5])
+
+    def test_lazy(self):
+        """Are streams read no further than needed?"""
+
+        read = []
+
+        def stream(author_id, *minutes):
+            for row in rows(*minutes, author_id=author_id):
+                read.append(row.timestamp.minute)
+                yield row
+
+        merge_streams([stream(1, 9, 8, 1), stream(2, 7, 6, 5)], 2)
+        self.assertEqual(sorted(read), [7, 8, 9])
+
+        # a bound keeps a stream from being read until its time comes
+        def bounded(latest, *minutes):
+            yield bound(rows(latest, author_id=3)[0].id, 3)
+            yield from stream(3, *minutes)
+
+        read.clear()
+        merged = merge_streams([rows(9, 8, 7), bounded(3, 3, 2)], 2)
+
+        self.assertEqual([row.timestamp.minute for row in merged], [9, 8])
+        self.assertEqual(read, [])
+
+    def test_watermark(self):
+        """Are messages older than the watermark cut off?"""
+
+        merged = merge_streams([rows(9, 5, 1), rows(8, 3, author_id=2)], 10,
+                               watermark=min_id_at(START + timedelta(minutes=4)))
+
+        self.assertEqual([row.timestamp.minute for row in merged], [9, 8, 5])
+
+    def test_duplicates(self):
+        """Is a message in two streams taken once?"""
+
+        merged = merge_streams([rows(9, 5), rows(9, 4)], 10)
+
+        self.assertEqual([row.timestamp.minute for row in merged], [9, 5, 4])
+
+
+class FeedTestCase(TestCase):
+    """Test fan-out on write and on read."""
+
+    def setUp(self):
+        """Create users: u0 follows u1 & u2, u3 follows u1 & u2, u4 follows u2."""
+
+        TimelineEntry.query.delete()
+        HotAuthor.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for c in (cache.recent, feed.hot, cache.authors):
+            c.clear()
+
+        users = [
+            User(email=f"test{i}@test.com", username=f"testuser{i}", password="HASHED_PASSWORD")
+            for i in range(5)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u0, u1, u2, u3, u4 = users
+        u0.following.extend([u1, u2])
+        u3.following.extend([u1, u2])
+        u4.following.append(u2)
+        db.session.commit()
+
+        self.users = users
+        self.minutes = 0
+
+    def tearDown(self):
+        """Clean up any faulted transaction."""
+        db.session.rollback()
+
+    def post(self, user, text):
+        """Add a message, a minute after the last one; returns its id."""
+
+        self.minutes += 1
+        msg = Message(user_id=user.id, text=text,
+                      timestamp=START + timedelta(minutes=self.minutes))
+        db.session.add(msg)
+        db.session.commit()
+
+        return msg.id
+
+    def timeline(self, user):
+        return [message_id for (message_id,) in (db.session
+                .query(TimelineEntry.message_id)
+                .filter(TimelineEntry.user_id == user.id)
+                .order_by(TimelineEntry.message_id))]
+
+    def test_ensure_timeline(self):
+        """Is a timeline filled from followed authors the first time?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        m1 = self.post(u1, "one")
+        m2 = self.post(u2, "two")
+        self.post(u3, "not followed")
+
+        ensure_timeline(u0)
+
+        self.assertIsNotNone(u0.timeline_built_at)
+        self.assertEqual(self.timeline(u0), [m1, m2])
+
+    def test_fan_out(self):
+        """Are new messages copied to built timelines only?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        ensure_timeline(u0)
+        ensure_timeline(u3)
+
+        m1 = self.post(u2, "hello")
+
+        self.assertEqual(fan_out_message(m1), 2)
+        self.assertEqual(self.timeline(u0), [m1])
+        self.assertEqual(self.timeline(u3), [m1])
+        self.assertEqual(self.timeline(u4), [])
+
+    def test_hot_authors(self):
+        """Are hot authors merged on read instead of fanned out?"""
+
+        u0, u1, u2, u3, u4 = self.users
+
+        # u2 has 3 followers, u1 has 2
+        self.assertEqual(refresh_hot_authors(threshold=3), 1)
+
+        ensure_timeline(u0)
+        m1 = self.post(u1, "normal")
+        m2 = self.post(u2, "hot")
+        m3 = self.post(u0, "mine")
+
+        self.assertEqual(fan_out_message(m1), 1)
+        self.assertEqual(fan_out_message(m2), 0)
+        self.assertEqual(self.timeline(u0), [m1])
+
+        self.assertEqual([card.id for card in home_feed(u0)], [m3, m2, m1])
+        self.assertEqual(home_feed(u0)[1].username, "testuser2")
+
+        # u2 stays hot until below half the threshold
+        Follows.query.filter_by(user_following_id=u4.id).delete()
+        db.session.commit()
+        self.assertEqual(refresh_hot_authors(threshold=3), 1)
+
+        Follows.query.filter_by(user_following_id=u3.id).delete()
+        db.session.commit()
+        self.assertEqual(refresh_hot_authors(threshold=3), 0)
+
+        # its messages, never fanned out, are copied when it cools down
+        feed.hot.clear()
+        self.assertEqual(self.timeline(u0), [m1, m2])
+        self.assertEqual([card.id for card in home_feed(u0)], [m3, m2, m1])
+
+    def test_unfollow(self):
+        """Are unfollowed authors taken out of timelines?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        self.post(u1, "one")
+        m2 = self.post(u2, "two")
+        ensure_timeline(u0)
+
+        follow_removed(u0, u1.id)
+        db.session.commit()
+
+        self.assertEqual(self.timeline(u0), [m2])
+
+    def test_recent_messages(self):
+        """Are authors' buffers loaded once, then added to and pruned?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        m1 = self.post(u1, "one")
+        recent = cache.RecentMessages(size=2)
+
+        self.assertEqual([m.id for m in recent.get(u1.id)], [m1])
+
+        # added to the buffer without reading the messages table
+        m2 = self.post(u1, "two")
+        recent.add(Message.query.get(m2))
+        Message.query.filter_by(id=m1).delete()
+        db.session.commit()
+
+        self.assertEqual([m.id for m in recent.get(u1.id)], [m2, m1])
+        self.assertEqual([m.id for m in recent.get(u1.id, limit=1)], [m2])
+
+        # pruning a full buffer reloads it
+        recent.remove(u1.id, m1)
+        self.assertEqual([m.id for m in recent.get(u1.id)], [m2])
+
+        # a buffer that isn't full is pruned in place
+        Message.query.filter_by(id=m2).delete()
+        db.session.commit()
+        recent.remove(u1.id, m2)
+
+        self.assertEqual(recent.get(u1.id), [])
+
+    def test_author_stream(self):
+        """Do author streams page past the recent buffer?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        ids = [self.post(u1, str(i)) for i in range(5)]
+
+        size = cache.recent.size
+        cache.recent.size = 2
+
+        try:
+            stream = author_stream(u1.id, chunk=2)
+            self.assertEqual([row.id for row in stream], ids[::-1])
+        finally:
+            cache.recent.size = size
+            cache.recent.clear()
+
+    def test_trim(self):
+        """Are timelines kept to their newest entries?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        self.post(u1, "one")
+        m2 = self.post(u2, "two")
+        m3 = self.post(u1, "three")
+        ensure_timeline(u0)
+        ensure_timeline(u4)
+
+        self.assertEqual(trim_timelines(size=2), 1)
+        self.assertEqual(self.timeline(u0), [m2, m3])
+        self.assertEqual(self.timeline(u4), [m2])
+
+    def test_new_since(self):
+        """Do high-water marks find followed authors' new messages only?"""
+
+        u0, u1, u2, u3, u4 = self.users
+        m1 = self.post(u1, "one")
+        self.post(u3, "not followed")
+
+        self.assertEqual(fill_high_water_marks(), 2)
+
+        m2 = self.post(u2, "two")
+        m3 = self.post(u1, "three")
+
+        for message_id in (m3, m2):
+            mark_posted(Message.query.get(message_id))
+        db.session.commit()
+
+        marks = new_marks(u0.id, m1)
+
+        self.assertEqual(sorted(marks), sorted([(u1.id, m3), (u2.id, m2)]))
+        self.assertEqual(new_since(marks, m1), [m3, m2])
+        self.assertEqual(new_since(marks, m2), [m3])
+        self.assertEqual(new_marks(u0.id, m3), [])
+        self.assertEqual(new_marks(u4.id, m2), [])
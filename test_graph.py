@@ -0,0 +1,173 @@
+"""Graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, Message, Follows, FollowChange, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from graph import GraphIndex, log_follow, log_purge, prune_follow_changes
+
+db.create_all()
+
+
+class GraphIndexTestCase(TestCase):
+    """Test the in-memory follows graph."""
+
+    def setUp(self):
+        """Create users: u0 follows u1 & u2, u1 follows u2."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        FollowChange.query.delete()
+
+        users = [
+            User(email=f"test{i}@test.com", username=f"testuser{i}", password="HASHED_PASSWORD")
+            for i in range(3)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u0, u1, u2 = users
+        u0.following.extend([u1, u2])
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.users = users
+        self.index = GraphIndex.from_db()
+
+    def tearDown(self):
+        """Clean up any faulted transaction and the index."""
+        db.session.rollback()
+        User.graph_index = None
+
+    def test_lookups(self):
+        """Does the index answer membership, counts and pages?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        index = self.index
+
+        self.assertTrue(index.is_following(u0, u1))
+        self.assertFalse(index.is_following(u1, u0))
+        self.assertEqual(index.following_count(u0), 2)
+        self.assertEqual(index.followers_count(u2), 2)
+        self.assertEqual(list(index.followers(u2)), [u0, u1])
+
+        self.assertEqual(index.page(index.following(u0), limit=1), ([u1], u1))
+        self.assertEqual(index.page(index.following(u0), after=u1, limit=1), ([u2], None))
+
+        report = index.memory_report()
+        self.assertEqual(report['follows'], 3)
+        self.assertGreater(report['arrays'], 0)
+
+    def test_follow_unfollow(self):
+        """Are writes applied to the index?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        index = self.index
+
+        index.follow(u2, u0)
+        self.assertTrue(index.is_following(u2, u0))
+        self.assertEqual(list(index.followers(u0)), [u2])
+
+        index.unfollow(u0, u1)
+        self.assertFalse(index.is_following(u0, u1))
+        self.assertEqual(index.following_count(u0), 1)
+        self.assertEqual(index.followers_count(u1), 0)
+
+    def log_changes(self, *changes):
+        """Log (user id, other id, following) changes as another process
+        would, other id None for a purge."""
+
+        app.config['GRAPH_INDEX'] = 'db'
+
+        try:
+            with app.app_context():
+                for user_id, other_id, following in changes:
+                    if other_id is None:
+                        log_purge(user_id)
+                    else:
+                        log_follow(user_id, other_id, following)
+
+                db.session.commit()
+        finally:
+            app.config['GRAPH_INDEX'] = None
+
+    def test_catch_up(self):
+        """Are follows made and users purged by other processes applied?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        index = GraphIndex.from_db(poll=0)
+
+        self.log_changes((u2, u0, True), (u0, u2, False), (u1, None, False))
+
+        self.assertTrue(index.is_following(u2, u0))
+        self.assertFalse(index.is_following(u0, u2))
+        self.assertEqual(index.following_count(u1), 0)
+        self.assertEqual(index.followers_count(u2), 0)
+
+        # applying them again changes nothing
+        index.catch_up()
+        self.assertEqual(list(index.following(u2)), [u0])
+
+    def test_pruned(self):
+        """Is an index that missed pruned changes rebuilt from the table?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        index = GraphIndex.from_db(poll=0)
+
+        # in the table, but its change was pruned
+        db.session.add(Follows(user_following_id=u2, user_being_followed_id=u1))
+        self.log_changes((u2, u1, True), (u2, u0, True))
+        db.session.add(Follows(user_following_id=u2, user_being_followed_id=u0))
+        db.session.commit()
+
+        self.assertEqual(prune_follow_changes(keep=-60), 1)
+        self.assertEqual(list(index.following(u2)), [u0, u1])
+
+    def test_snapshot(self):
+        """Does a memory-mapped snapshot load the same graph?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+
+        with TemporaryDirectory() as path:
+            self.index.save(path)
+            index = GraphIndex.load(path)
+
+            self.assertTrue(index.is_following(u1, u2))
+            self.assertEqual(index.following_count(u0), 2)
+            self.assertEqual(index.change_id, self.index.change_id)
+
+    def test_user_methods(self):
+        """Do the User follow methods use the index when it is set?"""
+
+        u0, u1, u2 = self.users
+        User.graph_index = self.index
+
+        self.assertTrue(u0.is_following(u1))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertEqual(sorted(u0.following_ids()), [u1.id, u2.id])
+        self.assertEqual(u2.followers_count(), 2)
+
+        rows, next_after = u2.followers_page(viewer_id=u1.id)
+        self.assertEqual([row.id for row in rows], [u0.id, u1.id])
+        self.assertEqual([row.viewer_follows for row in rows], [False, False])
+        self.assertIsNone(next_after)
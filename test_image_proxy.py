@@ -0,0 +1,217 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_image_proxy.py
+
+
+import io
+import os
+import socket
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import imageproxy
+from imageproxy import thumbnail, ImageCache
+
+app.config['TESTING'] = True
+
+# the stub origin below listens on localhost
+app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+
+
+def make_png(width, height):
+    """PNG bytes of a plain image."""
+
+    data = io.BytesIO()
+    Image.new('RGB', (width, height), 'blue').save(data, 'png')
+    return data.getvalue()
+
+
+class StubOrigin(BaseHTTPRequestHandler):
+    """Serves /big.png, /page.html and counts requests."""
+
+    requests = 0
+
+    def do_GET(self):
+        StubOrigin.requests += 1
+
+        if self.path == '/big.png':
+            body, content_type = make_png(800, 600), 'image/png'
+        elif self.path == '/page.html':
+            body, content_type = b'<html></html>', 'text/html'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test the image proxy route and its cache."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubOrigin)
+        cls.origin = f"http://127.0.0.1:{cls.server.server_port}"
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        """Use an empty cache and a fresh client."""
+
+        self.cache_dir = TemporaryDirectory()
+        imageproxy.cache = ImageCache(self.cache_dir.name)
+        imageproxy.failures.clear()
+        StubOrigin.requests = 0
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_resize_and_cache(self):
+        """Is a remote image resized once and then served from the cache?"""
+
+        with app.test_request_context():
+            url = thumbnail(f"{self.origin}/big.png", 'avatar')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(StubOrigin.requests, 1)
+
+        #conditional request
+        resp = self.client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_header_keeps_aspect(self):
+        """Are header images shrunk to fit without cropping?"""
+
+        with app.test_request_context():
+            url = thumbnail(f"{self.origin}/big.png", 'header')
+
+        resp = self.client.get(url)
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (427, 320))
+
+    def test_bad_signature(self):
+        """Are unsigned URLs refused?"""
+
+        resp = self.client.get(f"/img/avatar/0000?url={self.origin}/big.png")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(StubOrigin.requests, 0)
+
+    def test_not_an_image(self):
+        """Do non-images fall back to the default image?"""
+
+        with app.test_request_context():
+            url = thumbnail(f"{self.origin}/page.html", 'avatar')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn('/static/', resp.location)
+
+    def test_failures_cached(self):
+        """Are failed originals not fetched again for a while?"""
+
+        with app.test_request_context():
+            url = thumbnail(f"{self.origin}/missing.png", 'avatar')
+
+        for _ in range(3):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(StubOrigin.requests, 1)
+
+    def test_private_address_refused(self):
+        """Are hosts resolving to private addresses refused, unfetched?"""
+
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+
+        try:
+            with app.test_request_context():
+                url = thumbnail(f"http://localhost:{self.server.server_port}/big.png", 'avatar')
+
+            resp = self.client.get(url)
+        finally:
+            app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(StubOrigin.requests, 0)
+
+    def test_resolved_once(self):
+        """Is the address connected to the one resolved and checked?"""
+
+        resolve = socket.getaddrinfo
+        answers = []
+
+        def rebinding(host, *args, **kwargs):
+            # first answer the origin, then somewhere else
+            if host == 'rebind.test':
+                answers.append(host)
+                host = '127.0.0.1' if len(answers) == 1 else '127.0.0.2'
+
+            return resolve(host, *args, **kwargs)
+
+        with app.test_request_context():
+            url = thumbnail(f"http://rebind.test:{self.server.server_port}/big.png", 'avatar')
+
+        with patch('socket.getaddrinfo', rebinding):
+            resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(answers, ['rebind.test'])
+
+    def test_local_images(self):
+        """Are our own images left to the static build?"""
+
+        with app.test_request_context():
+            self.assertTrue(thumbnail('/static/images/default-pic.png', 'avatar').startswith('/static/'))
+            self.assertEqual(thumbnail(None, 'avatar'), '/static/images/default-pic.png')
+
+            # protocol-relative URLs aren't ours
+            self.assertTrue(thumbnail('//example.com/me.png', 'avatar').startswith('/img/avatar/'))
+
+    def test_eviction(self):
+        """Does the cache drop least recently used files when full?"""
+
+        cache = ImageCache(self.cache_dir.name, max_bytes=250)
+
+        first = cache.put('a', b'x' * 100)
+        os.utime(first, (0, 0))
+        cache.put('b', b'x' * 100)
+        cache.put('c', b'x' * 100)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
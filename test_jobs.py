@@ -0,0 +1,182 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import jobs
+from jobs import RetryLater, task, enqueue, run_pending, requeue_stale, schedule_periodic
+
+db.create_all()
+
+calls = []
+
+
+@task
+def record_call(value):
+    """Test task: remember the value it was called with."""
+
+    calls.append(value)
+
+
+@task(max_attempts=2)
+def always_fail():
+    """Test task: always raises."""
+
+    raise ValueError("boom")
+
+
+@task(max_attempts=1)
+def not_yet():
+    """Test task: always put off."""
+
+    raise RetryLater(60, "not yet")
+
+
+@task(max_attempts=1, every=60)
+def periodic_fail():
+    """Test task: repeats, and always raises."""
+
+    raise ValueError("boom")
+
+
+class JobsTestCase(TestCase):
+    """Test the job queue and worker."""
+
+    def setUp(self):
+        """Clear the jobs table"""
+
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        # retry right away
+        jobs.RETRY_DELAY = 0
+
+    def tearDown(self):
+        """Clean up any faulted transaction."""
+        db.session.rollback()
+
+    def test_enqueue_and_run(self):
+        """Does a queued job run once?"""
+
+        job = enqueue(record_call, value=5)
+        db.session.commit()
+
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [5])
+        self.assertEqual(Job.query.get(job.id).status, 'done')
+
+        #nothing left to run
+        self.assertEqual(run_pending(), 0)
+
+    def test_scheduled(self):
+        """Does a job wait until run_at?"""
+
+        job = enqueue(record_call, delay=60, value=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 0)
+        self.assertEqual(calls, [])
+
+        job.run_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [1])
+
+    def test_retry(self):
+        """Is a failing job retried, then marked failed?"""
+
+        job = enqueue(always_fail)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 2)
+
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('boom', job.last_error)
+
+    def test_retry_later(self):
+        """Is a job put off without using up an attempt?"""
+
+        job = enqueue(not_yet)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 1)
+
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(job.last_error, "not yet")
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=30))
+
+    def test_periodic_after_failure(self):
+        """Is a periodic task queued again when it runs out of attempts?"""
+
+        job = enqueue(periodic_fail)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(Job.query.get(job.id).status, 'failed')
+
+        next_run = Job.query.filter(Job.name == 'periodic_fail', Job.status == 'queued').one()
+        self.assertGreater(next_run.run_at, datetime.utcnow())
+
+    def test_schedule_periodic(self):
+        """Is each periodic task queued once, even if queued twice already?"""
+
+        enqueue(periodic_fail)
+        enqueue(periodic_fail, delay=30)
+        db.session.commit()
+
+        schedule_periodic()
+        schedule_periodic()
+
+        for name in jobs.PERIODIC:
+            self.assertEqual(Job.query.filter(Job.name == name).count(), 1, name)
+
+    def test_requeue_stale(self):
+        """Are jobs abandoned by a dead worker queued again?"""
+
+        job = enqueue(record_call, value=2)
+        job.status = 'running'
+        job.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [2])
+
+    def test_stale_out_of_attempts(self):
+        """Are abandoned jobs out of attempts failed instead of queued?"""
+
+        job = enqueue(record_call, value=3)
+        job.status = 'running'
+        job.attempts = job.max_attempts
+        job.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(), 0)
+        self.assertEqual(Job.query.get(job.id).status, 'failed')
+        self.assertEqual(run_pending(), 0)
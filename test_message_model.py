@@ -9,6 +9,7 @@ import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Follows , Likes
+from snowflake import timestamp_of
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -70,6 +71,22 @@ class MessageModelTestCase(TestCase):
 
         self.assertGreater(m.id , 0)
         self.assertEqual(m.user , self.user)
+
+    def test_message_ids(self):
+        """Are ids time-ordered, with the timestamp taken from the id?"""
+
+        u = self.user
+        m1 = Message(user_id=u.id , text='first')
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(user_id=u.id , text='second')
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertGreater(m2.id , m1.id)
+        self.assertEqual(m1.timestamp , timestamp_of(m1.id))
+        self.assertGreaterEqual(m2.timestamp , m1.timestamp)
     
     def test_is_liked_by(self):
         """Does the is_liked_by work"""
@@ -102,4 +119,21 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(len(u2.likes) , 1)
         self.assertEqual(len(m.likes_users) , 1)
         self.assertEqual(u2.is_like(m) , True)
-        self.assertEqual(m.is_liked_by(u2), True)
\ No newline at end of file
+        self.assertEqual(m.is_liked_by(u2), True)
+
+        # others can like it too, but nobody twice
+        u3 = User(
+            email="test3@test.com" ,
+            username="testuser3" ,
+            password="HASHED_PASSWORD"
+        )
+        db.session.add(u3)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=u3.id , message_id=m.id))
+        db.session.commit()
+        self.assertEqual(len(m.likes_users) , 2)
+
+        db.session.add(Likes(user_id=u3.id , message_id=m.id))
+        self.assertRaises(IntegrityError , db.session.commit)
+        db.session.rollback()
@@ -21,6 +21,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import cache
+from feed import mark_posted
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -46,6 +48,10 @@ class MessageViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
 
+        cache.messages.clear()
+        cache.authors.clear()
+        cache.recent.clear()
+
         self.client = app.test_client()
 
         self.testuser = User.signup(username="testuser",
@@ -166,6 +172,55 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, f'http://localhost/users/{user_id}')
 
+    def test_messages_show_cached(self):
+        """message pages are cached until the message or its author changes"""
+
+        user_id = self.testuser.id
+        user_id2 = self.testuser2.id
+
+        msg = Message(user_id=user_id , text="test text")
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertIn('@testuser<' , resp.get_data(as_text=True))
+
+            # served from the cache, even though the row changed
+            User.query.filter_by(id=user_id).update({'username': 'renamed'})
+            db.session.commit()
+
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertIn('@testuser<' , resp.get_data(as_text=True))
+
+            cache.invalidate_author(user_id)
+
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertIn('@renamed<' , resp.get_data(as_text=True))
+
+            # follow state is per viewer, not cached
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id2
+
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertIn(f'action="/users/follow/{user_id}"' , resp.get_data(as_text=True))
+
+            db.session.add(Follows(user_being_followed_id=user_id , user_following_id=user_id2))
+            db.session.commit()
+
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertIn(f'action="/users/stop-following/{user_id}"' , resp.get_data(as_text=True))
+
+            # deleting the message drops it from the cache
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f'/messages/{msg_id}/delete')
+
+            resp = c.get(f'/messages/{msg_id}')
+            self.assertEqual(resp.status_code, 404)
+
     def test_messages_add_like(self):
         """like a message?"""
 
@@ -216,6 +271,106 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('btn-secondary', html)
 
+    def test_messages_since(self):
+        """Are new messages polled for, with 304s while nothing's new?"""
+
+        user_id = self.testuser.id
+        user_id2 = self.testuser2.id
+
+        follow = Follows(user_being_followed_id=user_id , user_following_id=user_id2)
+        db.session.add(follow)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/messages/since?after=0')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id2
+
+            resp = c.get('/messages/since?after=0')
+            self.assertEqual(resp.get_json(), {'count': 0, 'ids': []})
+
+            etag = resp.headers['ETag']
+            resp = c.get('/messages/since?after=0', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            #followed user posts
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post('/messages/new', data={"text": "new"})
+            msg_id = Message.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id2
+
+            resp = c.get('/messages/since?after=0', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {'count': 1, 'ids': [str(msg_id)]})
+
+            resp = c.get(f'/messages/since?after={msg_id}')
+            self.assertEqual(resp.get_json(), {'count': 0, 'ids': []})
+
+            resp = c.get('/messages/since?after=x')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_messages_since_other_worker(self):
+        """Are messages posted through another worker polled for, whatever
+        this worker's buffer of the author's recent messages holds?"""
+
+        user_id = self.testuser.id
+        user_id2 = self.testuser2.id
+
+        db.session.add(Follows(user_being_followed_id=user_id , user_following_id=user_id2))
+        db.session.commit()
+
+        # this worker's buffer, from before the post
+        self.assertEqual(cache.recent.get(user_id), [])
+
+        msg = Message(user_id=user_id , text="posted elsewhere")
+        db.session.add(msg)
+        db.session.flush()
+        mark_posted(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id2
+
+            resp = c.get('/messages/since?after=0')
+            self.assertEqual(resp.get_json(), {'count': 1, 'ids': [str(msg_id)]})
+
+    def test_like_counts(self):
+        """Are like counts shown on home page, profile and likes cards?"""
+
+        user_id = self.testuser.id
+        user_id2 = self.testuser2.id
+
+        user3 = User.signup(username="testuser3", email="test3@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        user_id3 = user3.id
+
+        msg = Message(user_id=user_id , text="test text")
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        db.session.add_all([Likes(message_id=msg_id , user_id=user_id2),
+                            Likes(message_id=msg_id , user_id=user_id3)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for url in ['/', f'/users/{user_id}', f'/users/{user_id2}/likes']:
+                html = c.get(url).get_data(as_text=True)
+                self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html, url)
+
     def test_messages_show_likes(self):
         """show the list of like messages?"""
 
@@ -0,0 +1,208 @@
+"""Message partition and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import partitions
+from partitions import (add_months, archive_month, archived_months, id_range,
+                        maintain_partitions, messages_before, months_in_database,
+                        purge_archived_user, restore_month)
+from snowflake import make_id, ms_at, timestamp_of
+
+db.create_all()
+
+
+class MonthsTestCase(TestCase):
+    """Month arithmetic."""
+
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2020, 11, 1), 3), date(2021, 2, 1))
+        self.assertEqual(add_months(date(2020, 1, 1), -1), date(2019, 12, 1))
+
+    def test_id_range(self):
+        """Do a month's ids hold exactly its messages?"""
+
+        low, high = id_range(date(2020, 2, 1))
+
+        self.assertEqual(timestamp_of(low), datetime(2020, 2, 1))
+        self.assertEqual(timestamp_of(high), datetime(2020, 3, 1))
+        self.assertEqual(id_range(date(2020, 1, 1))[1], low)
+
+
+class ArchiveTestCase(TestCase):
+    """Archiving and restoring months of messages."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.archive_dir = partitions.ARCHIVE_DIR
+        partitions.ARCHIVE_DIR = tempfile.mkdtemp()
+        partitions.archives.clear()
+
+        author = User(email="author@test.com", username="author", password="HASHED_PASSWORD")
+        fan = User(email="fan@test.com", username="fan", password="HASHED_PASSWORD")
+        db.session.add_all([author, fan])
+        db.session.commit()
+
+        # two messages a month, January to March 2020
+        self.ids = []
+
+        for month in (1, 2, 3):
+            for day in (10, 20):
+                id = make_id(ms_at(datetime(2020, month, day)))
+                db.session.add(Message(id=id, text=f"{month}/{day}", user_id=author.id))
+                self.ids.append(id)
+
+        db.session.commit()
+        db.session.add(Likes(user_id=fan.id, message_id=self.ids[0]))
+        db.session.commit()
+
+        self.author_id = author.id
+        self.fan_id = fan.id
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(partitions.ARCHIVE_DIR)
+        partitions.ARCHIVE_DIR = self.archive_dir
+
+    def test_archive(self):
+        """Are months older than the cutoff moved to files?"""
+
+        self.assertEqual(months_in_database(),
+                         [date(2020, 1, 1), date(2020, 2, 1), date(2020, 3, 1)])
+
+        self.assertEqual(maintain_partitions(after_months=1, today=datetime(2020, 4, 5)), 2)
+
+        self.assertEqual(archived_months(), [date(2020, 2, 1), date(2020, 1, 1)])
+        self.assertEqual(sorted(id for (id,) in db.session.query(Message.id)), self.ids[4:])
+        self.assertEqual(Likes.query.count(), 0)
+
+        # archiving again finds nothing left to do
+        self.assertEqual(maintain_partitions(after_months=1, today=datetime(2020, 4, 5)), 0)
+
+    def test_messages_before(self):
+        """Do profile pages run on from the database into the archive?"""
+
+        archive_month(date(2020, 1, 1))
+        newest_first = self.ids[::-1]
+
+        rows = messages_before(self.author_id, self.ids[-1], 3)
+        self.assertEqual([row.id for row in rows], newest_first[1:4])
+
+        rows = messages_before(self.author_id, rows[-1].id, 3)
+        self.assertEqual([row.id for row in rows], newest_first[4:])
+        self.assertEqual(rows[-1].text, "1/10")
+        self.assertEqual(rows[-1].timestamp, datetime(2020, 1, 10))
+
+    def test_archive_blocks(self):
+        """Are archives written and read a block at a time, with or without
+        their index?"""
+
+        partitions.ARCHIVE_BATCH = 1
+
+        try:
+            # merged with the month's archive, and read back from the database
+            archive_month(date(2020, 1, 1))
+            restore_month(date(2020, 1, 1))
+            archive_month(date(2020, 1, 1))
+        finally:
+            partitions.ARCHIVE_BATCH = 1000
+
+        self.assertEqual([record['id'] for record in partitions.read_archive(date(2020, 1, 1))],
+                         self.ids[:2])
+        self.assertEqual(len(partitions.archive_index(date(2020, 1, 1))['blocks']), 2)
+
+        rows = messages_before(self.author_id, self.ids[1], 10)
+        self.assertEqual([row.id for row in rows], self.ids[:1])
+        self.assertEqual(messages_before(self.fan_id, None, 10), [])
+
+        os.remove(partitions.index_path(date(2020, 1, 1)))
+        partitions.archives.clear()
+
+        rows = messages_before(self.author_id, self.ids[2], 10)
+        self.assertEqual([row.id for row in rows], self.ids[1::-1])
+
+    def test_restore(self):
+        """Does a restored month come back with its likes?"""
+
+        archive_month(date(2020, 1, 1))
+        self.assertEqual(restore_month(date(2020, 1, 1)), 2)
+
+        self.assertEqual(sorted(id for (id,) in db.session.query(Message.id)), self.ids)
+        self.assertEqual(Message.query.get(self.ids[0]).timestamp, datetime(2020, 1, 10))
+        self.assertEqual([like.message_id for like in Likes.query], [self.ids[0]])
+
+        # archiving it again keeps one copy of each message
+        archive_month(date(2020, 1, 1))
+        rows = messages_before(self.author_id, self.ids[2], 10)
+        self.assertEqual([row.id for row in rows], self.ids[1::-1])
+
+    def test_restore_again(self):
+        """Can a month be restored twice, with its likes?"""
+
+        archive_month(date(2020, 1, 1))
+        self.assertEqual(restore_month(date(2020, 1, 1)), 2)
+
+        Message.query.filter(Message.id == self.ids[1]).delete()
+        db.session.commit()
+
+        self.assertEqual(restore_month(date(2020, 1, 1)), 2)
+        self.assertEqual(sorted(id for (id,) in db.session.query(Message.id)), self.ids)
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_restore_purged_users(self):
+        """Are messages and likes of accounts gone since left out?"""
+
+        archive_month(date(2020, 1, 1))
+
+        User.query.filter(User.id == self.fan_id).delete()
+        db.session.commit()
+
+        self.assertEqual(restore_month(date(2020, 1, 1)), 2)
+        self.assertEqual(Likes.query.count(), 0)
+
+        archive_month(date(2020, 1, 1))
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.assertEqual(restore_month(date(2020, 1, 1)), 0)
+
+    def test_purge_archived_user(self):
+        """Does purging an account take it out of the archive files?"""
+
+        archive_month(date(2020, 1, 1))
+        archive_month(date(2020, 2, 1))
+
+        self.assertEqual(purge_archived_user(self.fan_id), 0)
+        records = {record['id']: record for record in partitions.read_archive(date(2020, 1, 1))}
+        self.assertEqual(records[self.ids[0]]['likes'], [])
+
+        self.assertEqual(purge_archived_user(self.author_id), 4)
+        self.assertEqual(archived_months(), [])
+        self.assertEqual(messages_before(self.author_id, self.ids[4], 10), [])
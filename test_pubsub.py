@@ -0,0 +1,142 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import cache
+from pubsub import LocalBroker, events
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LocalBrokerTestCase(TestCase):
+    """In-process publish/subscribe."""
+
+    def test_publish(self):
+        """Do subscribers get what's published on their channels only?"""
+
+        broker = LocalBroker()
+        first = broker.subscribe({1, 2})
+        second = broker.subscribe({2})
+
+        broker.publish(1, 'a')
+        broker.publish(2, 'b')
+        broker.publish(3, 'c')
+
+        self.assertEqual(first.get(timeout=0), ['a', 'b'])
+        self.assertEqual(second.get(timeout=0), ['b'])
+        self.assertEqual(first.get(timeout=0), [])
+
+        first.close()
+        second.close()
+        self.assertEqual(broker.channels, {})
+
+    def test_events(self):
+        """Are ids sent as events, with heartbeats while idle?"""
+
+        broker = LocalBroker()
+        subscription = broker.subscribe({1})
+        stream = events(subscription, heartbeat=0)
+
+        self.assertTrue(next(stream).startswith("retry:"))
+        self.assertEqual(next(stream), ": heartbeat\n\n")
+
+        broker.publish(1, 12345678901234567)
+        self.assertEqual(next(stream), 'event: messages\ndata: ["12345678901234567"]\n\n')
+
+        # the subscription ends with the stream
+        stream.close()
+        self.assertEqual(broker.channels, {})
+
+
+class StreamViewTestCase(TestCase):
+    """/stream and /messages/cards."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for c in (cache.messages, cache.authors, cache.recent):
+            c.clear()
+
+        self.client = app.test_client()
+
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+
+        reader.following.append(author)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_stream(self):
+        """Does posting push the new id to followers' streams?"""
+
+        with app.test_client() as reader, app.test_client() as author:
+            self.assertEqual(reader.get('/stream').status_code, 401)
+
+            self.login(reader, self.reader_id)
+            resp = reader.get('/stream')
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+
+            stream = iter(resp.response)
+            next(stream)
+
+            self.login(author, self.author_id)
+            author.post('/messages/new', data={"text": "live"})
+            msg = Message.query.one()
+
+            self.assertIn(f'["{msg.id}"]', next(stream).decode())
+            resp.close()
+
+    def test_cards(self):
+        """Are the requested cards rendered, and nothing else?"""
+
+        msgs = [Message(user_id=self.author_id, text=f"card {i}") for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        with self.client as client:
+            self.assertEqual(client.get('/messages/cards?ids=1').status_code, 401)
+
+            self.login(client, self.reader_id)
+            resp = client.get(f'/messages/cards?ids={ids[2]},{ids[0]}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index('card 2'), html.index('card 0'))
+            self.assertNotIn('card 1', html)
+            self.assertEqual(client.get('/messages/cards?ids=x').status_code, 400)
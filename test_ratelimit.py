@@ -0,0 +1,178 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+from threading import Thread
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from flask import Flask, request
+
+from app import app
+from models import db
+from ratelimit import LocalBuckets, RemoteBuckets, BucketServer, trust_proxies
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class FakeClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LocalBucketsTestCase(TestCase):
+    """Token buckets in memory."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.buckets = LocalBuckets(clock=self.clock)
+
+    def test_burst_and_refill(self):
+        """burst requests pass at once, then one per 1/rate seconds"""
+
+        request = [('login:ip:1.2.3.4', 0.5, 3)]
+
+        for _ in range(3):
+            self.assertEqual(self.buckets.take(request), 0)
+
+        self.assertAlmostEqual(self.buckets.take(request), 2.0)
+
+        self.clock.now += 1
+        self.assertAlmostEqual(self.buckets.take(request), 1.0)
+
+        self.clock.now += 1
+        self.assertEqual(self.buckets.take(request), 0)
+
+    def test_all_or_nothing(self):
+        """no bucket is drawn from unless every one has a token"""
+
+        user = ('add:user:1', 1.0, 1)
+        ip = ('add:ip:1.2.3.4', 1.0, 5)
+
+        self.assertEqual(self.buckets.take([user, ip]), 0)
+        self.assertGreater(self.buckets.take([user, ip]), 0)
+
+        # the denied request didn't use one of the IP's tokens
+        self.assertEqual(self.buckets.buckets['add:ip:1.2.3.4'][0], 4)
+
+    def test_prune(self):
+        """refilled buckets are forgotten"""
+
+        self.buckets.take([('a', 1.0, 2)])
+        self.buckets.take([('b', 0.01, 2)])
+
+        self.clock.now += 5
+        self.buckets.prune(self.clock())
+
+        self.assertEqual(list(self.buckets.buckets), ['b'])
+
+
+class RemoteBucketsTestCase(TestCase):
+    """Token buckets shared through a bucket server."""
+
+    def setUp(self):
+        self.server = BucketServer(('127.0.0.1', 0))
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host, port = self.server.server_address
+        self.clients = [RemoteBuckets(host, port), RemoteBuckets(host, port)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared(self):
+        """clients draw from the same buckets"""
+
+        request = [('login:ip:1.2.3.4', 0.001, 2), ('login:user:1', 0.001, 5)]
+
+        self.assertEqual(self.clients[0].take(request), 0)
+        self.assertEqual(self.clients[1].take(request), 0)
+        self.assertGreater(self.clients[0].take(request), 0)
+
+    def test_unreachable(self):
+        """requests are let through if the server is down"""
+
+        host, port = self.server.server_address
+        self.tearDown()
+
+        client = RemoteBuckets(host, port)
+        self.assertEqual(client.take([('login:ip:1.2.3.4', 0.001, 1)]), 0)
+
+        self.setUp()
+
+
+class RateLimitViewTestCase(TestCase):
+    """Budgets applied to routes."""
+
+    def setUp(self):
+        self.limiter = app.extensions['ratelimit']
+        self.limiter.backend.reset()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.limiter.backend.reset()
+        db.session.rollback()
+
+    def test_login_limited(self):
+        """too many login attempts get a 429 with Retry-After"""
+
+        form = {'username': 'nobody', 'password': 'password'}
+
+        for _ in range(10):
+            resp = self.client.post('/login', data=form)
+            self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.post('/login', data=form)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '6')
+
+        # other clients and showing the form aren't limited
+        resp = self.client.post('/login', data=form,
+                                environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/login')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_behind_proxy(self):
+        """Are clients told apart by X-Forwarded-For behind a proxy?"""
+
+        proxied = Flask(__name__)
+        proxied.add_url_rule('/ip', 'ip', lambda: request.remote_addr)
+        trust_proxies(proxied, 1)
+
+        client = proxied.test_client()
+        environ = {'REMOTE_ADDR': '10.0.0.1'}
+
+        resp = client.get('/ip', environ_base=environ,
+                          headers={'X-Forwarded-For': '1.2.3.4, 5.6.7.8'})
+        self.assertEqual(resp.get_data(as_text=True), '5.6.7.8')
+
+        resp = client.get('/ip', environ_base=environ)
+        self.assertEqual(resp.get_data(as_text=True), '10.0.0.1')
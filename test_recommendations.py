@@ -0,0 +1,120 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Message, Follows, Likes, Recommendation
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from graph import CSR, load_following
+import recommend
+from recommend import top_candidates, refresh_recommendations, rebuild_recommendations
+
+db.create_all()
+
+
+class RecommendationTestCase(TestCase):
+    """Test friend-of-friend recommendations."""
+
+    def setUp(self):
+        """Create users: u0 follows u1 & u2, who both follow u3; u1 follows u4."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        Recommendation.query.delete()
+
+        users = [
+            User(email=f"test{i}@test.com", username=f"testuser{i}", password="HASHED_PASSWORD")
+            for i in range(5)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u0, u1, u2, u3, u4 = users
+        u0.following.extend([u1, u2])
+        u1.following.extend([u3, u4])
+        u2.following.append(u3)
+        db.session.commit()
+
+        self.ids = [u.id for u in users]
+
+    def tearDown(self):
+        """Clean up any faulted transaction."""
+        db.session.rollback()
+
+    def test_csr(self):
+        """Does the CSR hold sorted adjacency lists?"""
+
+        following = CSR.from_edges(np.array([2, 0, 0, 1]), np.array([3, 2, 1, 3]))
+
+        self.assertEqual(following.size, 4)
+        self.assertEqual(list(following.neighbors(0)), [1, 2])
+        self.assertEqual(following.degree(3), 0)
+        self.assertEqual(list(following.neighbors(10)), [])
+
+    def test_top_candidates(self):
+        """Are candidates ranked by mutual follows?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+        following = load_following()
+
+        self.assertEqual(top_candidates(following, u0), [(u3, 2), (u4, 1)])
+        self.assertEqual(top_candidates(following, u0, k=1), [(u3, 2)])
+
+        #already following everything reachable
+        self.assertEqual(top_candidates(following, u3), [])
+
+    def test_refresh_recommendations(self):
+        """Does the per-user refresh store the same ranking?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+        refresh_recommendations(u0)
+
+        suggestions = Recommendation.for_user(u0)
+        self.assertEqual([(s.id, s.score) for s in suggestions], [(u3, 2), (u4, 1)])
+
+    def test_refresh_bounded(self):
+        """Does the per-user refresh bound its walk like the rebuild does?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+        saved = recommend.MAX_FOLLOWING_SCANNED, recommend.MAX_NEIGHBORS_SCANNED
+        recommend.MAX_FOLLOWING_SCANNED = recommend.MAX_NEIGHBORS_SCANNED = 1
+
+        try:
+            expected = top_candidates(load_following(), u0)
+            refresh_recommendations(u0)
+        finally:
+            recommend.MAX_FOLLOWING_SCANNED, recommend.MAX_NEIGHBORS_SCANNED = saved
+
+        suggestions = Recommendation.for_user(u0)
+        self.assertEqual([(s.id, s.score) for s in suggestions], expected)
+        self.assertEqual(expected, [(u3, 1)])
+
+    def test_rebuild_recommendations(self):
+        """Does the full rebuild store recommendations for everyone?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+        rebuild_recommendations()
+
+        suggestions = Recommendation.for_user(u0)
+        self.assertEqual([(s.id, s.score) for s in suggestions], [(u3, 2), (u4, 1)])
+        self.assertEqual(Recommendation.for_user(u2), [])
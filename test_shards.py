@@ -0,0 +1,288 @@
+"""Shard routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry, ShardBucket
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import cache
+import feed
+import shards
+from jobs import RetryLater
+from purge import purge_user
+from feed import home_feed
+from shards import BUCKETS, BucketMovingError, ShardRouter, plan_moves
+
+db.create_all()
+
+
+class PlanMovesTestCase(TestCase):
+    """Rebalancing plans."""
+
+    def test_plan_moves(self):
+        """Are the biggest buckets that fit moved to the emptiest shard?"""
+
+        moves = plan_moves({1: (0, 50), 2: (0, 30), 3: (0, 10), 4: (1, 20)}, range(3))
+
+        self.assertEqual(moves, [(2, 0, 2), (3, 0, 1)])
+
+    def test_balanced(self):
+        """Is nothing moved when no move would help?"""
+
+        self.assertEqual(plan_moves({1: (0, 50), 2: (1, 40)}, range(2)), [])
+
+
+class ShardRouterTestCase(TestCase):
+    """Messages and likes on two SQLite shards."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        ShardBucket.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        self.urls = [f"sqlite:///{self.dir}/shard{i}.db" for i in range(2)]
+        self.router = ShardRouter(self.urls, bucket_map_ttl=0)
+        self.router.create_tables()
+        self.router.init_buckets()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.users = users
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.router.configure([])
+        User.shard_router = None
+
+        for engine in self.router.engines:
+            engine.dispose()
+
+        shutil.rmtree(self.dir)
+
+    def rows_on(self, shard, table):
+        """(user id, id) of every row of `table` on `shard`."""
+
+        with self.router.connect(shard) as connection:
+            return sorted((row.user_id, row.id) for row in connection.execute(
+                self.router.messages.metadata.tables[table].select()))
+
+    def test_routing(self):
+        """Does each author's message go to their shard, and only there?"""
+
+        router = self.router
+        ids = {user.id: router.add_message(user.id, f"by {user.username}").id
+               for user in self.users}
+
+        for user in self.users:
+            shard = user.id % BUCKETS % 2
+            self.assertEqual(router.shard_of(user.id), shard)
+            self.assertIn((user.id, ids[user.id]), self.rows_on(shard, 'messages'))
+            self.assertNotIn((user.id, ids[user.id]), self.rows_on(1 - shard, 'messages'))
+
+            self.assertEqual([m.text for m in router.author_messages(user.id)],
+                             [f"by {user.username}"])
+
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_fan_out(self):
+        """Are reads across authors answered from every shard?"""
+
+        router = self.router
+        u0, u1, u2 = self.users
+        m0 = router.add_message(u0.id, "zero")
+        m1 = router.add_message(u1.id, "one")
+        m2 = router.add_message(u1.id, "two")
+
+        self.assertEqual(sorted(router.latest_message_ids([u0.id, u1.id, u2.id])),
+                         sorted([(u0.id, m0.id), (u1.id, m2.id)]))
+
+        self.assertEqual(router.find_message(m1.id), m1)
+        self.assertIsNone(router.find_message(m1.id + 1))
+        self.assertEqual(router.fetch_messages([(m0.id, u0.id), (m2.id, u1.id)]),
+                         {m0.id: m0, m2.id: m2})
+
+    def test_likes(self):
+        """Are likes kept on the liker's shard, and removed with the message?"""
+
+        router = self.router
+        u0, u1, u2 = self.users
+        message = router.add_message(u0.id, "likeable")
+
+        self.assertTrue(router.toggle_like(u1.id, message.id))
+        self.assertEqual(router.liked_ids(u1.id), [message.id])
+        self.assertEqual(router.count_likes(u1.id), 1)
+
+        liked = router.liked_messages(u1)
+        self.assertEqual([(m.id, m.username, m.likes) for m in liked],
+                         [(message.id, "testuser0", 1)])
+
+        # counted across the likers' shards
+        router.toggle_like(u0.id, message.id)
+        router.toggle_like(u2.id, message.id)
+        self.assertEqual(router.like_counts([message.id, message.id + 1]), {message.id: 3})
+
+        # streamed a batch at a time, each batch's likes counted as it's read
+        other = router.add_message(u2.id, "also likeable")
+        router.toggle_like(u1.id, other.id)
+        liked = router.liked_messages(u1, yield_per=1)
+        self.assertEqual([(m.id, m.likes) for m in (next(liked), next(liked))],
+                         [(other.id, 1), (message.id, 3)])
+        router.toggle_like(u1.id, other.id)
+        router.toggle_like(u0.id, message.id)
+        router.toggle_like(u2.id, message.id)
+
+        self.assertFalse(router.toggle_like(u1.id, message.id))
+        self.assertEqual(router.liked_ids(u1.id), [])
+
+        router.toggle_like(u1.id, message.id)
+        router.delete_message(message)
+
+        self.assertEqual(router.liked_ids(u1.id), [])
+        self.assertIsNone(router.find_message(message.id))
+
+    def test_move_bucket(self):
+        """Does a moved bucket take its rows to the new shard?"""
+
+        router = self.router
+        u0, u1, u2 = self.users
+        message = router.add_message(u0.id, "moving")
+        router.toggle_like(u0.id, router.add_message(u1.id, "liked").id)
+
+        source = router.shard_of(u0.id)
+        router.move_bucket(u0.id % BUCKETS, 1 - source, settle=0)
+
+        self.assertEqual(router.shard_of(u0.id), 1 - source)
+        self.assertEqual(router.author_messages(u0.id), [message])
+        self.assertEqual(router.count_likes(u0.id), 1)
+        self.assertNotIn(u0.id, [user_id for user_id, _ in self.rows_on(source, 'messages')])
+        self.assertEqual(router.bucket_rows()[u0.id % BUCKETS], (1 - source, 2))
+
+    def test_move_bucket_writes(self):
+        """Are writes refused while a bucket moves, and deletes kept?"""
+
+        router = self.router
+        u0, u1, u2 = self.users
+        bucket = u0.id % BUCKETS
+        source = router.shard_of(u0.id)
+        liked = router.add_message(u1.id, "liked")
+        router.toggle_like(u0.id, liked.id)
+
+        router.set_bucket(bucket, source, moving=True)
+
+        self.assertRaises(BucketMovingError, router.add_message, u0.id, "while moving")
+        self.assertRaises(BucketMovingError, router.toggle_like, u0.id, liked.id)
+
+        router.copy_bucket(bucket, source, 1 - source)
+
+        # deleted on the old shard after it was copied, as likes are when
+        # the message they like is deleted
+        with router.connect(source) as connection:
+            connection.execute(router.likes.delete().where(router.likes.c.user_id == u0.id))
+
+        self.assertEqual(router.drop_missing(bucket, source, 1 - source), 1)
+
+        router.set_bucket(bucket, 1 - source)
+
+        self.assertEqual(router.liked_ids(u0.id), [])
+        router.add_message(u0.id, "after the move")
+
+    def test_purge_user(self):
+        """Are a user's messages, and likes on them, purged a batch at a time,
+        and the purge put off while their bucket moves?"""
+
+        shards.router.configure(self.urls)
+        User.shard_router = shards.router
+
+        router = shards.router
+        u0, u1, u2 = self.users
+        ids = [router.add_message(u0.id, f"message {i}").id for i in range(3)]
+        router.toggle_like(u0.id, router.add_message(u1.id, "liked").id)
+        router.toggle_like(u1.id, ids[0])
+        router.toggle_like(u2.id, ids[1])
+        liker_ids = [u1.id, u2.id]
+
+        router.set_bucket(u0.id % BUCKETS, router.shard_of(u0.id), moving=True)
+        router.forget_bucket_map()
+        self.assertRaises(RetryLater, purge_user, u0.id)
+
+        router.set_bucket(u0.id % BUCKETS, router.shard_of(u0.id))
+        router.forget_bucket_map()
+        batches = []
+
+        with app.app_context():
+            counts = purge_user(u0.id, batch_size=2,
+                                progress=lambda user_id, table, deleted: batches.append((table, deleted)))
+
+        self.assertEqual(counts['messages'], 3)
+        self.assertEqual(counts['likes'], 1)
+        self.assertIn(('messages', 2), batches)
+        self.assertEqual(router.find_messages(ids), {})
+        self.assertEqual(router.liked_ids(liker_ids[0]), [])
+        self.assertEqual(router.liked_ids(liker_ids[1]), [])
+
+    def test_home_feed(self):
+        """Is a home page assembled from authors on both shards?"""
+
+        shards.router.configure(self.urls)
+        User.shard_router = shards.router
+
+        for c in (cache.recent, cache.authors, feed.hot):
+            c.clear()
+
+        u0, u1, u2 = self.users
+        u0.following.extend([u1, u2])
+        db.session.commit()
+
+        m1 = shards.router.add_message(u1.id, "one")
+        m2 = shards.router.add_message(u2.id, "two")
+
+        self.assertNotEqual(shards.router.shard_of(u1.id), shards.router.shard_of(u2.id))
+        self.assertEqual([card.id for card in home_feed(u0)], [m2.id, m1.id])
+        self.assertEqual(u1.messages_count(), 1)
+
+    def test_message_cards(self):
+        """Are cards of indexed messages read from their authors' shards only?"""
+
+        shards.router.configure(self.urls)
+        User.shard_router = shards.router
+
+        for c in (cache.messages, cache.authors):
+            c.clear()
+
+        u0, u1, u2 = self.users
+        m1 = shards.router.add_message(u1.id, "one")
+        m2 = shards.router.add_message(u2.id, "two")
+
+        cards = cache.message_cards([m2.id, m1.id], {m1.id: u1.id, m2.id: u2.id})
+        self.assertEqual([(card.id, card.username) for card in cards],
+                         [(m2.id, "testuser2"), (m1.id, "testuser1")])
+
+        # not looked for on any other shard
+        cache.messages.clear()
+        self.assertEqual(cache.message_cards([m1.id], {m1.id: u2.id}), [])
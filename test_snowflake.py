@@ -0,0 +1,138 @@
+"""Message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from flask import Flask
+
+from snowflake import (IdGenerator, WorkerIdError, init_snowflake, make_id, min_id_at,
+                       timestamp_of, MAX_SEQUENCE)
+
+
+class FakeClock:
+    """A clock that moves a millisecond when told to, or after `ticks` reads."""
+
+    def __init__(self, ticks=None):
+        self.now = 1600000000.0
+        self.ticks = ticks
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+
+        if self.ticks and self.reads % self.ticks == 0:
+            self.now += 0.001
+
+        return self.now
+
+
+class IdGeneratorTestCase(TestCase):
+    """Time-ordered ids."""
+
+    def test_increasing(self):
+        """Do ids made in the same millisecond still increase?"""
+
+        clock = FakeClock()
+        next_id = IdGenerator(worker_id=5, clock=clock)
+        ids = [next_id() for _ in range(3)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(len({timestamp_of(id) for id in ids}), 1)
+        self.assertEqual((ids[0] >> 12) & 1023, 5)
+
+    def test_clock_back(self):
+        """Do ids keep increasing when the clock goes back?"""
+
+        clock = FakeClock()
+        next_id = IdGenerator(worker_id=1, clock=clock)
+        first = next_id()
+
+        clock.now -= 1
+        self.assertGreater(next_id(), first)
+
+    def test_sequence_overflow(self):
+        """Does a full millisecond wait for the next one?"""
+
+        clock = FakeClock(ticks=10000)
+        next_id = IdGenerator(worker_id=1, clock=clock)
+        ids = [next_id() for _ in range(MAX_SEQUENCE + 2)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[-1] & MAX_SEQUENCE, 0)
+        self.assertGreater(timestamp_of(ids[-1]), timestamp_of(ids[0]))
+
+    def test_timestamps(self):
+        """Do ids give back the time they were made?"""
+
+        when = datetime(2021, 6, 1, 12, 30, 15, 250000)
+        id = make_id(min_id_at(when) >> 22, 1023, MAX_SEQUENCE)
+
+        self.assertEqual(timestamp_of(id), when)
+        self.assertGreater(id, min_id_at(when))
+        self.assertLess(id, min_id_at(datetime(2021, 6, 1, 12, 30, 15, 251000)))
+
+
+class WorkerLeaseTestCase(TestCase):
+    """Worker ids leased per process."""
+
+    def setUp(self):
+        self.lock_dir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.lock_dir.cleanup()
+
+    def generator(self):
+        next_id = IdGenerator()
+        next_id.configure(5, 2, self.lock_dir.name)
+        return next_id
+
+    def test_lease(self):
+        """Do live processes hold different worker ids of the range?"""
+
+        first, second, third = self.generator(), self.generator(), self.generator()
+
+        self.assertEqual((first.worker(), second.worker()), (5, 6))
+        self.assertRaises(WorkerIdError, third.worker)
+
+        # a process gone frees its id
+        first.lease.close()
+        self.assertEqual(third.worker(), 5)
+
+    def test_fork(self):
+        """Does a forked process lease its own worker id?"""
+
+        next_id = self.generator()
+        parent = next_id()
+        reader, writer = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                os.write(writer, str(next_id()).encode())
+            finally:
+                os._exit(0)
+
+        os.close(writer)
+        child = int(os.read(reader, 100))
+        os.close(reader)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(((parent >> 12) & 1023, (child >> 12) & 1023), (5, 6))
+
+    def test_unconfigured(self):
+        """Is there no id without a worker id range?"""
+
+        self.assertRaises(WorkerIdError, IdGenerator())
+        self.assertRaises(WorkerIdError, IdGenerator().configure, 1020, 16)
+
+    def test_refuse_to_start(self):
+        """Does the app refuse to start in production without a range?"""
+
+        self.assertRaises(WorkerIdError, init_snowflake, Flask(__name__))
@@ -0,0 +1,88 @@
+"""Hot query tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_statements.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.dialects.postgresql import psycopg2
+
+from models import db, User, Follows, USER_FOLLOWING_COUNT
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import statements
+from statements import Statement
+
+db.create_all()
+
+
+class StatementTestCase(TestCase):
+    """Statements built once."""
+
+    def setUp(self):
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        users[0].following.extend(users[1:])
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_compiled_once(self):
+        """Is a statement compiled once, whatever its parameters?"""
+
+        u0, u1, u2 = self.user_ids
+        statement = Statement(db.select([Follows.user_being_followed_id])
+                              .where(Follows.user_following_id == db.bindparam('user_id')))
+
+        before = len(statements.compiled_cache)
+
+        self.assertEqual(sorted(id for (id,) in statement.execute(db.session, user_id=u0)),
+                         [u1, u2])
+        self.assertEqual(statement.execute(db.session, user_id=u1).fetchall(), [])
+        self.assertEqual(len(statements.compiled_cache), before + 1)
+
+        self.assertEqual(USER_FOLLOWING_COUNT.execute(db.session, user_id=u0).scalar(), 2)
+
+    def test_prepared_sql(self):
+        """Are parameters numbered for PREPARE on Postgres?"""
+
+        statement = Statement(db.select([Follows.user_being_followed_id])
+                              .where(Follows.user_following_id == db.bindparam('user_id'))
+                              .limit(db.bindparam('limit')), 'following')
+
+        sql, names = statement.prepared_sql(psycopg2.dialect())
+
+        self.assertIn("follows.user_following_id = $1", sql)
+        self.assertIn("LIMIT $2", sql)
+        self.assertEqual(names, ['user_id', 'limit'])
+
+    def test_find(self):
+        """Does the baked user lookup find users, deleted or not?"""
+
+        u0, u1, u2 = self.user_ids
+        db.session.expunge_all()
+
+        self.assertEqual(User.find(u1).username, "testuser1")
+        self.assertIsNone(User.find(0))
@@ -0,0 +1,150 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, MessageTag, Mention
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import app as views
+import cache
+from tags import backfill_tags, hashtags, link_tags, mentioned_usernames, mentioning, tagged
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ParseTestCase(TestCase):
+    """Finding tags and mentions in text."""
+
+    def test_parse(self):
+        """Are tags lowercased and both de-duplicated?"""
+
+        text = "#Flask and #flask, not a#b; @bob @amy @bob me@example.com"
+
+        self.assertEqual(hashtags(text), ['flask'])
+        self.assertEqual(mentioned_usernames(text), ['bob', 'amy'])
+
+    def test_link_tags(self):
+        """Are tags linked and the rest escaped?"""
+
+        self.assertEqual(link_tags("<b> #Hi"), '&lt;b&gt; <a href="/tags/hi">#Hi</a>')
+
+
+class TagsTestCase(TestCase):
+    """Indexing messages and the tag and mentions pages."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for c in (cache.messages, cache.authors, cache.recent):
+            c.clear()
+
+        self.client = app.test_client()
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+    def post(self, client, text):
+        client.post('/messages/new', data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def test_index(self):
+        """Are posted messages indexed, and unindexed when deleted?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            first = self.post(c, "#one @reader @nobody")
+            second = self.post(c, "#one #Two")
+
+            self.assertEqual(tagged('one'), [(second, self.author_id), (first, self.author_id)])
+            self.assertEqual(tagged('TWO'), [(second, self.author_id)])
+            self.assertEqual(tagged('one', before=second), [(first, self.author_id)])
+            self.assertEqual(mentioning(self.reader_id), [(first, self.author_id)])
+
+            c.post(f'/messages/{first}/delete')
+
+            self.assertEqual(tagged('one'), [(second, self.author_id)])
+            self.assertEqual(mentioning(self.reader_id), [])
+
+    def test_backfill(self):
+        """Are messages posted before indexing indexed by the backfill?"""
+
+        db.session.add_all([Message(user_id=self.author_id, text=f"#old {i} @reader")
+                            for i in range(3)])
+        db.session.commit()
+
+        self.assertEqual(tagged('old'), [])
+        self.assertEqual(backfill_tags(batch_size=2), 3)
+        self.assertEqual(len(tagged('old')), 3)
+        self.assertEqual(len(mentioning(self.reader_id)), 3)
+
+        # again, without duplicates
+        backfill_tags()
+        self.assertEqual(len(tagged('old')), 3)
+
+    def test_pages(self):
+        """Are tag and mentions pages paged by message id?"""
+
+        page = views.INDEX_PAGE
+        views.INDEX_PAGE = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.author_id
+
+                ids = [self.post(c, f"message {i} #paged @reader") for i in range(3)]
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+
+                html = c.get('/tags/Paged').get_data(as_text=True)
+                self.assertIn("message 2", html)
+                self.assertIn("message 1", html)
+                self.assertNotIn("message 0", html)
+                self.assertIn(f'?before={ids[1]}', html)
+
+                html = c.get(f'/tags/paged?before={ids[1]}').get_data(as_text=True)
+                self.assertIn("message 0", html)
+                self.assertNotIn("message 1", html)
+                self.assertNotIn("?before=", html)
+
+                html = c.get(f'/users/{self.reader_id}/mentions').get_data(as_text=True)
+                self.assertIn("Mentioning @reader", html)
+                self.assertIn("message 2", html)
+
+                self.assertEqual(c.get('/users/0/mentions').status_code, 404)
+        finally:
+            views.INDEX_PAGE = page
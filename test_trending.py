@@ -0,0 +1,174 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import cache
+import trending
+from trending import CountMinSketch, SlidingCounter, TopK
+
+db.create_all()
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CountersTestCase(TestCase):
+    """Sketches, top-K and sliding windows."""
+
+    def test_sketch(self):
+        """Are counts never under, and exact with few keys?"""
+
+        sketch = CountMinSketch(width=64, depth=4)
+
+        for key in range(200):
+            sketch.add(key, key % 7)
+
+        self.assertTrue(all(sketch.estimate(key) >= key % 7 for key in range(200)))
+
+        sketch = CountMinSketch()
+        sketch.add('a', 3)
+        sketch.add('b')
+
+        self.assertEqual((sketch.estimate('a'), sketch.estimate('b'), sketch.estimate('c')),
+                         (3, 1, 0))
+
+    def test_top_k(self):
+        """Are the biggest counts kept as counts change?"""
+
+        top = TopK(k=2)
+
+        for key, count in [('a', 1), ('b', 2), ('c', 3), ('a', 4), ('b', 1)]:
+            top.update(key, count)
+
+        self.assertEqual(top.most_common(), [('a', 4), ('c', 3)])
+
+    def test_window(self):
+        """Do counts drop out as the window moves on?"""
+
+        now = [0]
+        counter = SlidingCounter(window=60, slots=6, clock=lambda: now[0])
+
+        counter.add('old', 5)
+        now[0] = 30
+        counter.add('new', 2)
+
+        self.assertEqual(counter.most_common(), [('old', 5), ('new', 2)])
+
+        now[0] = 65
+        self.assertEqual(counter.estimate('old'), 0)
+        self.assertEqual(counter.most_common(), [('new', 2)])
+
+        now[0] = 1000
+        self.assertEqual(counter.most_common(), [])
+
+    def test_unlike(self):
+        """Is an unlike taken off the slot its like was counted in, and only
+        while that's in the window?"""
+
+        now = [0]
+        saved = trending.likes, trending.liked_slots
+        trending.likes = SlidingCounter(window=60, slots=6, clock=lambda: now[0])
+        trending.liked_slots = cache.TTLCache()
+
+        try:
+            trending.count_like(1, 'm')
+            now[0] = 30
+            trending.count_like(2, 'm')
+            trending.count_like(1, 'm', liked=False)
+            self.assertEqual(trending.likes.estimate('m'), 1)
+
+            # liked again, then the like drops out of the window
+            trending.count_like(1, 'm')
+            now[0] = 95
+            trending.count_like(3, 'm')
+            trending.count_like(1, 'm', liked=False)
+            trending.count_like(2, 'm', liked=False)
+
+            self.assertEqual(trending.likes.estimate('m'), 1)
+            self.assertEqual(trending.likes.most_common(), [('m', 1)])
+
+            # never counted by this process
+            trending.count_like(4, 'm', liked=False)
+            self.assertEqual(trending.likes.estimate('m'), 1)
+        finally:
+            trending.likes, trending.liked_slots = saved
+
+
+class TrendingViewTestCase(TestCase):
+    """/trending."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for c in (cache.messages, cache.authors, cache.recent):
+            c.clear()
+
+        trending.likes = SlidingCounter()
+        trending.posts = SlidingCounter()
+        trending.liked_slots.clear()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"user{i}", email=f"user{i}@test.com",
+                             password="password", image_url=None) for i in range(3)]
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+
+    def test_trending(self):
+        """Are the messages liked lately shown, most liked first?"""
+
+        author, reader, other = self.user_ids
+
+        with self.client as c:
+            resp = c.get('/trending', follow_redirects=True)
+            self.assertIn('Access unauthorized.', resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author
+
+            for text in ("liked once", "liked twice", "not liked"):
+                c.post('/messages/new', data={"text": text})
+
+            ids = {msg.text: msg.id for msg in Message.query.all()}
+
+            # liked, unliked and liked again: an unlike takes its like off
+            for user_id, text in [(reader, "liked twice"), (reader, "liked twice"),
+                                  (reader, "liked twice"), (other, "liked twice"),
+                                  (reader, "liked once"), (reader, "liked once"),
+                                  (other, "liked once")]:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                c.post(f'/users/add_like/{ids[text]}')
+
+            html = c.get('/trending').get_data(as_text=True)
+
+        self.assertLess(html.index("liked twice"), html.index("liked once"))
+        self.assertNotIn("not liked", html)
+        self.assertIn("3 new messages", html)
+        self.assertEqual(trending.likes.estimate(ids["liked twice"]), 2)
+        self.assertEqual(trending.likes.estimate(ids["liked once"]), 1)
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError , InvalidRequestError
-from models import db, User, Message, Follows , Likes
+from models import db, read_rows, User, UserCard, Message, Follows , Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -109,6 +109,56 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u1.is_following(u2) , True)
         self.assertEqual(u2.is_followed_by(u1) , True)
 
+    def test_follows_page(self):
+        """Do following_page & followers_page page through follows with the viewer's flags?"""
+
+        users = [
+            User(email=f"test{i}@test.com" , username=f"testuser{i}" , password="HASHED_PASSWORD")
+            for i in range(4)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u1 , u2 , u3 , u4 = users
+
+        # u1 follows everyone else, u2 follows u3
+        u1.following.extend([u2 , u3 , u4])
+        u2.following.append(u3)
+        db.session.commit()
+
+        self.assertEqual(u1.following_count() , 3)
+        self.assertEqual(u3.followers_count() , 2)
+
+        rows , next_after = u1.following_page(viewer_id=u2.id , limit=2)
+        self.assertEqual([row.id for row in rows] , [u2.id , u3.id])
+        self.assertEqual([row.viewer_follows for row in rows] , [False , True])
+        self.assertEqual(next_after , u3.id)
+
+        rows , next_after = u1.following_page(viewer_id=u2.id , after=next_after , limit=2)
+        self.assertEqual([row.id for row in rows] , [u4.id])
+        self.assertIsNone(next_after)
+
+        rows , next_after = u3.followers_page(viewer_id=u1.id)
+        self.assertEqual([row.username for row in rows] , ["testuser0" , "testuser1"])
+        self.assertEqual([row.viewer_follows for row in rows] , [False , True])
+
+    def test_read_rows(self):
+        """Are list rows read as plain tuples, all at once or streamed?"""
+
+        users = [
+            User(email=f"test{i}@test.com" , username=f"testuser{i}" , password="HASHED_PASSWORD")
+            for i in range(3)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        rows = read_rows(User.cards() , UserCard)
+        self.assertEqual([type(row) for row in rows] , [UserCard] * 3)
+        self.assertEqual([row.username for row in rows] , ["testuser0" , "testuser1" , "testuser2"])
+
+        streamed = read_rows(User.cards() , UserCard , yield_per=2)
+        self.assertEqual(list(streamed) , rows)
+
     def test_signup(self):
         """
         test for signup classmethod
@@ -181,3 +231,11 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(user , False)
 
+
+        #deleted user can not log in
+        u.mark_deleted()
+        db.session.commit()
+
+        user = User.authenticate(username='test' , password='password')
+
+        self.assertEqual(user , False)
@@ -9,7 +9,7 @@ import os
 from csv import DictReader
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError , InvalidRequestError
-from models import db, User, Message, Follows , Likes
+from models import db, User, Message, Follows , Likes , Job
 from flask import session, request, g
 
 # BEFORE we import our app, let's set an environmental variable
@@ -23,6 +23,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app,CURR_USER_KEY
+from jobs import run_pending
+from warmup import warm_templates, timings
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -50,6 +52,7 @@ class UserViewTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         Likes.query.delete()
+        Job.query.delete()
 
         self.client = app.test_client()
 
@@ -112,6 +115,15 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('@testuser' , html)
 
+    def test_warmup(self):
+        """templates precompiled and requests timed"""
+
+        self.assertGreater(warm_templates(app) , 0)
+
+        resp = self.client.get('/signup')
+        self.assertIn('app;dur=' , resp.headers['Server-Timing'])
+        self.assertIsNotNone(timings['first_request_ms'])
+
     def test_signup(self):
         """signup"""
 
@@ -196,6 +208,35 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('@testuser' , html)
 
+            resp = client.get('/users?q=nobody')
+            html = resp.get_data(as_text=True)
+            self.assertIn('Sorry, no users found' , html)
+
+    def test_users_streamed(self):
+        """list pages are streamed, with follow state per card"""
+        with self.client as client:
+            self.login()
+            client.post(f'/users/follow/{self.u2_id}')
+
+            resp = client.get('/users')
+            self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.u2_id}"' , html)
+            self.assertIn(f'action="/users/follow/{self.u1_id}"' , html)
+
+            # flashed messages are shown once, not kept for the next page
+            with client.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello streamed')]
+
+            html = client.get('/users').get_data(as_text=True)
+            self.assertIn('Hello streamed' , html)
+
+            html = client.get('/users').get_data(as_text=True)
+            self.assertNotIn('Hello streamed' , html)
+
+            self.logout()
+
     def test_users_show(self):
         """users_show"""
         with self.client as client:
@@ -217,6 +258,65 @@ class UserViewTestCase(TestCase):
 
             self.logout()
 
+    def test_users_show_fresh(self):
+        """users_show reads the first page from the database, not a buffer
+        another worker may have filled before a post or a delete"""
+        with self.client as client:
+            old = Message(user_id=self.u1_id , text="old message")
+            db.session.add(old)
+            db.session.commit()
+
+            # fills this worker's buffer of the author's recent messages
+            self.assertIn('old message' , client.get(f'/users/{self.u1_id}').get_data(as_text=True))
+
+            # posted and deleted through another worker
+            db.session.add(Message(user_id=self.u1_id , text="new message"))
+            db.session.delete(old)
+            db.session.commit()
+
+            html = client.get(f'/users/{self.u1_id}').get_data(as_text=True)
+            self.assertIn('new message' , html)
+            self.assertNotIn('old message' , html)
+
+    def test_homepage_own_fresh(self):
+        """the home page reads the user's own messages from the database, not
+        a buffer another worker may have filled before a post or a delete"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            old = Message(user_id=self.u1_id , text="old message")
+            db.session.add(old)
+            db.session.commit()
+
+            self.assertIn('old message' , client.get('/').get_data(as_text=True))
+
+            # posted and deleted through another worker
+            db.session.add(Message(user_id=self.u1_id , text="new message"))
+            db.session.delete(old)
+            db.session.commit()
+
+            html = client.get('/').get_data(as_text=True)
+            self.assertIn('new message' , html)
+            self.assertNotIn('old message' , html)
+
+    def test_users_show_before(self):
+        """users_show pages back with 'before'"""
+        with self.client as client:
+            msgs = [Message(user_id=self.u1_id , text=f"message {i}") for i in range(3)]
+
+            for msg in msgs:
+                db.session.add(msg)
+                db.session.commit()
+
+            resp = client.get(f'/users/{self.u1_id}?before={msgs[2].id}')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('message 0' , html)
+            self.assertIn('message 1' , html)
+            self.assertNotIn('message 2' , html)
+            self.assertNotIn('?before=' , html)
+
 
     def test_users_following(self):
         """users_following"""
@@ -394,11 +494,24 @@ class UserViewTestCase(TestCase):
 
             self.login()
 
+            msg = Message(user_id=self.u1_id , text="test text")
+            follow = Follows(user_being_followed_id=self.u2_id , user_following_id=self.u1_id)
+            db.session.add_all([msg , follow])
+            db.session.commit()
+
             resp = client.post(f'/users/delete' , follow_redirects=True)
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn(CURR_USER_KEY , session)
 
+            #marked deleted right away, purged by the background job
+            self.assertIsNotNone(User.query.get(self.u1_id).deleted_at)
+            run_pending()
+
+            self.assertIsNone(User.query.get(self.u1_id))
+            self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count() , 0)
+            self.assertEqual(Follows.query.filter_by(user_following_id=self.u1_id).count() , 0)
+
     
 
             
\ No newline at end of file
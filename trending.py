@@ -0,0 +1,248 @@
+"""Trending messages and active authors.
+
+Likes (per message) and posts (per author) are counted over a sliding
+window of `TRENDING_WINDOW` seconds, an hour by default, as they happen:
+the like and post views call `count_like`/`count_post`. The window is cut
+into `SLOTS` slots, each with its own count-min sketch, and the oldest slot
+is dropped as time moves on, so memory stays fixed however many messages
+are liked. Next to the sketches a top-K heap keeps the keys with the
+biggest counts, which is what `/trending` shows; nothing is read from the
+likes table.
+
+Counts are approximate (a sketch can only overestimate, by a little), kept
+per process and start empty: each worker ranks what it has seen, which for
+trends is a fair sample. An unlike takes its like back off the slot it was
+counted in, if that's still in the window and the like was counted by this
+process (see `count_like`), so liking a message over and over doesn't push
+it up and no count goes below zero.
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from collections import deque
+
+from cache import TTLCache, authors, load_author, message_cards
+
+# seconds of likes and posts counted
+WINDOW = 60 * 60
+
+# slots the window is cut into; the window moves on one slot at a time
+SLOTS = 12
+
+# counters per row of each sketch, and rows; estimates are off by at most
+# about 2 / WIDTH of the slot's total, with probability 1 - 2 ** -DEPTH
+WIDTH = 2048
+DEPTH = 4
+
+# keys ranked
+TOP = 100
+
+# likes whose slot is remembered, for unlikes to take them back off
+LIKES_REMEMBERED = 100000
+
+
+class CountMinSketch:
+    """Approximate counts of keys in fixed memory."""
+
+    def __init__(self, width=WIDTH, depth=DEPTH):
+        self.width = width
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    def cells(self, key):
+        for seed, row in enumerate(self.rows):
+            yield row, hash((seed, key)) % self.width
+
+    def add(self, key, count=1):
+        for row, cell in self.cells(key):
+            row[cell] += count
+
+    def estimate(self, key):
+        """At least the count of `key`, rarely more."""
+
+        return min(row[cell] for row, cell in self.cells(key))
+
+
+class TopK:
+    """The `k` keys with the biggest counts seen.
+
+    A min-heap of (count, key) with the smallest of the kept counts on top,
+    so a key that beats it takes its place. Entries whose count has since
+    changed are left in the heap and skipped when they come up.
+    """
+
+    def __init__(self, k=TOP):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def update(self, key, count):
+        self.counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+
+        while len(self.counts) > self.k:
+            count, key = heapq.heappop(self.heap)
+
+            if self.counts.get(key) == count:
+                del self.counts[key]
+
+        if len(self.heap) > 4 * self.k:
+            self.rebuild()
+
+    def rescore(self, estimate):
+        """Replace the kept counts with `estimate(key)`, dropping zeros."""
+
+        self.counts = {key: count for key, count in
+                       ((key, estimate(key)) for key in self.counts) if count}
+        self.rebuild()
+
+    def rebuild(self):
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def most_common(self, limit=None):
+        """(key, count) pairs, biggest count first."""
+
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:limit]
+
+
+class SlidingCounter:
+    """Approximate counts of keys over the last `window` seconds, and the
+    keys counted most."""
+
+    def __init__(self, window=WINDOW, slots=SLOTS, top=TOP,
+                 width=WIDTH, depth=DEPTH, clock=time.time):
+        self.span = window / slots
+        self.slots = slots
+        self.width = width
+        self.depth = depth
+        self.clock = clock
+        self.sketches = deque()
+        self.top = TopK(top)
+        self.lock = threading.Lock()
+
+    def advance(self):
+        """Start the current slot and drop those out of the window."""
+
+        slot = int(self.clock() // self.span)
+
+        if self.sketches and self.sketches[-1][0] == slot:
+            return
+
+        dropped = False
+
+        while self.sketches and self.sketches[0][0] <= slot - self.slots:
+            self.sketches.popleft()
+            dropped = True
+
+        self.sketches.append((slot, CountMinSketch(self.width, self.depth)))
+
+        if dropped:
+            self.top.rescore(self.count)
+
+    def count(self, key):
+        return sum(sketch.estimate(key) for _, sketch in self.sketches)
+
+    def add(self, key, count=1, slot=None):
+        """Count `key`, in the current slot or in `slot`.
+
+        Returns the slot counted in; None if `slot` has left the window.
+        """
+
+        with self.lock:
+            self.advance()
+
+            if slot is None:
+                slot, sketch = self.sketches[-1]
+            else:
+                sketch = dict(self.sketches).get(slot)
+
+                if sketch is None:
+                    return None
+
+            sketch.add(key, count)
+            self.top.update(key, self.count(key))
+
+            return slot
+
+    def estimate(self, key):
+        """About how many times `key` was counted in the window."""
+
+        with self.lock:
+            self.advance()
+            return self.count(key)
+
+    def most_common(self, limit=None):
+        """(key, count) of the keys counted most in the window, most first."""
+
+        with self.lock:
+            self.advance()
+            return self.top.most_common(limit)
+
+
+likes = SlidingCounter()
+posts = SlidingCounter()
+
+# (user id, message id) -> slot their like was counted in
+liked_slots = TTLCache(size=LIKES_REMEMBERED, ttl=WINDOW)
+
+
+def count_like(user_id, message_id, liked=True):
+    """Count a like of `message_id` by `user_id`, or take back the like an
+    unlike undoes.
+
+    A like is taken off the slot it was counted in, and only if this
+    process counted it and the slot is still in the window: otherwise it
+    isn't in the counts to take back.
+    """
+
+    key = (user_id, message_id)
+
+    if liked:
+        liked_slots.put(key, likes.add(message_id))
+        return
+
+    slot = liked_slots.get(key, lambda key: None)
+
+    if slot is not None:
+        liked_slots.invalidate(key)
+        likes.add(message_id, -1, slot)
+
+
+def count_post(message):
+    posts.add(message.user_id)
+
+
+def trending_messages(limit=TOP):
+    """(`MessageCard`, likes) of the messages liked most lately, most first.
+
+    Deleted messages are left out.
+    """
+
+    counts = {message_id: count for message_id, count in likes.most_common(limit)
+              if count > 0}
+
+    return [(card, counts[card.id]) for card in message_cards(list(counts))]
+
+
+def active_authors(limit=TOP):
+    """(user id, username, image url, posts) of the accounts that posted
+    most lately, most first."""
+
+    rows = []
+
+    for user_id, count in posts.most_common(limit):
+        author = authors.get(user_id, load_author)
+
+        if author:
+            rows.append((user_id, *author, count))
+
+    return rows
+
+
+def init_trending(app):
+    """Set the window from the app config."""
+
+    for counter in (likes, posts):
+        counter.span = app.config.get('TRENDING_WINDOW', WINDOW) / counter.slots
@@ -0,0 +1,95 @@
+"""Make cold workers as fast as warm ones.
+
+Compiling a Jinja template to Python takes far longer than rendering it, and
+every new worker process used to pay that on the first request for each
+page. `init_warmup` points Jinja at an on-disk bytecode cache, shared by
+every worker and kept across deploys, and loads every template when the app
+starts. It also times requests, so the first request a worker serves can be
+compared with the ones after it:
+
+- each response gets a `Server-Timing: app;dur=<ms>` header
+- the first request of each worker is logged
+- `timings` keeps the first and average request times of this process
+"""
+
+import os
+import time
+
+from flask import current_app, g, request
+from jinja2 import FileSystemBytecodeCache
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var', 'jinja')
+
+# when this module was imported: roughly when the worker started
+BOOT_TIME = time.perf_counter()
+
+timings = {
+    'first_request_ms': None,
+    'first_request_after_boot_ms': None,
+    'requests': 0,
+    'total_ms': 0.0,
+}
+
+
+def warm_templates(app):
+    """Load (compile, or read from the bytecode cache) every template.
+
+    Returns the number of templates loaded.
+    """
+
+    names = app.jinja_env.list_templates(extensions=['html'])
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def start_timer():
+    """Note when the request started."""
+
+    g.request_start = time.perf_counter()
+
+
+def record_timing(response):
+    """Record how long the request took, up to the response headers."""
+
+    start = g.get('request_start')
+
+    if start is None:
+        return response
+
+    now = time.perf_counter()
+    duration = (now - start) * 1000
+
+    if timings['first_request_ms'] is None:
+        timings['first_request_ms'] = duration
+        timings['first_request_after_boot_ms'] = (now - BOOT_TIME) * 1000
+        current_app.logger.info(
+            f"worker {os.getpid()} first request {request.path}: "
+            f"{duration:.1f} ms, {timings['first_request_after_boot_ms']:.0f} ms after boot")
+
+    timings['requests'] += 1
+    timings['total_ms'] += duration
+
+    response.headers['Server-Timing'] = f"app;dur={duration:.1f}"
+    return response
+
+
+def init_warmup(app):
+    """Set up the bytecode cache and request timing, then warm templates."""
+
+    cache_dir = app.config.get('JINJA_CACHE_DIR', CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    app.before_request(start_timer)
+    app.after_request(record_timing)
+
+    if app.config.get('TEMPLATE_WARMUP', True):
+        start = time.perf_counter()
+        count = warm_templates(app)
+
+        app.logger.info(f"{count} templates warmed in "
+                        f"{(time.perf_counter() - start) * 1000:.0f} ms")